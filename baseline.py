@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+#
+#  BSD LICENSE
+#
+#  Copyright (c) Crane Che <cranechu@gmail.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in
+#      the documentation and/or other materials provided with the
+#      distribution.
+#    * Neither the name of Intel Corporation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+#  "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+#  LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+#  OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+#  SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+#  LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+#  DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+#  THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#  (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""performance baseline of ioworker results, and the regression gate
+
+    def test_random_read(nvme0n1, baseline):
+        results = [nvme0n1.ioworker(io_size=8, lba_align=8, lba_random=True,
+                                    read_percentage=100, time=10,
+                                    output_io_per_second=[]).start().close()
+                   for i in range(3)]
+        baseline.check(results)
+
+    sudo python3 -B -m pytest perf_test.py --pciaddr=01:00.0 --baseline=baseline.json
+
+Results are kept by drive model, firmware and workload signature (the
+ioworker arguments). The first run of a workload, or any run with
+--baseline-update, is recorded as the baseline, and later runs fail when
+any metric is worse than the baseline beyond its tolerance band. The band is the larger one of the relative tolerance
+and 3 standard errors of the difference, estimated from the repeats. The
+noise cannot be estimated without repeats, so the band is the relative
+tolerance when the baseline or the new results have only one run.
+"""
+
+import math
+import json
+import time
+import hashlib
+import logging
+import statistics
+
+import pytest
+
+
+# metrics compared, 1: higher is better, -1: lower is better
+METRICS = {
+    "iops": 1,
+    "iops_consistency": 1,
+    "latency_average_us": -1,
+    "latency_p99_us": -1,
+    "latency_p999_us": -1,
+}
+
+
+def workload_signature(args):
+    """short and stable id of the ioworker arguments"""
+    text = json.dumps(args, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+
+def result_metrics(result):
+    """get the compared metrics of one ioworker result"""
+    ret = {}
+    if result["mseconds"]:
+        ret["iops"] = (result["io_count_read"]+result["io_count_write"])*1000/result["mseconds"]
+    if "iops_consistency" in result:
+        ret["iops_consistency"] = result["iops_consistency"]
+    if "latency_average_us" in result:
+        ret["latency_average_us"] = result["latency_average_us"]
+    if "latency_intervals" in result and result["latency_intervals"]["p99_us"]:
+        ret["latency_p99_us"] = max(result["latency_intervals"]["p99_us"])
+        ret["latency_p999_us"] = max(result["latency_intervals"]["p999_us"])
+    return ret
+
+
+def _run_record(result):
+    return {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "metrics": result_metrics(result),
+            "io_per_second": list(result.get("io_per_second", []))}
+
+
+def _stderr(runs, metric):
+    """standard error of the mean of the metric over runs, None without repeats"""
+    values = [r["metrics"][metric] for r in runs]
+    if len(values) < 2:
+        # io per second within one run is not the noise between runs
+        return None
+    return statistics.stdev(values)/math.sqrt(len(values))
+
+
+def compare(base_runs, new_runs, tolerance=0.02):
+    """compare new runs against the baseline runs
+
+    # Attributes
+        base_runs (list): run records of the baseline
+        new_runs (list): run records of the new runs
+        tolerance (float or dict): relative tolerance of all metrics, or of each metric. Default: 0.02
+
+    # Returns
+        (list): a dict of each metric: metric, baseline, new, change, band and regression
+    """
+
+    ret = []
+    for metric, direction in METRICS.items():
+        if not all(metric in r["metrics"] for r in base_runs+new_runs):
+            continue
+
+        base = statistics.mean(r["metrics"][metric] for r in base_runs)
+        new = statistics.mean(r["metrics"][metric] for r in new_runs)
+        tol = tolerance.get(metric, 0.02) if isinstance(tolerance, dict) else tolerance
+        base_err = _stderr(base_runs, metric)
+        new_err = _stderr(new_runs, metric)
+        noise = 0.0
+        if base_err is not None and new_err is not None:
+            noise = 3*math.sqrt(base_err**2 + new_err**2)
+        change = (new-base)/base if base else 0.0
+        band = max(tol, noise/base if base else 0.0)
+        ret.append({"metric": metric,
+                    "baseline": base,
+                    "new": new,
+                    "change": change,
+                    "band": band,
+                    "regression": change*direction < -band})
+    return ret
+
+
+def report(rows):
+    """text table of the comparison"""
+    lines = ["%-20s %14s %14s %9s %8s  %s" %
+             ("metric", "baseline", "new", "change", "band", "verdict")]
+    for r in rows:
+        lines.append("%-20s %14.2f %14.2f %+8.2f%% %7.2f%%  %s" %
+                     (r["metric"], r["baseline"], r["new"], r["change"]*100,
+                      r["band"]*100, "REGRESSION" if r["regression"] else "ok"))
+    return "\n".join(lines)
+
+
+class Baseline(object):
+    """baseline store in a JSON file, used by fixture "baseline"
+
+    # Attributes
+        path (str): the JSON file of the baseline
+        update (bool): record results as the new baseline, instead of comparing. Default: False
+        tolerance (float or dict): relative tolerance of all metrics, or of each metric. Default: 0.02
+    """
+
+    def __init__(self, path, update=False, tolerance=0.02):
+        self.path = path
+        self.update = update
+        self.tolerance = tolerance
+        try:
+            with open(path) as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = {}
+
+    def key(self, result):
+        """the baseline of the drive model, firmware and workload"""
+        device = result["device"]
+        return "%s/%s/%s" % (device["model"], device["firmware"],
+                             workload_signature(result["args"]))
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump(self.data, f, indent=2)
+
+    def record(self, results):
+        """replace the baseline with the results of one workload"""
+        key = self.key(results[0])
+        self.data[key] = {"model": results[0]["device"]["model"],
+                          "firmware": results[0]["device"]["firmware"],
+                          "args": dict(results[0]["args"]),
+                          "runs": [_run_record(r) for r in results]}
+
+    def check(self, results):
+        """compare results of repeated runs of one workload against the baseline
+
+        # Attributes
+            results (list or IOWorkerResult): results returned by ioworker's close()
+
+        # Returns
+            (list): the comparison of each metric, see compare()
+
+        # Raises
+            Failed: pytest failure with the diff report, when any metric regresses
+        """
+
+        if not isinstance(results, (list, tuple)):
+            results = [results]
+        key = self.key(results[0])
+        assert all(self.key(r) == key for r in results), "results are not of the same workload"
+
+        if self.update or key not in self.data:
+            logging.info("record baseline %s" % key)
+            self.record(results)
+            return []
+
+        rows = compare(self.data[key]["runs"],
+                       [_run_record(r) for r in results],
+                       self.tolerance)
+        text = report(rows)
+        logging.info("baseline %s\n%s" % (key, text))
+        if any(r["regression"] for r in rows):
+            pytest.fail("performance regression of %s\n%s" % (key, text), pytrace=False)
+        return rows
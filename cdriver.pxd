@@ -43,6 +43,22 @@ cdef extern from "driver.h":
         pass
     ctypedef struct cpl:
         pass
+    ctypedef struct buffer_sgl:
+        pass
+    ctypedef struct qpair_reap_ring:
+        pass
+    ctypedef struct ioworker_sample:
+        unsigned int time_ms
+        unsigned int io_count_read
+        unsigned int io_count_write
+        unsigned long bytes
+    ctypedef struct ioworker_latency_interval:
+        unsigned int time_ms
+        unsigned int io_count
+        unsigned int p50_us
+        unsigned int p99_us
+        unsigned int p999_us
+        unsigned int max_us
     ctypedef struct ioworker_args:
         unsigned long lba_start
         unsigned short lba_size
@@ -55,23 +71,69 @@ cdef extern from "driver.h":
         unsigned long io_count
         unsigned int seconds
         unsigned int qdepth
+        unsigned int sgl_segment_size
         unsigned int* io_counter_per_second
         unsigned int* io_counter_per_latency
+        unsigned int sample_interval_ms
+        unsigned int sample_max
+        ioworker_sample* samples
+        unsigned int latency_interval_ms
+        unsigned int latency_interval_max
+        ioworker_latency_interval* latency_intervals
     ctypedef struct ioworker_rets:
         unsigned long io_count_read
         unsigned long io_count_write
         unsigned int mseconds
         unsigned int latency_max_us
+        unsigned int sample_count
+        unsigned int latency_interval_count
         unsigned short error
+    ctypedef struct buffer_pool_stats:
+        unsigned long alloc_count
+        unsigned long reuse_count
+        unsigned long bytes_in_use
+        unsigned long bytes_in_use_max
+        unsigned long bytes_cached
+    ctypedef struct nvme_reset_timing:
+        unsigned int disable_us
+        unsigned int admin_us
+        unsigned int io_us
+        unsigned int qpair_count
+    ctypedef struct qpair_reap_entry:
+        unsigned short cid
+        unsigned short status
+        unsigned int cdw0
+        unsigned int latency_us
+    ctypedef struct cmd_stage_stats:
+        unsigned long count
+        unsigned long sum_ns
+        unsigned int hist[32]
+    ctypedef struct nvme_transport_opts:
+        unsigned short trsvcid
+        char subnqn[224]
+        unsigned char hdgst
+        unsigned char ddgst
+        unsigned int io_queue_size
+
+    enum:
+        QPAIR_WAIT_POLL
+        QPAIR_WAIT_INTERRUPT
+        QPAIR_WAIT_HYBRID
+
+    enum:
+        CMD_STAGE_INTERVAL_COUNT
+        CMD_STAGE_HIST_COUNT
 
     ctypedef void(*cmd_cb_func)(void * cmd_cb_arg, const cpl * cpl)
     ctypedef void(*aer_cb_func)(void * are_cb_arg, const cpl * cpl)
     ctypedef void(*timeout_cb_func)(void * cb_arg, ctrlr * ctrlr,
                                     qpair * qpair, unsigned short cid)
 
-    int driver_init()
+    int driver_init(int shm_id, char* core_mask,
+                    unsigned int mem_size, char* pciaddr)
     int driver_fini()
     unsigned long driver_config(unsigned long cfg_word)
+    bint driver_verify_available()
 
     pcie * pcie_init(ctrlr * c)
     int pcie_cfg_read8(pcie * pci,
@@ -80,9 +142,24 @@ cdef extern from "driver.h":
     int pcie_cfg_write8(pcie * pci,
                         unsigned char value,
                         unsigned int offset)
+    int pcie_cfg_read16(pcie * pci,
+                        unsigned short * value,
+                        unsigned int offset)
+    int pcie_cfg_write16(pcie * pci,
+                         unsigned short value,
+                         unsigned int offset)
+    int pcie_cfg_read32(pcie * pci,
+                        unsigned int * value,
+                        unsigned int offset)
+    int pcie_cfg_write32(pcie * pci,
+                         unsigned int value,
+                         unsigned int offset)
+    unsigned int pcie_cfg_snapshot(pcie * pci,
+                                   void * buf,
+                                   unsigned int len)
 
-    ctrlr * nvme_init(char * traddr)
-    ctrlr * nvme_probe(char * traddr)
+    ctrlr * nvme_init(char * traddr, nvme_transport_opts* opts)
+    ctrlr * nvme_probe(char * traddr, nvme_transport_opts* opts)
     int nvme_fini(ctrlr * c)
     int nvme_set_reg32(ctrlr * c,
                        unsigned int offset,
@@ -90,9 +167,11 @@ cdef extern from "driver.h":
     int nvme_get_reg32(ctrlr * c,
                        unsigned int offset,
                        unsigned int * value)
+    const void * nvme_get_identify_data(ctrlr * c)
 
     void nvme_deallocate_ranges(ctrlr *c,
                                 void * buf, unsigned int count)
+    int nvme_reset_inplace(ctrlr * c, nvme_reset_timing * timing)
     int nvme_wait_completion_admin(ctrlr * c)
     void nvme_cmd_cb_print_cpl(void * qpair, const cpl * cpl)
     int nvme_send_cmd_raw(ctrlr * c,
@@ -119,12 +198,37 @@ cdef extern from "driver.h":
 
     void * buffer_init(size_t bytes, unsigned long* phys_addr)
     void buffer_fini(void * buf)
+    void * buffer_pool_get(size_t bytes, unsigned long* phys_addr, bint zero)
+    void buffer_pool_put(void * buf, size_t bytes)
+    void buffer_pool_get_stats(buffer_pool_stats * stats)
+    void buffer_pool_release()
+
+    buffer_sgl * buffer_sgl_init(size_t bytes, unsigned int seg_size)
+    void buffer_sgl_fini(buffer_sgl * sgl)
+    void * buffer_sgl_addr(buffer_sgl * sgl, size_t offset, size_t * len)
 
     qpair * qpair_create(ctrlr * c, int prio, int depth)
     int qpair_wait_completion(qpair * q, unsigned int max_completions)
+    int qpair_wait_completion_until(qpair * q,
+                                    unsigned int expected,
+                                    unsigned int timeout_ms,
+                                    unsigned int wait_mode)
     int qpair_get_id(qpair * q)
     int qpair_free(qpair * q)
 
+    qpair_reap_ring * qpair_reap_init(qpair * q, unsigned int depth)
+    void qpair_reap_fini(qpair_reap_ring * ring)
+    void qpair_reap_cb(void * cb_arg, const cpl * cpl)
+    unsigned int qpair_reap(qpair_reap_ring * ring,
+                            qpair * q,
+                            unsigned int max_count,
+                            qpair_reap_entry * entries)
+    unsigned long qpair_reap_dropped(qpair_reap_ring * ring)
+
+    void cmdlog_stage_entry(qpair * q)
+    void cmdlog_stage_cb(const cpl * cpl)
+    void cmdlog_stage_stats(unsigned short qid, cmd_stage_stats * stats, bint clear)
+
     namespace * ns_init(ctrlr * c, unsigned int nsid)
     int ns_refresh(namespace * ns, unsigned int nsid, ctrlr * c)
     int ns_cmd_read_write(bint is_read,
@@ -137,6 +241,44 @@ cdef extern from "driver.h":
                           unsigned int io_flags,
                           cmd_cb_func cb_fn,
                           void * cb_arg)
+    int ns_cmd_io_sgl(unsigned int opcode,
+                      namespace * ns,
+                      qpair * qpair,
+                      buffer_sgl * sgl,
+                      unsigned long lba,
+                      unsigned int lba_count,
+                      unsigned int io_flags,
+                      cmd_cb_func cb_fn,
+                      void * cb_arg)
+    int ns_cmd_read_write_many(bint is_read,
+                               namespace * ns,
+                               qpair * qpair,
+                               void * buf,
+                               size_t len,
+                               unsigned int count,
+                               const unsigned long * lbas,
+                               const unsigned short * lba_counts,
+                               const unsigned long * buf_offsets,
+                               unsigned int io_flags,
+                               unsigned int qdepth,
+                               unsigned int timeout_sec,
+                               unsigned short * status,
+                               unsigned int * latency_us)
+    int ns_cmd_file(bint is_load,
+                    namespace * ns,
+                    qpair * qpair,
+                    const char * path,
+                    unsigned long lba,
+                    unsigned long lba_count,
+                    unsigned int io_size,
+                    unsigned int qdepth,
+                    unsigned int timeout_sec)
+    int ns_cmd_deallocate(namespace * ns,
+                          qpair * qpair,
+                          const unsigned long * ranges,
+                          unsigned int count,
+                          unsigned int qdepth,
+                          unsigned int timeout_sec)
     unsigned int ns_get_sector_size(namespace * ns)
     unsigned long ns_get_num_sectors(namespace * ns)
     int ns_fini(namespace * ns)
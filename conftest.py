@@ -5,12 +5,22 @@ import logging
 import inspect
 
 import nvme as d
+from baseline import Baseline
 
 
 def pytest_addoption(parser):
     parser.addoption(
         "--pciaddr", action="store", default="", help="pci (BDF) address of the device under test, e.g.: 02:00.0"
     )
+    parser.addoption(
+        "--baseline", action="store", default="baseline.json", help="performance baseline file of ioworker results"
+    )
+    parser.addoption(
+        "--baseline-update", action="store_true", help="record ioworker results as the new baseline"
+    )
+    parser.addoption(
+        "--benchmark-json", action="store", default="", help="result file of benchmark, default: a new file in folder benchmark for each run"
+    )
 
 
 @pytest.fixture(scope="session")
@@ -20,6 +30,14 @@ def pciaddr(request):
     return ret
 
 
+@pytest.fixture(scope="session")
+def baseline(request):
+    ret = Baseline(request.config.getoption("--baseline"),
+                   request.config.getoption("--baseline-update"))
+    yield ret
+    ret.save()
+
+
 @pytest.fixture(scope="function", autouse=True)
 def script(request):
     # skip empty tests
@@ -62,6 +80,23 @@ def nvme0n1(nvme0):
     del ret
 
 
+@pytest.fixture(scope="session")
+def tcp_target():
+    ret = d.TcpTarget()
+    if not ret.available:
+        pytest.skip("nvmf_tgt is not available")
+    ret.start()
+    yield ret
+    ret.stop()
+
+
+@pytest.fixture(scope="session")
+def tcp_nvme0(tcp_target):
+    ret = d.Controller(b'127.0.0.1', tcp_target.port)
+    yield ret
+    del ret
+
+
 @pytest.fixture(scope="function")
 def aer(nvme0):
     def register_cb(func):
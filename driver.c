@@ -39,12 +39,18 @@
 #include <string.h>
 #include <pthread.h>
 #include <sys/time.h>
+#include <sys/mman.h>
+#include <fcntl.h>
+#include <errno.h>
 #include <sys/sysinfo.h>
+#include <sys/epoll.h>
+#include <sys/socket.h>
+#include <sys/un.h>
 
 #include "spdk/stdinc.h"
 #include "spdk/env.h"
 #include "spdk/crc32.h"
-#include "spdk/rpc.h"
+#include "spdk/jsonrpc.h"
 #include "spdk_internal/log.h"
 #include "spdk/lib/nvme/nvme_internal.h"
 #include "driver.h"
@@ -52,6 +58,7 @@
 
 #define US_PER_S              (1000ULL*1000ULL)
 #define MIN(X,Y)              ((X) < (Y) ? (X) : (Y))
+#define MAX(X,Y)              ((X) > (Y) ? (X) : (Y))
 
 #ifndef BIT
 #define BIT(a)                (1UL << (a))
@@ -59,6 +66,20 @@
 
 // the global configuration of the driver
 #define DCFG_VERIFY_READ      (BIT(0))
+#define DCFG_STAGE_TRACE      (BIT(3))
+
+// USDT probes for perf/bpftrace, e.g.: bpftrace -e 'usdt:./nvme.*.so:pynvme:cmd_complete {...}'
+// they are nop instructions when not attached
+#if defined(__has_include)
+#if __has_include(<sys/sdt.h>)
+#include <sys/sdt.h>
+#endif
+#endif
+#ifndef DTRACE_PROBE2
+#define DTRACE_PROBE2(provider, name, a1, a2)
+#define DTRACE_PROBE3(provider, name, a1, a2, a3)
+#define DTRACE_PROBE4(provider, name, a1, a2, a3, a4)
+#endif
 
 
 //// shared data
@@ -66,16 +87,54 @@
 
 #define DRIVER_IO_TOKEN_NAME      "driver_io_token"
 #define DRIVER_CRC32_TABLE_NAME   "driver_crc32_table"
+#define DRIVER_CRC32_GEN_NAME     "driver_crc32_generation"
 #define DRIVER_GLOBAL_CONFIG_NAME "driver_global_config"
 
-// TODO: support multiple namespace
 static uint64_t g_driver_table_size = 0;
 static uint64_t* g_driver_io_token_ptr = NULL;
 static uint32_t* g_driver_csum_table_ptr = NULL;
 static uint64_t* g_driver_global_config_ptr = NULL;
 
+// checksum table is divided into chunks, and each chunk is tagged with the
+// generation when it is cleared. Stale chunks are cleared lazily when they
+// are accessed, so the whole table is invalidated by increasing the epoch.
+#define CRC32_CHUNK_LBA_COUNT     (4096ULL)
+#define CRC32_GEN_BUSY            (BIT(31))
+struct crc32_gen_table_t {
+  uint32_t epoch;
+  uint32_t dummy;
+  uint32_t disabled;  // more than one namespace is opened
+  uint32_t chunk[];
+};
+static struct crc32_gen_table_t* g_driver_crc32_gen_ptr = NULL;
+
+// namespaces opened in the primary process. The checksum table is kept for
+// the first one only, and it is disabled when other namespaces are opened.
+static uint32_t g_driver_ns_count = 0;
+static struct spdk_nvme_ns* g_driver_csum_ns = NULL;
+
+static inline uint64_t crc32_chunk_count(uint64_t table_size)
+{
+  uint64_t lba_count = table_size/sizeof(uint32_t);
+
+  return (lba_count+CRC32_CHUNK_LBA_COUNT-1)/CRC32_CHUNK_LBA_COUNT;
+}
+
 static int memzone_reserve_shared_memory(uint64_t table_size)
 {
+  if (spdk_process_is_primary() && g_driver_ns_count != 0)
+  {
+    // LBAs of different namespaces cannot share one checksum table
+    assert(g_driver_io_token_ptr != NULL);
+    if (g_driver_crc32_gen_ptr != NULL)
+    {
+      g_driver_crc32_gen_ptr->disabled = true;
+    }
+    g_driver_csum_table_ptr = NULL;
+    SPDK_NOTICELOG("Data verification is disabled with multiple namespaces!\n");
+    return 0;
+  }
+
   if (spdk_process_is_primary())
   {
     assert(g_driver_io_token_ptr == NULL);
@@ -90,6 +149,10 @@ static int memzone_reserve_shared_memory(uint64_t table_size)
     g_driver_io_token_ptr = spdk_memzone_reserve(DRIVER_IO_TOKEN_NAME,
                                                  sizeof(uint64_t),
                                                  0, 0);
+    g_driver_crc32_gen_ptr = spdk_memzone_reserve(DRIVER_CRC32_GEN_NAME,
+                                                  sizeof(struct crc32_gen_table_t) + \
+                                                  sizeof(uint32_t)*crc32_chunk_count(table_size),
+                                                  0, 0);
   }
   else
   {
@@ -97,6 +160,13 @@ static int memzone_reserve_shared_memory(uint64_t table_size)
     g_driver_table_size = table_size;
     g_driver_io_token_ptr = spdk_memzone_lookup(DRIVER_IO_TOKEN_NAME);
     g_driver_csum_table_ptr = spdk_memzone_lookup(DRIVER_CRC32_TABLE_NAME);
+    g_driver_crc32_gen_ptr = spdk_memzone_lookup(DRIVER_CRC32_GEN_NAME);
+  }
+
+  if (g_driver_crc32_gen_ptr == NULL || g_driver_crc32_gen_ptr->disabled)
+  {
+    // checksum table cannot be used without generation table
+    g_driver_csum_table_ptr = NULL;
   }
 
   if (g_driver_csum_table_ptr == NULL)
@@ -120,36 +190,124 @@ static int memzone_reserve_shared_memory(uint64_t table_size)
   return 0;
 }
 
+// clear the chunk if it is stale, shared by multiple processes
+static void crc32_chunk_refresh(uint64_t chunk, uint32_t epoch)
+{
+  uint32_t* gen_ptr = &g_driver_crc32_gen_ptr->chunk[chunk];
+  uint32_t gen = __atomic_load_n(gen_ptr, __ATOMIC_ACQUIRE);
+
+  while (gen != epoch)
+  {
+    if ((gen & CRC32_GEN_BUSY) == 0 &&
+        __atomic_compare_exchange_n(gen_ptr, &gen, epoch|CRC32_GEN_BUSY, false,
+                                    __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE))
+    {
+      // this process clears the chunk, others wait
+      uint64_t lba_count = g_driver_table_size/sizeof(uint32_t);
+      uint64_t lba = chunk*CRC32_CHUNK_LBA_COUNT;
+      uint64_t count = MIN(CRC32_CHUNK_LBA_COUNT, lba_count-lba);
+
+      memset(&g_driver_csum_table_ptr[lba], 0, count*sizeof(uint32_t));
+      __atomic_store_n(gen_ptr, epoch, __ATOMIC_RELEASE);
+      return;
+    }
+
+    spdk_pause();
+    gen = __atomic_load_n(gen_ptr, __ATOMIC_ACQUIRE);
+  }
+}
+
+// get the checksum entry of the lba, after its chunk is refreshed
+static inline uint32_t* crc32_entry(uint64_t lba)
+{
+  uint64_t chunk = lba/CRC32_CHUNK_LBA_COUNT;
+  uint32_t epoch = __atomic_load_n(&g_driver_crc32_gen_ptr->epoch, __ATOMIC_ACQUIRE);
+
+  if (__atomic_load_n(&g_driver_crc32_gen_ptr->chunk[chunk], __ATOMIC_ACQUIRE) != epoch)
+  {
+    crc32_chunk_refresh(chunk, epoch);
+  }
+
+  return &g_driver_csum_table_ptr[lba];
+}
+
 void crc32_clear(uint64_t lba, uint64_t lba_count, int sanitize, int uncorr)
 {
   int c = uncorr ? 0xff : 0;
-  size_t len = lba_count*sizeof(uint32_t);
 
   if (sanitize == true)
   {
     assert(lba == 0);
     assert(g_driver_table_size != 0); //Namspace instance not exist, you may need to add nvme0n1 in the fixture list
     SPDK_DEBUGLOG(SPDK_LOG_NVME, "clear the whole table\n");
-    len = g_driver_table_size;
+    lba_count = g_driver_table_size/sizeof(uint32_t);
+  }
+
+  if (g_driver_csum_table_ptr == NULL)
+  {
+    return;
+  }
+
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "clear checksum table, lba 0x%lx, c %d, count %ld\n",
+                lba, c, lba_count);
+  if (sanitize == true)
+  {
+    // invalidate all chunks by the new epoch
+    uint32_t epoch = __atomic_load_n(&g_driver_crc32_gen_ptr->epoch, __ATOMIC_ACQUIRE);
+    __atomic_store_n(&g_driver_crc32_gen_ptr->epoch,
+                     (epoch+1)&(~CRC32_GEN_BUSY),
+                     __ATOMIC_RELEASE);
+    if (c == 0)
+    {
+      return;
+    }
   }
 
-  if (g_driver_csum_table_ptr != NULL)
+  // clear the range chunk by chunk
+  while (lba_count != 0)
   {
-    SPDK_DEBUGLOG(SPDK_LOG_NVME, "clear checksum table, lba 0x%lx, c %d, len %ld\n",
-                  lba, c, len);
-    memset(&g_driver_csum_table_ptr[lba], c, len);
+    uint64_t count = MIN(lba_count,
+                         CRC32_CHUNK_LBA_COUNT-lba%CRC32_CHUNK_LBA_COUNT);
+
+    memset(crc32_entry(lba), c, count*sizeof(uint32_t));
+    lba += count;
+    lba_count -= count;
   }
 }
 
-static void crc32_fini(void)
+static void crc32_fini(struct spdk_nvme_ns* ns)
 {
   if (spdk_process_is_primary())
   {
+    assert(g_driver_ns_count > 0);
+    if (--g_driver_ns_count != 0)
+    {
+      if (ns == g_driver_csum_ns)
+      {
+        // other namespaces are still opened, keep the table disabled
+        g_driver_csum_ns = NULL;
+      }
+      else if (g_driver_ns_count == 1 && g_driver_csum_ns != NULL &&
+               g_driver_crc32_gen_ptr != NULL)
+      {
+        // only the owner of the table is left. Checksums are not updated
+        // when the table is disabled, so invalidate all of them.
+        g_driver_csum_table_ptr = spdk_memzone_lookup(DRIVER_CRC32_TABLE_NAME);
+        g_driver_crc32_gen_ptr->disabled = false;
+        crc32_clear(0, 0, true, false);
+        SPDK_NOTICELOG("Data verification is enabled again!\n");
+      }
+      return;
+    }
+
+    g_driver_csum_ns = NULL;
     spdk_memzone_free(DRIVER_IO_TOKEN_NAME);
     spdk_memzone_free(DRIVER_CRC32_TABLE_NAME);
+    spdk_memzone_free(DRIVER_CRC32_GEN_NAME);
   }
   g_driver_io_token_ptr = NULL;
   g_driver_csum_table_ptr = NULL;
+  g_driver_crc32_gen_ptr = NULL;
 }
 
 
@@ -206,7 +364,7 @@ static void buffer_fill_data(void* buf,
     if (g_driver_csum_table_ptr != NULL)
     {
       uint32_t crc = buffer_calc_csum(ptr, lba_size);
-      g_driver_csum_table_ptr[lba] = crc;
+      *crc32_entry(lba) = crc;
     }
   }
 }
@@ -228,7 +386,7 @@ static int buffer_verify_data(const void* buf,
     //expected crc, to bypass verification
     if (g_driver_csum_table_ptr != NULL)
     {
-      expected_crc = g_driver_csum_table_ptr[lba];
+      expected_crc = *crc32_entry(lba);
     }
 
     if (expected_crc == 0)
@@ -268,6 +426,236 @@ void buffer_fini(void* buf)
 }
 
 
+////module: buffer pool
+///////////////////////////////
+
+// cache released buffers in power-of-two size classes, from 4KB to 2MB.
+// Buffers larger than the biggest class are not cached.
+#define BUFFER_POOL_CLASS_MIN_SHIFT   (12)
+#define BUFFER_POOL_CLASS_MAX_SHIFT   (21)
+#define BUFFER_POOL_CLASS_COUNT       (BUFFER_POOL_CLASS_MAX_SHIFT-BUFFER_POOL_CLASS_MIN_SHIFT+1)
+#define BUFFER_POOL_CLASS_DEPTH       (32)
+#define BUFFER_POOL_CACHE_MAX_BYTES   (64ULL*1024*1024)
+
+struct buffer_pool_class_t {
+  void* buf[BUFFER_POOL_CLASS_DEPTH];
+  uint64_t phys_addr[BUFFER_POOL_CLASS_DEPTH];
+  uint32_t count;
+};
+
+// pool is private to each process, no lock required
+static struct buffer_pool_class_t buffer_pool_table[BUFFER_POOL_CLASS_COUNT];
+static buffer_pool_stats buffer_pool_statistics;
+
+static int buffer_pool_class(size_t bytes)
+{
+  int shift = BUFFER_POOL_CLASS_MIN_SHIFT;
+
+  while ((1ULL<<shift) < bytes)
+  {
+    shift ++;
+  }
+
+  if (shift > BUFFER_POOL_CLASS_MAX_SHIFT)
+  {
+    // too large to be pooled
+    return -1;
+  }
+
+  return shift-BUFFER_POOL_CLASS_MIN_SHIFT;
+}
+
+static inline size_t buffer_pool_class_size(int index)
+{
+  return 1ULL<<(index+BUFFER_POOL_CLASS_MIN_SHIFT);
+}
+
+void* buffer_pool_get(size_t bytes, uint64_t* phys_addr, int zero)
+{
+  void* buf = NULL;
+  int index = buffer_pool_class(bytes);
+  size_t size = bytes;
+
+  if (index >= 0)
+  {
+    struct buffer_pool_class_t* c = &buffer_pool_table[index];
+
+    size = buffer_pool_class_size(index);
+    if (c->count != 0)
+    {
+      // reuse the most recently released buffer, it is still hot in cache
+      c->count --;
+      buf = c->buf[c->count];
+      if (phys_addr != NULL)
+      {
+        *phys_addr = c->phys_addr[c->count];
+      }
+
+      buffer_pool_statistics.reuse_count ++;
+      buffer_pool_statistics.bytes_cached -= size;
+      if (zero)
+      {
+        memset(buf, 0, bytes);
+      }
+    }
+  }
+
+  if (buf == NULL)
+  {
+    // miss in the pool, allocate with the size of the class
+    buf = buffer_init(size, phys_addr);
+    if (buf == NULL)
+    {
+      return NULL;
+    }
+  }
+
+  buffer_pool_statistics.alloc_count ++;
+  buffer_pool_statistics.bytes_in_use += size;
+  if (buffer_pool_statistics.bytes_in_use > buffer_pool_statistics.bytes_in_use_max)
+  {
+    buffer_pool_statistics.bytes_in_use_max = buffer_pool_statistics.bytes_in_use;
+  }
+
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "buffer pool: get ptr %p, size %ld, class %d\n",
+                buf, bytes, index);
+  return buf;
+}
+
+void buffer_pool_put(void* buf, size_t bytes)
+{
+  int index = buffer_pool_class(bytes);
+  size_t size = bytes;
+
+  assert(buf != NULL);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "buffer pool: put ptr %p, size %ld, class %d\n",
+                buf, bytes, index);
+
+  if (index >= 0)
+  {
+    struct buffer_pool_class_t* c = &buffer_pool_table[index];
+
+    size = buffer_pool_class_size(index);
+    assert(buffer_pool_statistics.bytes_in_use >= size);
+    buffer_pool_statistics.bytes_in_use -= size;
+
+    if (c->count < BUFFER_POOL_CLASS_DEPTH &&
+        buffer_pool_statistics.bytes_cached+size <= BUFFER_POOL_CACHE_MAX_BYTES)
+    {
+      // keep the buffer for later use
+      c->buf[c->count] = buf;
+      c->phys_addr[c->count] = spdk_vtophys(buf, NULL);
+      c->count ++;
+      buffer_pool_statistics.bytes_cached += size;
+      return;
+    }
+  }
+  else
+  {
+    assert(buffer_pool_statistics.bytes_in_use >= size);
+    buffer_pool_statistics.bytes_in_use -= size;
+  }
+
+  buffer_fini(buf);
+}
+
+void buffer_pool_get_stats(buffer_pool_stats* stats)
+{
+  assert(stats != NULL);
+  memcpy(stats, &buffer_pool_statistics, sizeof(buffer_pool_stats));
+}
+
+void buffer_pool_release(void)
+{
+  // free all cached buffers back to hugepage memory
+  for (int i=0; i<BUFFER_POOL_CLASS_COUNT; i++)
+  {
+    struct buffer_pool_class_t* c = &buffer_pool_table[i];
+
+    while (c->count != 0)
+    {
+      c->count --;
+      buffer_fini(c->buf[c->count]);
+    }
+  }
+
+  buffer_pool_statistics.bytes_cached = 0;
+}
+
+
+////module: sgl buffer
+///////////////////////////////
+
+// a large data buffer made of fixed-size segments, which are not required
+// to be physically contiguous to each other
+struct buffer_sgl_t {
+  size_t size;
+  uint32_t seg_size;
+  uint32_t seg_count;
+  void* seg[];
+};
+
+struct buffer_sgl_t* buffer_sgl_init(size_t bytes, uint32_t seg_size)
+{
+  uint32_t seg_count = (bytes+seg_size-1)/seg_size;
+  struct buffer_sgl_t* sgl;
+
+  // segments are page aligned, so it can be described by PRP list too
+  assert(seg_size >= 0x1000);
+  assert((seg_size & (seg_size-1)) == 0);
+
+  sgl = malloc(sizeof(struct buffer_sgl_t)+sizeof(void*)*seg_count);
+  if (sgl == NULL)
+  {
+    return NULL;
+  }
+
+  sgl->size = bytes;
+  sgl->seg_size = seg_size;
+  sgl->seg_count = seg_count;
+  for (uint32_t i=0; i<seg_count; i++)
+  {
+    sgl->seg[i] = buffer_pool_get(seg_size, NULL, true);
+    if (sgl->seg[i] == NULL)
+    {
+      SPDK_ERRLOG("fail to allocate sgl segment %d\n", i);
+      sgl->seg_count = i;
+      buffer_sgl_fini(sgl);
+      return NULL;
+    }
+  }
+
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "sgl buffer: alloc %p, size %ld, %d segments\n",
+                sgl, bytes, seg_count);
+  return sgl;
+}
+
+void buffer_sgl_fini(struct buffer_sgl_t* sgl)
+{
+  assert(sgl != NULL);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "sgl buffer: free %p\n", sgl);
+
+  for (uint32_t i=0; i<sgl->seg_count; i++)
+  {
+    buffer_pool_put(sgl->seg[i], sgl->seg_size);
+  }
+  free(sgl);
+}
+
+void* buffer_sgl_addr(struct buffer_sgl_t* sgl, size_t offset, size_t* len)
+{
+  assert(offset < sgl->size);
+
+  // the continuous bytes from the offset to the end of its segment
+  if (len != NULL)
+  {
+    *len = MIN(sgl->seg_size - offset%sgl->seg_size, sgl->size - offset);
+  }
+
+  return sgl->seg[offset/sgl->seg_size] + offset%sgl->seg_size;
+}
+
+
 ////cmd log
 ///////////////////////////////
 
@@ -301,13 +689,143 @@ struct cmd_log_table_t {
   uint32_t msix_enabled;
   uint32_t mask_offset;
   struct spdk_nvme_qpair* qpair;
-  uint32_t dummy[26];
+  uint32_t latency_us_last;
+  uint32_t ioworker_seconds;
+
+  // live metrics of the qpair
+  uint64_t cpl_count;
+  uint64_t error_count;
+  uint64_t ioworker_cpl_base;
+  uint64_t ioworker_io_target;
+  uint64_t ioworker_start_us;
+
+  // commands logged since the qpair is created, entries of the previous
+  // qpair of the same qid are still in the table but not counted
+  uint64_t cmd_count;
+  uint32_t dummy[12];
 };
 static_assert(sizeof(struct cmd_log_table_t) == sizeof(struct cmd_log_entry_t)*(CMD_LOG_DEPTH+1), "cacheline aligned");
 
 #define DRIVER_CMDLOG_TABLE_NAME  "driver_cmdlog_table"
 static struct cmd_log_table_t* cmd_log_queue_table;
 
+// timestamps of each stage of the commands, in the same index of cmdlog
+// entries. They are recorded only when DCFG_STAGE_TRACE is enabled.
+enum cmd_stage_t {
+  CMD_STAGE_ENTRY,      // python method entry
+  CMD_STAGE_BUILD,      // driver builds sqe and fills data
+  CMD_STAGE_SUBMIT,     // sqe is submitted to spdk qpair
+  CMD_STAGE_DOORBELL,   // spdk rings the doorbell
+  CMD_STAGE_CQE,        // cqe is reaped by spdk
+  CMD_STAGE_COUNT
+};
+
+struct cmd_stage_table_t {
+  uint64_t tsc[CMD_LOG_DEPTH][CMD_STAGE_COUNT];
+  uint64_t entry_tsc;
+  uint64_t build_tsc;
+  uint64_t cmdlog_tsc;
+  cmd_stage_stats stats[CMD_STAGE_INTERVAL_COUNT];
+};
+
+#define DRIVER_CMDLOG_STAGE_NAME  "driver_cmdlog_stage"
+static struct cmd_stage_table_t* cmd_stage_queue_table;
+static uint64_t cmd_stage_ticks_hz;
+
+static inline bool cmd_stage_enabled(void)
+{
+  return (*g_driver_global_config_ptr & DCFG_STAGE_TRACE) != 0;
+}
+
+static void cmd_stage_update(cmd_stage_stats* stats, uint64_t start, uint64_t end)
+{
+  uint64_t ns;
+  uint32_t bucket;
+
+  // stage is not traced, e.g. ioworker skips python
+  if (start == 0 || end < start)
+  {
+    return;
+  }
+
+  ns = (end-start)*1000000000ULL/cmd_stage_ticks_hz;
+  bucket = (ns == 0) ? 0 : MIN(63-__builtin_clzll(ns), CMD_STAGE_HIST_COUNT-1);
+  stats->count++;
+  stats->sum_ns += ns;
+  stats->hist[bucket]++;
+}
+
+// record the stage timestamp of python entry in the qpair
+void cmdlog_stage_entry(struct spdk_nvme_qpair* qpair)
+{
+  uint16_t qid = qpair ? qpair->id : 0;
+
+  if (cmd_stage_enabled())
+  {
+    cmd_stage_queue_table[qid].entry_tsc = spdk_get_ticks();
+  }
+}
+
+static inline void cmdlog_stage_build(struct spdk_nvme_qpair* qpair)
+{
+  if (cmd_stage_enabled())
+  {
+    cmd_stage_queue_table[qpair->id].build_tsc = spdk_get_ticks();
+  }
+}
+
+static inline void cmdlog_stage_doorbell(struct spdk_nvme_qpair* qpair)
+{
+  uint16_t qid = qpair->id;
+  uint32_t index = cmd_log_queue_table[qid].tail_index;
+
+  // the latest command in the cmdlog
+  index = (index == 0) ? CMD_LOG_DEPTH-1 : index-1;
+  DTRACE_PROBE2(pynvme, cmd_doorbell, qid, index);
+  if (cmd_stage_enabled())
+  {
+    cmd_stage_queue_table[qid].tsc[index][CMD_STAGE_DOORBELL] = spdk_get_ticks();
+  }
+}
+
+// called in user callback of the command, for the interval after cmdlog
+void cmdlog_stage_cb(const struct spdk_nvme_cpl* cpl)
+{
+  struct cmd_stage_table_t* stage = &cmd_stage_queue_table[cpl->sqid];
+
+  DTRACE_PROBE2(pynvme, cmd_callback, cpl->sqid, cpl->cid);
+  if (cmd_stage_enabled() && cpl->sqid < CMD_LOG_QPAIR_COUNT)
+  {
+    cmd_stage_update(&stage->stats[CMD_STAGE_INTERVAL_CALLBACK],
+                     stage->cmdlog_tsc, spdk_get_ticks());
+    stage->cmdlog_tsc = 0;
+  }
+}
+
+void cmdlog_stage_stats(uint16_t qid, cmd_stage_stats* stats, bool clear)
+{
+  assert(qid < CMD_LOG_QPAIR_COUNT);
+
+  memcpy(stats, cmd_stage_queue_table[qid].stats,
+         sizeof(cmd_stage_stats)*CMD_STAGE_INTERVAL_COUNT);
+  if (clear)
+  {
+    memset(cmd_stage_queue_table[qid].stats, 0,
+           sizeof(cmd_stage_stats)*CMD_STAGE_INTERVAL_COUNT);
+  }
+}
+
+
+static inline void timeradd_second(struct timeval* now,
+                                     unsigned int seconds,
+                                     struct timeval* due)
+{
+  struct timeval duration;
+
+  duration.tv_sec = seconds;
+  duration.tv_usec = 0;
+  timeradd(now, &duration, due);
+}
 
 static uint32_t timeval_to_us(struct timeval* t)
 {
@@ -328,6 +846,18 @@ static void cmd_log_qpair_init(struct spdk_nvme_qpair* q)
   // set tail to invalid value, means the qpair is empty
   cmd_log_queue_table[qid].tail_index = 0;
   cmd_log_queue_table[qid].qpair = q;
+  cmd_log_queue_table[qid].cpl_count = 0;
+  cmd_log_queue_table[qid].error_count = 0;
+  cmd_log_queue_table[qid].ioworker_start_us = 0;
+  cmd_log_queue_table[qid].cmd_count = 0;
+  memset(&cmd_stage_queue_table[qid], 0, sizeof(struct cmd_stage_table_t));
+}
+
+
+// number of the latest entries logged by the current qpair
+static inline uint32_t cmd_log_valid_count(struct cmd_log_table_t* log_table)
+{
+  return MIN(log_table->cmd_count, CMD_LOG_DEPTH);
 }
 
 
@@ -348,6 +878,10 @@ static int cmd_log_init(void)
                                                sizeof(struct cmd_log_table_t)*CMD_LOG_QPAIR_COUNT,
                                                0, SPDK_MEMZONE_NO_IOVA_CONTIG);
 
+    cmd_stage_queue_table = spdk_memzone_reserve(DRIVER_CMDLOG_STAGE_NAME,
+                                                 sizeof(struct cmd_stage_table_t)*CMD_LOG_QPAIR_COUNT,
+                                                 0, SPDK_MEMZONE_NO_IOVA_CONTIG);
+
     // clear all qpair's cmd log
     for (int i=0; i<CMD_LOG_QPAIR_COUNT; i++)
     {
@@ -363,10 +897,12 @@ static int cmd_log_init(void)
   else
   {
     cmd_log_queue_table = spdk_memzone_lookup(DRIVER_CMDLOG_TABLE_NAME);
+    cmd_stage_queue_table = spdk_memzone_lookup(DRIVER_CMDLOG_STAGE_NAME);
     g_driver_global_config_ptr = spdk_memzone_lookup(DRIVER_GLOBAL_CONFIG_NAME);
   }
 
-  if (cmd_log_queue_table == NULL)
+  cmd_stage_ticks_hz = spdk_get_ticks_hz();
+  if (cmd_log_queue_table == NULL || cmd_stage_queue_table == NULL)
   {
     fprintf(stderr, "Cannot allocate or find the cmdlog memory!\n");
     return -1;
@@ -379,6 +915,7 @@ static int cmd_log_init(void)
 static void cmd_log_finish(void)
 {
   spdk_memzone_free(DRIVER_CMDLOG_TABLE_NAME);
+  spdk_memzone_free(DRIVER_CMDLOG_STAGE_NAME);
   spdk_memzone_free(DRIVER_GLOBAL_CONFIG_NAME);
 }
 
@@ -388,6 +925,7 @@ void cmdlog_cmd_cpl(void* cb_ctx, struct spdk_nvme_cpl* cpl)
   struct timeval diff;
   struct timeval now;
   struct cmd_log_entry_t* log_entry = (struct cmd_log_entry_t*)cb_ctx;
+  uint64_t cqe_tsc = cmd_stage_enabled() ? spdk_get_ticks() : 0;
 
   assert(cpl != NULL);
   assert(log_entry != NULL);
@@ -408,6 +946,7 @@ void cmdlog_cmd_cpl(void* cb_ctx, struct spdk_nvme_cpl* cpl)
   memcpy(&log_entry->cpl, cpl, sizeof(struct spdk_nvme_cpl));
   timersub(&now, &log_entry->time_cmd, &diff);
   log_entry->cpl_latency_us = timeval_to_us(&diff);
+  cmd_log_queue_table[log_entry->req->qpair->id].latency_us_last = log_entry->cpl_latency_us;
 
   //verify read data
   if (log_entry->cmd.opc == 2 && log_entry->buf != NULL)
@@ -438,6 +977,37 @@ void cmdlog_cmd_cpl(void* cb_ctx, struct spdk_nvme_cpl* cpl)
     }
   }
 
+  cmd_log_queue_table[log_entry->req->qpair->id].cpl_count++;
+  if (spdk_nvme_cpl_is_error(cpl))
+  {
+    cmd_log_queue_table[log_entry->req->qpair->id].error_count++;
+  }
+
+  DTRACE_PROBE4(pynvme, cmd_complete, log_entry->req->qpair->id, cpl->cid,
+                ((uint16_t*)&cpl->status)[0], log_entry->cpl_latency_us);
+
+  //stage intervals of the command
+  if (cqe_tsc != 0)
+  {
+    uint16_t qid = log_entry->req->qpair->id;
+    uint32_t index = log_entry - cmd_log_queue_table[qid].table;
+    struct cmd_stage_table_t* stage = &cmd_stage_queue_table[qid];
+    uint64_t* tsc = stage->tsc[index];
+
+    tsc[CMD_STAGE_CQE] = cqe_tsc;
+    cmd_stage_update(&stage->stats[CMD_STAGE_INTERVAL_PYTHON],
+                     tsc[CMD_STAGE_ENTRY], tsc[CMD_STAGE_BUILD]);
+    cmd_stage_update(&stage->stats[CMD_STAGE_INTERVAL_BUILD],
+                     tsc[CMD_STAGE_BUILD], tsc[CMD_STAGE_SUBMIT]);
+    cmd_stage_update(&stage->stats[CMD_STAGE_INTERVAL_SUBMIT],
+                     tsc[CMD_STAGE_SUBMIT], tsc[CMD_STAGE_DOORBELL]);
+    cmd_stage_update(&stage->stats[CMD_STAGE_INTERVAL_DEVICE],
+                     tsc[CMD_STAGE_DOORBELL], tsc[CMD_STAGE_CQE]);
+    stage->cmdlog_tsc = spdk_get_ticks();
+    cmd_stage_update(&stage->stats[CMD_STAGE_INTERVAL_CMDLOG],
+                     tsc[CMD_STAGE_CQE], stage->cmdlog_tsc);
+  }
+
   //recover callback argument
   SPDK_DEBUGLOG(SPDK_LOG_NVME, "recover req %p cb arg, entry %p, old %p, new %p\n",
                 log_entry->req, log_entry, log_entry->req->cb_arg, log_entry->cb_arg);
@@ -471,7 +1041,15 @@ void cmdlog_add_cmd(struct spdk_nvme_qpair* qpair, struct nvme_request* req)
     log_entry->req->cb_arg = log_entry->cb_arg;
   }
 
-  log_entry->buf = req->payload.contig_or_cb_arg;
+  // sgl payload is verified in its own callback
+  if (nvme_payload_type(&req->payload) == NVME_PAYLOAD_TYPE_CONTIG)
+  {
+    log_entry->buf = req->payload.contig_or_cb_arg;
+  }
+  else
+  {
+    log_entry->buf = NULL;
+  }
   log_entry->cpl_latency_us = 0;
   memcpy(&log_entry->cmd, &req->cmd, sizeof(struct spdk_nvme_cmd));
   gettimeofday(&log_entry->time_cmd, NULL);
@@ -483,6 +1061,21 @@ void cmdlog_add_cmd(struct spdk_nvme_qpair* qpair, struct nvme_request* req)
   log_entry->cb_arg = req->cb_arg;
   req->cb_arg = log_entry;
 
+  DTRACE_PROBE3(pynvme, cmd_submit, qid, tail_index, req->cmd.opc);
+  if (cmd_stage_enabled())
+  {
+    // stages before submit are recorded in the qpair, consume them
+    struct cmd_stage_table_t* stage = &cmd_stage_queue_table[qid];
+    uint64_t* tsc = stage->tsc[tail_index];
+
+    tsc[CMD_STAGE_ENTRY] = stage->entry_tsc;
+    tsc[CMD_STAGE_BUILD] = stage->build_tsc;
+    tsc[CMD_STAGE_SUBMIT] = spdk_get_ticks();
+    tsc[CMD_STAGE_DOORBELL] = 0;
+    stage->entry_tsc = 0;
+    stage->build_tsc = 0;
+  }
+
   // add tail to commit the new cmd only when it is sent successfully
   tail_index += 1;
   if (tail_index == CMD_LOG_DEPTH)
@@ -490,6 +1083,7 @@ void cmdlog_add_cmd(struct spdk_nvme_qpair* qpair, struct nvme_request* req)
     tail_index = 0;
   }
   log_table->tail_index = tail_index;
+  log_table->cmd_count++;
 }
 
 
@@ -617,12 +1211,15 @@ void intc_unmask(struct spdk_nvme_qpair* q)
 struct cb_ctx {
   struct spdk_nvme_transport_id* trid;
   struct spdk_nvme_ctrlr* ctrlr;
+  nvme_transport_opts* opts;
 };
 
 static bool probe_cb(void *cb_ctx,
                      const struct spdk_nvme_transport_id *trid,
                      struct spdk_nvme_ctrlr_opts *opts)
 {
+  nvme_transport_opts* transport;
+
 	if (trid->trtype == SPDK_NVME_TRANSPORT_PCIE)
   {
     struct spdk_nvme_transport_id* target = ((struct cb_ctx*)cb_ctx)->trid;
@@ -652,6 +1249,20 @@ static bool probe_cb(void *cb_ctx,
   opts->header_digest = false;
 	opts->data_digest = false;
 
+  // fabrics options given by scripts
+  transport = ((struct cb_ctx*)cb_ctx)->opts;
+  if (transport != NULL)
+  {
+    if (transport->io_queue_size != 0)
+    {
+      opts->io_queue_size = transport->io_queue_size;
+      opts->io_queue_requests = MAX(opts->io_queue_requests,
+                                    transport->io_queue_size*2);
+    }
+    opts->header_digest = transport->hdgst;
+    opts->data_digest = transport->ddgst;
+  }
+
 	return true;
 }
 
@@ -695,27 +1306,88 @@ int pcie_cfg_write8(struct spdk_pci_device* pci,
   return spdk_pci_device_cfg_write8(pci, value, offset);
 }
 
+int pcie_cfg_read16(struct spdk_pci_device* pci,
+                    unsigned short* value,
+                    unsigned int offset)
+{
+  return spdk_pci_device_cfg_read16(pci, value, offset);
+}
 
-////module: nvme ctrlr
-///////////////////////////////
-struct spdk_nvme_ctrlr* nvme_probe(char* traddr)
+int pcie_cfg_write16(struct spdk_pci_device* pci,
+                     unsigned short value,
+                     unsigned int offset)
 {
-  struct spdk_nvme_transport_id trid;
-  struct cb_ctx cb_ctx;
-	int rc;
+  return spdk_pci_device_cfg_write16(pci, value, offset);
+}
 
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "looking for NVMe @%s\n", traddr);
+int pcie_cfg_read32(struct spdk_pci_device* pci,
+                    unsigned int* value,
+                    unsigned int offset)
+{
+  return spdk_pci_device_cfg_read32(pci, value, offset);
+}
 
-  // device address
+int pcie_cfg_write32(struct spdk_pci_device* pci,
+                     unsigned int value,
+                     unsigned int offset)
+{
+  return spdk_pci_device_cfg_write32(pci, value, offset);
+}
+
+// read config space in one access, return the length read
+unsigned int pcie_cfg_snapshot(struct spdk_pci_device* pci,
+                               void* buf,
+                               unsigned int len)
+{
+  if (0 == spdk_pci_device_cfg_read(pci, buf, len, 0))
+  {
+    return len;
+  }
+
+  // extended config space is not accessible, try legacy config space
+  len = MIN(len, 256);
+  if (0 == spdk_pci_device_cfg_read(pci, buf, len, 0))
+  {
+    return len;
+  }
+
+  return 0;
+}
+
+
+////module: nvme ctrlr
+///////////////////////////////
+
+#define NVME_RESET_TIMEOUT_S      (10)
+
+struct spdk_nvme_ctrlr* nvme_probe(char* traddr, nvme_transport_opts* opts)
+{
+  struct spdk_nvme_transport_id trid;
+  struct cb_ctx cb_ctx;
+	int rc;
+
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "looking for NVMe @%s\n", traddr);
+
+  // device address
   memset(&trid, 0, sizeof(trid));
   if (strchr(traddr, ':') == NULL)
   {
-    // tcp/ip address: fixed port to 4420
+    // tcp/ip address: default port 4420
     trid.trtype = SPDK_NVME_TRANSPORT_TCP;
     trid.adrfam = SPDK_NVMF_ADRFAM_IPV4;
     strncpy(trid.traddr, traddr, strlen(traddr)+1);
-    strncpy(trid.trsvcid, "4420", 4+1);
-    snprintf(trid.subnqn, sizeof(trid.subnqn), "%s", SPDK_NVMF_DISCOVERY_NQN);
+    snprintf(trid.trsvcid, sizeof(trid.trsvcid), "%u",
+             (opts && opts->trsvcid) ? opts->trsvcid : 4420);
+
+    // connect to the given subsystem, or discover all subsystems
+    if (opts && opts->subnqn[0] != '\0')
+    {
+      snprintf(trid.subnqn, sizeof(trid.subnqn), "%s", opts->subnqn);
+    }
+    else
+    {
+      snprintf(trid.subnqn, sizeof(trid.subnqn), "%s", SPDK_NVMF_DISCOVERY_NQN);
+    }
   }
   else
   {
@@ -726,6 +1398,7 @@ struct spdk_nvme_ctrlr* nvme_probe(char* traddr)
 
   cb_ctx.trid = &trid;
   cb_ctx.ctrlr = NULL;
+  cb_ctx.opts = opts;
   rc = spdk_nvme_probe(&trid, &cb_ctx, probe_cb, attach_cb, NULL);
   if (rc != 0 || cb_ctx.ctrlr == NULL)
   {
@@ -737,12 +1410,12 @@ struct spdk_nvme_ctrlr* nvme_probe(char* traddr)
   return cb_ctx.ctrlr;
 }
 
-struct spdk_nvme_ctrlr* nvme_init(char * traddr)
+struct spdk_nvme_ctrlr* nvme_init(char * traddr, nvme_transport_opts* opts)
 {
   struct spdk_nvme_ctrlr* ctrlr;
 
   //enum the device
-  ctrlr = nvme_probe(traddr);
+  ctrlr = nvme_probe(traddr, opts);
   if (ctrlr == NULL)
   {
     return NULL;
@@ -798,6 +1471,77 @@ int nvme_get_reg32(struct spdk_nvme_ctrlr* ctrlr,
   return nvme_pcie_ctrlr_get_reg_4(ctrlr, offset, value);
 }
 
+// identify controller data kept by the driver, read without any command
+const void* nvme_get_identify_data(struct spdk_nvme_ctrlr* ctrlr)
+{
+  return spdk_nvme_ctrlr_get_data(ctrlr);
+}
+
+// reset controller without re-enumeration, and re-create existing io qpairs
+int nvme_reset_inplace(struct spdk_nvme_ctrlr* ctrlr, nvme_reset_timing* timing)
+{
+  int ret = 0;
+  uint32_t cc;
+  uint32_t csts;
+  uint64_t hz = spdk_get_ticks_hz();
+  uint64_t start = spdk_get_ticks();
+  uint64_t deadline = start + hz*NVME_RESET_TIMEOUT_S;
+  struct spdk_nvme_qpair* qpair;
+  TAILQ_HEAD(, spdk_nvme_qpair) io_qpairs;
+
+  assert(timing != NULL);
+  memset(timing, 0, sizeof(nvme_reset_timing));
+
+  // cc.en 1 => 0, and wait csts.rdy to 0
+  nvme_pcie_ctrlr_get_reg_4(ctrlr, 0x14, &cc);
+  nvme_pcie_ctrlr_set_reg_4(ctrlr, 0x14, cc & ~1);
+  do
+  {
+    nvme_pcie_ctrlr_get_reg_4(ctrlr, 0x1c, &csts);
+    if (spdk_get_ticks() > deadline)
+    {
+      SPDK_ERRLOG("timeout to wait csts.rdy 0\n");
+      return -ETIMEDOUT;
+    }
+  } while (csts & 1);
+  timing->disable_us = (spdk_get_ticks()-start)*US_PER_S/hz;
+
+  // detach io qpairs, so spdk only resets the admin queue
+  TAILQ_INIT(&io_qpairs);
+  TAILQ_CONCAT(&io_qpairs, &ctrlr->active_io_qpairs, tailq);
+  TAILQ_FOREACH(qpair, &io_qpairs, tailq)
+  {
+    nvme_qpair_disable(qpair);
+    timing->qpair_count ++;
+  }
+
+  // cc.en 0 => 1, and initialize admin queue
+  start = spdk_get_ticks();
+  if (0 != spdk_nvme_ctrlr_reset(ctrlr) || ctrlr->is_failed)
+  {
+    SPDK_ERRLOG("fail to reset controller\n");
+    ret = -1;
+  }
+  timing->admin_us = (spdk_get_ticks()-start)*US_PER_S/hz;
+
+  // re-create io qpairs with their original id, depth and priority
+  start = spdk_get_ticks();
+  TAILQ_FOREACH(qpair, &io_qpairs, tailq)
+  {
+    if (ret == 0 && 0 != nvme_transport_ctrlr_reinit_io_qpair(ctrlr, qpair))
+    {
+      SPDK_ERRLOG("fail to re-create qpair %d\n", qpair->id);
+      ret = -1;
+    }
+  }
+  TAILQ_CONCAT(&ctrlr->active_io_qpairs, &io_qpairs, tailq);
+  timing->io_us = (spdk_get_ticks()-start)*US_PER_S/hz;
+
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "reset in place: disable %dus, admin %dus, io %dus\n",
+                timing->disable_us, timing->admin_us, timing->io_us);
+  return ret;
+}
+
 int nvme_wait_completion_admin(struct spdk_nvme_ctrlr* ctrlr)
 {
   int32_t rc;
@@ -908,6 +1652,12 @@ int nvme_cpl_is_error(const struct spdk_nvme_cpl* cpl)
 ////module: qpair
 ///////////////////////////////
 
+// back off of waiting interrupts
+#define QPAIR_WAIT_SPIN_US        (50)
+#define QPAIR_WAIT_PAUSE_COUNT    (1000)
+#define QPAIR_WAIT_SLEEP_MIN_US   (10)
+#define QPAIR_WAIT_SLEEP_MAX_US   (1000)
+
 struct spdk_nvme_qpair *qpair_create(struct spdk_nvme_ctrlr* ctrlr,
                                      int prio, int depth)
 {
@@ -944,6 +1694,120 @@ int qpair_wait_completion(struct spdk_nvme_qpair *qpair, uint32_t max_completion
   return spdk_nvme_qpair_process_completions(qpair, max_completions);
 }
 
+// process completions when the qpair's msix vector fired
+static int qpair_process_interrupt(struct spdk_nvme_qpair* qpair,
+                                   uint32_t max_completions)
+{
+  int ret;
+  struct cmd_log_table_t* log_table = &cmd_log_queue_table[qpair->id];
+
+  if (log_table->msix_data == 0)
+  {
+    return 0;
+  }
+
+  // mask the interrupt, and clear it before processing
+  nvme_pcie_ctrlr_set_reg_4(qpair->ctrlr, log_table->mask_offset, 1);
+  log_table->msix_data = 0;
+  ret = spdk_nvme_qpair_process_completions(qpair, max_completions);
+  if (ret > 0 && (uint32_t)ret == max_completions)
+  {
+    // more completions may be left in CQ, check them next time
+    log_table->msix_data = 1;
+  }
+  nvme_pcie_ctrlr_set_reg_4(qpair->ctrlr, log_table->mask_offset, 0);
+
+  return ret;
+}
+
+// reap until expected completions arrive, or timeout_ms passes. Return the
+// number of reaped completions, or negative error code.
+// wait_mode:
+//  QPAIR_WAIT_POLL: busy polling CQ
+//  QPAIR_WAIT_INTERRUPT: check CQ only when msix vector fired, otherwise
+//                        back off with pause and then sleep
+//  QPAIR_WAIT_HYBRID: busy polling for a while after the last completion,
+//                     then wait interrupt as above
+int qpair_wait_completion_until(struct spdk_nvme_qpair *qpair,
+                                uint32_t expected,
+                                uint32_t timeout_ms,
+                                uint32_t wait_mode)
+{
+  int ret;
+  uint32_t reaped = 0;
+  uint32_t poll_count = 0;
+  uint32_t idle_count = 0;
+  uint32_t sleep_us = QPAIR_WAIT_SLEEP_MIN_US;
+  uint64_t now = spdk_get_ticks();
+  uint64_t deadline = now + spdk_get_ticks_hz()*timeout_ms/1000;
+  uint64_t spin_ticks = 0;
+  uint64_t spin_deadline;
+
+  // interrupt is not available, e.g. fabrics
+  if (!cmd_log_queue_table[qpair->id].msix_enabled)
+  {
+    wait_mode = QPAIR_WAIT_POLL;
+  }
+
+  if (wait_mode == QPAIR_WAIT_HYBRID)
+  {
+    spin_ticks = spdk_get_ticks_hz()*QPAIR_WAIT_SPIN_US/US_PER_S;
+  }
+  spin_deadline = now + spin_ticks;
+
+  while (reaped < expected)
+  {
+    // never reap more than expected
+    if (wait_mode == QPAIR_WAIT_POLL ||
+        (wait_mode == QPAIR_WAIT_HYBRID && spdk_get_ticks() < spin_deadline))
+    {
+      ret = spdk_nvme_qpair_process_completions(qpair, expected-reaped);
+    }
+    else
+    {
+      ret = qpair_process_interrupt(qpair, expected-reaped);
+    }
+
+    if (ret < 0)
+    {
+      return ret;
+    }
+
+    if (ret > 0)
+    {
+      reaped += ret;
+      idle_count = 0;
+      sleep_us = QPAIR_WAIT_SLEEP_MIN_US;
+      spin_deadline = spdk_get_ticks() + spin_ticks;
+    }
+    else if (wait_mode == QPAIR_WAIT_INTERRUPT ||
+             (wait_mode == QPAIR_WAIT_HYBRID && spdk_get_ticks() >= spin_deadline))
+    {
+      // nothing fired, back off: pause first, then sleep longer and longer
+      if (idle_count++ < QPAIR_WAIT_PAUSE_COUNT)
+      {
+        spdk_pause();
+      }
+      else
+      {
+        usleep(sleep_us);
+        sleep_us = MIN(sleep_us*2, QPAIR_WAIT_SLEEP_MAX_US);
+      }
+    }
+
+    // check time periodically
+    if ((++poll_count & 0xff) == 0 || idle_count > QPAIR_WAIT_PAUSE_COUNT)
+    {
+      if (spdk_get_ticks() > deadline)
+      {
+        break;
+      }
+    }
+  }
+
+  return reaped;
+}
+
 int qpair_get_id(struct spdk_nvme_qpair* q)
 {
   // q NULL is admin queue
@@ -964,9 +1828,108 @@ int qpair_free(struct spdk_nvme_qpair* q)
 }
 
 
+////module: reap ring
+///////////////////////////////
+
+// completions are kept in the ring until reaped by scripts, instead of
+// calling back to scripts one by one
+struct qpair_reap_ring_t {
+  uint16_t qid;
+  uint32_t depth;
+  uint32_t head;
+  uint32_t count;
+  uint64_t count_dropped;
+  qpair_reap_entry entries[];
+};
+
+qpair_reap_ring* qpair_reap_init(struct spdk_nvme_qpair* q, uint32_t depth)
+{
+  qpair_reap_ring* ring;
+
+  assert(q != NULL);
+  assert(depth != 0);
+
+  ring = calloc(1, sizeof(qpair_reap_ring)+sizeof(qpair_reap_entry)*depth);
+  if (ring == NULL)
+  {
+    return NULL;
+  }
+
+  ring->qid = q->id;
+  ring->depth = depth;
+  return ring;
+}
+
+void qpair_reap_fini(qpair_reap_ring* ring)
+{
+  if (ring && ring->count_dropped)
+  {
+    SPDK_NOTICELOG("qpair %d dropped %ld completions not reaped\n",
+                   ring->qid, ring->count_dropped);
+  }
+  free(ring);
+}
+
+void qpair_reap_cb(void* cb_arg, const struct spdk_nvme_cpl* cpl)
+{
+  qpair_reap_ring* ring = (qpair_reap_ring*)cb_arg;
+  qpair_reap_entry* entry;
+
+  assert(ring != NULL);
+
+  if (ring->count == ring->depth)
+  {
+    // ring is full, drop the oldest completion
+    ring->head = (ring->head+1)%ring->depth;
+    ring->count --;
+    ring->count_dropped ++;
+  }
+
+  entry = &ring->entries[(ring->head+ring->count)%ring->depth];
+  entry->cid = cpl->cid;
+  entry->status = (*(uint16_t*)&cpl->status)>>1;
+  entry->cdw0 = cpl->cdw0;
+  entry->latency_us = cmd_log_queue_table[ring->qid].latency_us_last;
+  ring->count ++;
+}
+
+uint32_t qpair_reap(qpair_reap_ring* ring,
+                    struct spdk_nvme_qpair* q,
+                    uint32_t max_count,
+                    qpair_reap_entry* entries)
+{
+  uint32_t i;
+
+  assert(ring != NULL);
+
+  spdk_nvme_qpair_process_completions(q, 0);
+
+  for (i=0; i<max_count && ring->count; i++)
+  {
+    entries[i] = ring->entries[ring->head];
+    ring->head = (ring->head+1)%ring->depth;
+    ring->count --;
+  }
+
+  return i;
+}
+
+// get and clear the count of dropped completions
+uint64_t qpair_reap_dropped(qpair_reap_ring* ring)
+{
+  uint64_t count = ring->count_dropped;
+
+  ring->count_dropped = 0;
+  return count;
+}
+
+
 ////module: namespace
 ///////////////////////////////
 
+// max ranges in one DSM command
+#define NS_DSM_RANGE_MAX      (256)
+
 struct spdk_nvme_ns* ns_init(struct spdk_nvme_ctrlr* ctrlr, uint32_t nsid)
 {
   struct spdk_nvme_ns* ns = spdk_nvme_ctrlr_get_ns(ctrlr, nsid);
@@ -978,6 +1941,11 @@ struct spdk_nvme_ns* ns_init(struct spdk_nvme_ctrlr* ctrlr, uint32_t nsid)
     return NULL;
   }
 
+  if (spdk_process_is_primary() && g_driver_ns_count++ == 0)
+  {
+    g_driver_csum_ns = ns;
+  }
+
   return ns;
 }
 
@@ -997,6 +1965,7 @@ int ns_cmd_read_write(int is_read,
                       spdk_nvme_cmd_cb cb_fn,
                       void* cb_arg)
 {
+  int ret;
   struct spdk_nvme_cmd cmd;
   uint32_t lba_size = spdk_nvme_ns_get_sector_size(ns);
 
@@ -1011,6 +1980,8 @@ int ns_cmd_read_write(int is_read,
   assert(len >= lba_count*lba_size);
   assert((io_flags&0xffff) == 0);
 
+  cmdlog_stage_build(qpair);
+
   //setup cmd structure
   memset(&cmd, 0, sizeof(struct spdk_nvme_cmd));
   cmd.opc = is_read ? 2 : 1;
@@ -1030,884 +2001,2891 @@ int ns_cmd_read_write(int is_read,
   }
 
   //send io cmd in qpair
-  return spdk_nvme_ctrlr_cmd_io_raw(ns->ctrlr, qpair, &cmd, buf, len, cb_fn, cb_arg);
-}
+  ret = spdk_nvme_ctrlr_cmd_io_raw(ns->ctrlr, qpair, &cmd, buf, len, cb_fn, cb_arg);
+  if (ret == 0)
+  {
+    cmdlog_stage_doorbell(qpair);
+  }
 
-uint32_t ns_get_sector_size(struct spdk_nvme_ns* ns)
-{
-  return spdk_nvme_ns_get_sector_size(ns);
+  return ret;
 }
 
-uint64_t ns_get_num_sectors(struct spdk_nvme_ns* ns)
+// used for sgl callbacks
+struct ns_sgl_ctx {
+  struct buffer_sgl_t* sgl;
+  uint32_t offset;
+  bool is_read;
+  uint64_t lba;
+  uint32_t lba_count;
+  uint32_t lba_size;
+  spdk_nvme_cmd_cb cb_fn;
+  void* cb_arg;
+};
+
+static void ns_sgl_reset_cb(void* ref, uint32_t offset)
 {
-  return spdk_nvme_ns_get_num_sectors(ns);
+  struct ns_sgl_ctx* ctx = (struct ns_sgl_ctx*)ref;
+  ctx->offset = offset;
 }
 
-int ns_fini(struct spdk_nvme_ns* ns)
+static int ns_sgl_next_cb(void* ref, void** address, uint32_t* length)
 {
-  crc32_fini();
+  size_t len;
+  struct ns_sgl_ctx* ctx = (struct ns_sgl_ctx*)ref;
+
+  *address = buffer_sgl_addr(ctx->sgl, ctx->offset, &len);
+  *length = len;
+  ctx->offset += len;
   return 0;
 }
 
+static void ns_sgl_cpl_cb(void* ref, const struct spdk_nvme_cpl* cpl)
+{
+  struct ns_sgl_ctx* ctx = (struct ns_sgl_ctx*)ref;
+  struct buffer_sgl_t* sgl = ctx->sgl;
+  struct spdk_nvme_cpl c = *cpl;
 
-////module: ioworker
-///////////////////////////////
+  //verify read data segment by segment
+  if (ctx->is_read && !spdk_nvme_cpl_is_error(cpl) &&
+      (*g_driver_global_config_ptr & DCFG_VERIFY_READ) != 0)
+  {
+    uint32_t lba_per_seg = sgl->seg_size/ctx->lba_size;
 
-// used for callback
-struct ioworker_io_ctx {
-  void* data_buf;
-  size_t data_buf_len;
-  bool is_read;
-  struct timeval time_sent;
-  struct ioworker_global_ctx* gctx;
-};
+    for (uint32_t i=0; i*lba_per_seg<ctx->lba_count; i++)
+    {
+      uint32_t count = MIN(lba_per_seg, ctx->lba_count-i*lba_per_seg);
 
-struct ioworker_global_ctx {
-  struct ioworker_args* args;
-  struct ioworker_rets* rets;
-  struct spdk_nvme_ns* ns;
-  struct spdk_nvme_qpair *qpair;
-  struct timeval due_time;
-  struct timeval io_due_time;
-  struct timeval io_delay_time;
-  struct timeval time_next_sec;
-  uint64_t io_count_till_last_sec;
-  uint64_t sequential_lba;
-  uint64_t io_count_sent;
-  uint64_t io_count_cplt;
-  uint32_t last_sec;
-  bool flag_finish;
-};
+      if (0 != buffer_verify_data(sgl->seg[i],
+                                  ctx->lba+i*lba_per_seg,
+                                  count, ctx->lba_size))
+      {
+        //Unrecovered Read Error: The read data could not be recovered from the media.
+        c.status.sct = 0x02;
+        c.status.sc = 0x81;
+        break;
+      }
+    }
+  }
 
-#define ALIGN_UP(n, a)    (((n)%(a))?((n)+(a)-((n)%(a))):((n)))
-#define ALIGN_DOWN(n, a)  ((n)-((n)%(a)))
+  ctx->cb_fn(ctx->cb_arg, &c);
+  free(ctx);
+}
 
-static int ioworker_send_one(struct spdk_nvme_ns* ns,
-                             struct spdk_nvme_qpair *qpair,
-                             struct ioworker_io_ctx* ctx,
-                             struct ioworker_global_ctx* gctx);
+int ns_cmd_io_sgl(unsigned int opcode,
+                  struct spdk_nvme_ns* ns,
+                  struct spdk_nvme_qpair* qpair,
+                  struct buffer_sgl_t* sgl,
+                  uint64_t lba,
+                  uint32_t lba_count,
+                  uint32_t io_flags,
+                  spdk_nvme_cmd_cb cb_fn,
+                  void* cb_arg)
+{
+  int ret;
+  struct ns_sgl_ctx* ctx;
+  uint32_t lba_size = spdk_nvme_ns_get_sector_size(ns);
 
+  assert(ns != NULL);
+  assert(qpair != NULL);
+  assert(sgl != NULL);
 
-static inline void timeradd_second(struct timeval* now,
-                                     unsigned int seconds,
-                                     struct timeval* due)
-{
-  struct timeval duration;
+  //validate data buffer: lba should not cross segments
+  assert(sgl->size >= lba_count*lba_size);
+  assert(sgl->seg_size%lba_size == 0);
 
-  duration.tv_sec = seconds;
-  duration.tv_usec = 0;
-  timeradd(now, &duration, due);
-}
+  ctx = malloc(sizeof(struct ns_sgl_ctx));
+  if (ctx == NULL)
+  {
+    return -ENOMEM;
+  }
 
-static bool ioworker_send_one_is_finish(struct ioworker_args* args,
-                                        struct ioworker_global_ctx* c)
-{
-  struct timeval now;
+  ctx->sgl = sgl;
+  ctx->offset = 0;
+  ctx->is_read = (opcode == 2);
+  ctx->lba = lba;
+  ctx->lba_count = lba_count;
+  ctx->lba_size = lba_size;
+  ctx->cb_fn = cb_fn;
+  ctx->cb_arg = cb_arg;
 
-  // limit by io count, and/or time, which happens first
-  if (c->io_count_sent == args->io_count)
+  switch (opcode)
   {
-    SPDK_DEBUGLOG(SPDK_LOG_NVME, "ioworker finish, sent %ld io\n", c->io_count_sent);
-    return true;
+    case 1:
+      //fill write buffer with lba, token, and checksum
+      for (uint32_t i=0; i*(sgl->seg_size/lba_size)<lba_count; i++)
+      {
+        uint32_t lba_per_seg = sgl->seg_size/lba_size;
+        buffer_fill_data(sgl->seg[i], lba+i*lba_per_seg,
+                         MIN(lba_per_seg, lba_count-i*lba_per_seg),
+                         lba_size);
+      }
+      ret = spdk_nvme_ns_cmd_writev(ns, qpair, lba, lba_count,
+                                    ns_sgl_cpl_cb, ctx, io_flags,
+                                    ns_sgl_reset_cb, ns_sgl_next_cb);
+      break;
+
+    case 2:
+      ret = spdk_nvme_ns_cmd_readv(ns, qpair, lba, lba_count,
+                                   ns_sgl_cpl_cb, ctx, io_flags,
+                                   ns_sgl_reset_cb, ns_sgl_next_cb);
+      break;
+
+    case 5:
+      ret = spdk_nvme_ns_cmd_comparev(ns, qpair, lba, lba_count,
+                                      ns_sgl_cpl_cb, ctx, io_flags,
+                                      ns_sgl_reset_cb, ns_sgl_next_cb);
+      break;
+
+    default:
+      SPDK_ERRLOG("sgl buffer is not supported in opcode %d\n", opcode);
+      ret = -EINVAL;
+      break;
   }
 
-  assert(c->io_count_sent < args->io_count);
-  gettimeofday(&now, NULL);
-  if (true == timercmp(&now, &c->due_time, >))
+  if (ret != 0)
   {
-    SPDK_DEBUGLOG(SPDK_LOG_NVME, "ioworker finish, due time %ld us\n", c->due_time.tv_usec);
-    return true;
+    free(ctx);
   }
 
-  return false;
+  return ret;
 }
 
-static void ioworker_one_io_throttle(struct ioworker_global_ctx* gctx,
-                                     struct timeval* now)
-{
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "this io due at %ld.%06ld\n",
-                gctx->io_due_time.tv_sec, gctx->io_due_time.tv_usec);
-  if (true == timercmp(&gctx->io_due_time, now, >))
+// used for batch callbacks
+struct ns_batch_ctx {
+  uint32_t index;
+  struct timeval time_sent;
+  struct ns_batch_global_ctx* gctx;
+};
+
+struct ns_batch_global_ctx {
+  uint32_t count_cplt;
+  uint16_t* status;
+  uint32_t* latency_us;
+};
+
+static void ns_batch_cb(void* ref, const struct spdk_nvme_cpl* cpl)
+{
+  struct timeval now;
+  struct timeval diff;
+  struct ns_batch_ctx* ctx = (struct ns_batch_ctx*)ref;
+  struct ns_batch_global_ctx* gctx = ctx->gctx;
+
+  if (gctx->status == NULL)
   {
-    //delay usec to meet the IOPS prequisit
-    struct timeval diff;
-    timersub(&gctx->io_due_time, now, &diff);
-    usleep(timeval_to_us(&diff));
+    // the batch is already timeout
+    return;
   }
 
-  timeradd(&gctx->io_due_time, &gctx->io_delay_time, &gctx->io_due_time);
+  gettimeofday(&now, NULL);
+  timersub(&now, &ctx->time_sent, &diff);
+  gctx->latency_us[ctx->index] = timeval_to_us(&diff);
+  // status field without the phase tag
+  gctx->status[ctx->index] = (*(uint16_t*)&cpl->status)>>1;
+  gctx->count_cplt ++;
 }
 
-static uint32_t ioworker_get_duration(struct timeval* start,
-                                      struct ioworker_global_ctx* gctx)
+int ns_cmd_read_write_many(int is_read,
+                           struct spdk_nvme_ns* ns,
+                           struct spdk_nvme_qpair* qpair,
+                           void* buf,
+                           size_t len,
+                           uint32_t count,
+                           const uint64_t* lbas,
+                           const uint16_t* lba_counts,
+                           const uint64_t* buf_offsets,
+                           uint32_t io_flags,
+                           uint32_t qdepth,
+                           uint32_t timeout_sec,
+                           uint16_t* status,
+                           uint32_t* latency_us)
 {
+  int ret = 0;
+  int error = 0;
+  uint32_t count_sent = 0;
+  uint32_t count_cplt_last = 0;
+  uint32_t lba_size = spdk_nvme_ns_get_sector_size(ns);
   struct timeval now;
-  struct timeval diff;
-  uint32_t msec;
+  struct timeval due_time;
+  struct ns_batch_global_ctx* gctx;
+  struct ns_batch_ctx* ctx;
+
+  assert(qpair != NULL);
+  assert(qdepth != 0);
+
+  //validate all commands before sending any of them
+  for (uint32_t i=0; i<count; i++)
+  {
+    uint64_t offset = buf_offsets ? buf_offsets[i] : 0;
+
+    if (lba_counts[i] == 0 || offset+lba_counts[i]*lba_size > len)
+    {
+      SPDK_ERRLOG("invalid command %d: lba count %d, buffer offset %ld\n",
+                  i, lba_counts[i], offset);
+      return -EINVAL;
+    }
+  }
+
+  // global context is allocated together with command contexts
+  ctx = malloc(sizeof(struct ns_batch_ctx)*count + sizeof(struct ns_batch_global_ctx));
+  if (ctx == NULL)
+  {
+    return -ENOMEM;
+  }
+
+  gctx = (struct ns_batch_global_ctx*)&ctx[count];
+  gctx->count_cplt = 0;
+  gctx->status = status;
+  gctx->latency_us = latency_us;
 
   gettimeofday(&now, NULL);
-  timersub(&now, start, &diff);
-  msec = diff.tv_sec * 1000UL;
-  return msec + (diff.tv_usec+500)/1000;
+  timeradd_second(&now, timeout_sec, &due_time);
+  while (gctx->count_cplt < count)
+  {
+    // fill the queue
+    while (count_sent < count && count_sent-gctx->count_cplt < qdepth)
+    {
+      uint32_t i = count_sent;
+      uint64_t offset = buf_offsets ? buf_offsets[i] : 0;
+
+      ctx[i].index = i;
+      ctx[i].gctx = gctx;
+      gettimeofday(&ctx[i].time_sent, NULL);
+      ret = ns_cmd_read_write(is_read, ns, qpair,
+                              (uint8_t*)buf+offset, len-offset,
+                              lbas[i], lba_counts[i], io_flags,
+                              ns_batch_cb, &ctx[i]);
+      if (ret == -ENOMEM)
+      {
+        // no more request available, reap some completions first
+        break;
+      }
+      else if (ret != 0)
+      {
+        // stop sending, and wait for the commands already sent
+        SPDK_ERRLOG("batch command %d fail to send: %d\n", i, ret);
+        error = ret;
+        count = count_sent;
+        break;
+      }
+      count_sent ++;
+    }
+
+    spdk_nvme_qpair_process_completions(qpair, 0);
+
+    // timeout when no completion in the time limit
+    gettimeofday(&now, NULL);
+    if (gctx->count_cplt != count_cplt_last)
+    {
+      count_cplt_last = gctx->count_cplt;
+      timeradd_second(&now, timeout_sec, &due_time);
+    }
+    else if (timercmp(&now, &due_time, >))
+    {
+      SPDK_ERRLOG("batch timeout, sent %d, completed %d\n",
+                  count_sent, gctx->count_cplt);
+
+      // contexts are still used by outstanding commands, so not free them
+      gctx->status = NULL;
+      return -ETIMEDOUT;
+    }
+  }
+
+  free(ctx);
+  return error;
 }
 
-static uint32_t ioworker_update_rets(struct ioworker_io_ctx* ctx,
-                                     struct ioworker_rets* ret,
-                                     struct timeval* now)
+// used for dump and load callbacks
+struct ns_file_ctx {
+  void* buf;
+  uint64_t lba;
+  uint32_t lba_count;
+  bool busy;
+  struct ns_file_global_ctx* gctx;
+};
+
+struct ns_file_global_ctx {
+  bool is_load;
+  bool detached;
+  uint8_t* map;
+  size_t map_len;
+  uint64_t lba_start;
+  uint32_t lba_size;
+  uint32_t buf_size;
+  uint32_t qdepth;
+  uint32_t count_sent;
+  uint32_t count_cplt;
+  uint32_t count_error;
+  struct ns_file_ctx* ctx;
+};
+
+static void ns_file_release(struct ns_file_global_ctx* gctx)
 {
-  struct timeval diff;
-  uint32_t latency;
+  struct ns_file_ctx* ctx = gctx->ctx;
 
-  timersub(now, &ctx->time_sent, &diff);
-  latency = timeval_to_us(&diff);
-  if (latency > ret->latency_max_us)
+  for (uint32_t i=0; i<gctx->qdepth; i++)
   {
-    ret->latency_max_us = latency;
+    if (ctx[i].buf != NULL)
+    {
+      buffer_pool_put(ctx[i].buf, gctx->buf_size);
+    }
   }
+  munmap(gctx->map, gctx->map_len);
+  free(ctx);
+}
 
-  if (ctx->is_read == true)
+static void ns_file_cb(void* ref, const struct spdk_nvme_cpl* cpl)
+{
+  struct ns_file_ctx* ctx = (struct ns_file_ctx*)ref;
+  struct ns_file_global_ctx* gctx = ctx->gctx;
+  size_t offset = (ctx->lba-gctx->lba_start)*gctx->lba_size;
+  size_t len = ctx->lba_count*gctx->lba_size;
+
+  if (spdk_nvme_cpl_is_error(cpl))
   {
-    ret->io_count_read ++;
+    SPDK_WARNLOG("%s error: lba 0x%lx, status %02x/%02x\n",
+                 gctx->is_load ? "load" : "dump",
+                 ctx->lba, cpl->status.sct, cpl->status.sc);
+    gctx->count_error ++;
   }
-  else
+  else if (!gctx->is_load)
   {
-    ret->io_count_write ++;
+    memcpy(gctx->map+offset, ctx->buf, len);
   }
 
-  return latency;
+  ctx->busy = false;
+  gctx->count_cplt ++;
+
+  // the last outstanding command after timeout, completed by the device
+  // or aborted when the qpair is deleted
+  if (gctx->detached && gctx->count_cplt == gctx->count_sent)
+  {
+    ns_file_release(gctx);
+  }
 }
 
-static inline void ioworker_update_io_count_per_second(
-    struct ioworker_global_ctx* gctx,
-    struct ioworker_args* args,
-    struct ioworker_rets* rets)
+static int ns_file_send_one(struct spdk_nvme_ns* ns,
+                            struct spdk_nvme_qpair* qpair,
+                            struct ns_file_ctx* ctx)
 {
-  uint64_t current_io_count = rets->io_count_read + rets->io_count_write;
+  struct spdk_nvme_cmd cmd;
+  struct ns_file_global_ctx* gctx = ctx->gctx;
+  size_t offset = (ctx->lba-gctx->lba_start)*gctx->lba_size;
+  size_t len = ctx->lba_count*gctx->lba_size;
 
-  // update to next second
-  timeradd_second(&gctx->time_next_sec, 1, &gctx->time_next_sec);
-  args->io_counter_per_second[gctx->last_sec ++] = current_io_count - gctx->io_count_till_last_sec;
-  gctx->io_count_till_last_sec = current_io_count;
+  if (gctx->is_load)
+  {
+    // raw data from file, keep crc only for data written by pynvme
+    memcpy(ctx->buf, gctx->map+offset, len);
+    for (uint32_t i=0; i<ctx->lba_count && g_driver_csum_table_ptr; i++)
+    {
+      uint64_t* ptr = (uint64_t*)((uint8_t*)ctx->buf+i*gctx->lba_size);
+      uint64_t lba = ctx->lba+i;
+
+      *crc32_entry(lba) = (ptr[0] == lba) ?
+                          buffer_calc_csum(ptr, gctx->lba_size) : 0;
+    }
+  }
+
+  memset(&cmd, 0, sizeof(struct spdk_nvme_cmd));
+  cmd.opc = gctx->is_load ? 1 : 2;
+  cmd.nsid = ns->id;
+  cmd.cdw10 = ctx->lba;
+  cmd.cdw11 = ctx->lba>>32;
+  cmd.cdw12 = ctx->lba_count-1;
+
+  ctx->busy = true;
+  return spdk_nvme_ctrlr_cmd_io_raw(ns->ctrlr, qpair, &cmd, ctx->buf, len,
+                                    ns_file_cb, ctx);
 }
 
-static void ioworker_one_cb(void* ctx_in, const struct spdk_nvme_cpl *cpl)
+// dump lba range to file, or load file to lba range. Commands are pipelined
+// in qdepth, and the file is memory mapped.
+int ns_cmd_file(int is_load,
+                struct spdk_nvme_ns* ns,
+                struct spdk_nvme_qpair* qpair,
+                const char* path,
+                uint64_t lba,
+                uint64_t lba_count,
+                uint32_t io_size,
+                uint32_t qdepth,
+                uint32_t timeout_sec)
 {
-  uint32_t latency_us;
+  int fd;
+  int ret = 0;
+  size_t len;
+  uint8_t* map;
+  uint32_t lba_size = spdk_nvme_ns_get_sector_size(ns);
+  uint64_t lba_next = lba;
+  uint64_t lba_end = lba+lba_count;
+  uint32_t count_cplt_last = 0;
+  uint32_t count_sent = 0;
   struct timeval now;
-  struct ioworker_io_ctx* ctx = (struct ioworker_io_ctx*)ctx_in;
-  struct ioworker_args* args = ctx->gctx->args;
-  struct ioworker_global_ctx* gctx = ctx->gctx;
-  struct ioworker_rets* rets = gctx->rets;
+  struct timeval due_time;
+  struct ns_file_global_ctx* gctx;
+  struct ns_file_ctx* ctx;
 
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "one io completed, ctx %p, io delay time: %ld\n",
-               ctx, gctx->io_delay_time.tv_usec);
+  assert(qpair != NULL);
+  assert(io_size != 0 && io_size <= 0x10000);
+  assert(qdepth != 0);
 
-  gctx->io_count_cplt ++;
+  if (lba_end > spdk_nvme_ns_get_num_sectors(ns))
+  {
+    SPDK_ERRLOG("lba range exceeds namespace: 0x%lx\n", lba_end);
+    return -EINVAL;
+  }
 
-  // update statistics in ret structure
-  gettimeofday(&now, NULL);
-  assert(rets != NULL);
-  latency_us = ioworker_update_rets(ctx, rets, &now);
+  if (lba_count == 0)
+  {
+    return 0;
+  }
 
-  // update io count per latency
-  if (args->io_counter_per_latency != NULL)
+  // map the file
+  len = lba_count*lba_size;
+  fd = open(path, is_load ? O_RDONLY : (O_RDWR|O_CREAT|O_TRUNC), 0644);
+  if (fd < 0)
   {
-    args->io_counter_per_latency[MIN(US_PER_S-1, latency_us)] ++;
+    SPDK_ERRLOG("cannot open file %s\n", path);
+    return -errno;
+  }
+  if (!is_load && ftruncate(fd, len) != 0)
+  {
+    close(fd);
+    return -errno;
   }
+  map = mmap(NULL, len, is_load ? PROT_READ : (PROT_READ|PROT_WRITE),
+             MAP_SHARED, fd, 0);
+  close(fd);
+  if (map == MAP_FAILED)
+  {
+    SPDK_ERRLOG("cannot map file %s\n", path);
+    return -errno;
+  }
+  madvise(map, len, MADV_SEQUENTIAL);
 
-  // throttle IOPS by delay
-  if (gctx->io_delay_time.tv_usec != 0)
+  // one dma buffer for each outstanding command, and global context is
+  // allocated together with command contexts
+  ctx = calloc(1, sizeof(struct ns_file_ctx)*qdepth + sizeof(struct ns_file_global_ctx));
+  if (ctx == NULL)
   {
-    ioworker_one_io_throttle(gctx, &now);
+    munmap(map, len);
+    return -ENOMEM;
   }
 
-  if (true == nvme_cpl_is_error(cpl))
+  gctx = (struct ns_file_global_ctx*)&ctx[qdepth];
+  gctx->is_load = is_load;
+  gctx->map = map;
+  gctx->map_len = len;
+  gctx->lba_start = lba;
+  gctx->lba_size = lba_size;
+  gctx->buf_size = io_size*lba_size;
+  gctx->qdepth = qdepth;
+  gctx->ctx = ctx;
+  for (uint32_t i=0; i<qdepth; i++)
   {
-    // terminate ioworker when any error happen
-    // only keep the first error code
-    uint16_t error = ((*(unsigned short*)(&cpl->status))>>1)&0x7ff;
-    SPDK_DEBUGLOG(SPDK_LOG_NVME, "ioworker error happen in cpl\n");
-    gctx->flag_finish = true;
-    if (rets->error == 0)
+    ctx[i].gctx = gctx;
+    ctx[i].buf = buffer_pool_get(io_size*lba_size, NULL, false);
+    if (ctx[i].buf == NULL)
     {
-      rets->error = error;
+      ret = -ENOMEM;
+      goto exit;
     }
   }
 
-  // update io counter per second when required
-  if (args->io_counter_per_second != NULL)
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "%s lba 0x%lx, count %ld, file %s\n",
+                is_load ? "load" : "dump", lba, lba_count, path);
+  gettimeofday(&now, NULL);
+  timeradd_second(&now, timeout_sec, &due_time);
+  while (lba_next < lba_end || gctx->count_cplt < count_sent)
   {
-    if (true == timercmp(&now, &gctx->time_next_sec, >))
+    // send commands in all idle slots, and stop sending when any command fails
+    for (uint32_t i=0; i<qdepth && lba_next<lba_end && gctx->count_error==0; i++)
     {
-      ioworker_update_io_count_per_second(gctx, args, rets);
+      if (ctx[i].busy)
+      {
+        continue;
+      }
+
+      ctx[i].lba = lba_next;
+      ctx[i].lba_count = MIN(io_size, lba_end-lba_next);
+      if (ns_file_send_one(ns, qpair, &ctx[i]) != 0)
+      {
+        // no more request available, reap some completions first
+        ctx[i].busy = false;
+        break;
+      }
+      lba_next += ctx[i].lba_count;
+      count_sent ++;
     }
-  }
 
-  // check if all io are sent
-  if (gctx->flag_finish != true)
-  {
-    //update finish flag
-    gctx->flag_finish = ioworker_send_one_is_finish(args, gctx);
-  }
+    spdk_nvme_qpair_process_completions(qpair, 0);
 
-  if (gctx->flag_finish != true)
-  {
-    // send more io
-    ioworker_send_one(gctx->ns, gctx->qpair, ctx, gctx);
+    if (gctx->count_error != 0 && gctx->count_cplt == count_sent)
+    {
+      ret = -EIO;
+      break;
+    }
+
+    // timeout when no completion in the time limit
+    gettimeofday(&now, NULL);
+    if (gctx->count_cplt != count_cplt_last)
+    {
+      count_cplt_last = gctx->count_cplt;
+      timeradd_second(&now, timeout_sec, &due_time);
+    }
+    else if (timercmp(&now, &due_time, >))
+    {
+      SPDK_ERRLOG("%s timeout, sent %d, completed %d\n",
+                  is_load ? "load" : "dump", count_sent, gctx->count_cplt);
+
+      // contexts, buffers and the map are still used by outstanding
+      // commands, they are released by the last completion
+      gctx->count_sent = count_sent;
+      gctx->detached = true;
+      return -ETIMEDOUT;
+    }
   }
-}
 
-static inline bool ioworker_send_one_is_read(unsigned short read_percentage)
-{
-  return random()%100 < read_percentage;
+exit:
+  ns_file_release(gctx);
+  return ret;
 }
 
-static uint64_t ioworker_send_one_lba_sequential(struct ioworker_args* args,
-                                                 struct ioworker_global_ctx* gctx)
-{
-  uint64_t ret;
+// used for deallocate callbacks
+struct ns_dsm_ctx {
+  uint32_t count_cplt;
+  uint32_t count_error;
+};
 
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "gctx lba: 0x%lx, align:%d, end: 0x%lx\n",
-                gctx->sequential_lba, args->lba_align, args->region_end);
+static void ns_dsm_cb(void* ref, const struct spdk_nvme_cpl* cpl)
+{
+  struct ns_dsm_ctx* ctx = (struct ns_dsm_ctx*)ref;
 
-  ret = gctx->sequential_lba;
-  if (ret > args->region_end)
+  if (spdk_nvme_cpl_is_error(cpl))
   {
-    ret = args->region_start;
+    SPDK_WARNLOG("deallocate error: status %02x/%02x\n",
+                 cpl->status.sct, cpl->status.sc);
+    ctx->count_error ++;
   }
-
-  return ret;
+  ctx->count_cplt ++;
 }
 
-static inline uint64_t ioworker_send_one_lba_random(struct ioworker_args* args)
+static int ns_dsm_range_cmp(const void* a, const void* b)
 {
-  return (random()%(args->region_end-args->region_start)) + args->region_start;
+  uint64_t lba_a = ((const uint64_t*)a)[0];
+  uint64_t lba_b = ((const uint64_t*)b)[0];
+
+  return (lba_a > lba_b) - (lba_a < lba_b);
 }
 
-static uint64_t ioworker_send_one_lba(struct ioworker_args* args,
-                                      struct ioworker_global_ctx* gctx)
+// clear checksum of all ranges, merging adjacent and overlapped ranges
+static int ns_dsm_crc32_clear(const uint64_t* ranges, uint32_t count)
 {
-  uint64_t ret;
+  uint64_t start;
+  uint64_t end;
+  uint64_t* sorted;
 
-  if (args->lba_random == 0)
+  sorted = malloc(sizeof(uint64_t)*2*count);
+  if (sorted == NULL)
   {
-    ret = ioworker_send_one_lba_sequential(args, gctx);
-    gctx->sequential_lba = ret;
+    return -ENOMEM;
   }
-  else
+  memcpy(sorted, ranges, sizeof(uint64_t)*2*count);
+  qsort(sorted, count, sizeof(uint64_t)*2, ns_dsm_range_cmp);
+
+  start = sorted[0];
+  end = sorted[0]+sorted[1];
+  for (uint32_t i=1; i<count; i++)
   {
-    ret = ioworker_send_one_lba_random(args);
+    if (sorted[i*2] > end)
+    {
+      crc32_clear(start, end-start, 0, 0);
+      start = sorted[i*2];
+      end = start;
+    }
+    end = MAX(end, sorted[i*2]+sorted[i*2+1]);
   }
+  crc32_clear(start, end-start, 0, 0);
 
-  return ALIGN_DOWN(ret, args->lba_align);
+  free(sorted);
+  return 0;
 }
 
-static int ioworker_send_one(struct spdk_nvme_ns* ns,
-                             struct spdk_nvme_qpair *qpair,
-                             struct ioworker_io_ctx* ctx,
-                             struct ioworker_global_ctx* gctx)
+// deallocate ranges of (lba, lba_count) pairs, by DSM commands of up to 256
+// ranges. Commands are pipelined in qdepth.
+int ns_cmd_deallocate(struct spdk_nvme_ns* ns,
+                      struct spdk_nvme_qpair* qpair,
+                      const uint64_t* ranges,
+                      uint32_t count,
+                      uint32_t qdepth,
+                      uint32_t timeout_sec)
 {
   int ret;
-  struct ioworker_args* args = gctx->args;
-  bool is_read = ioworker_send_one_is_read(args->read_percentage);
-  uint64_t lba_starting = ioworker_send_one_lba(args, gctx);
-  uint16_t lba_count = args->lba_size;
+  uint32_t count_sent = 0;
+  uint32_t count_cmd = (count+NS_DSM_RANGE_MAX-1)/NS_DSM_RANGE_MAX;
+  uint32_t count_cplt_last = 0;
+  uint64_t num_sectors = spdk_nvme_ns_get_num_sectors(ns);
+  struct spdk_nvme_dsm_range dsm_ranges[NS_DSM_RANGE_MAX];
+  struct timeval now;
+  struct timeval due_time;
+  struct ns_dsm_ctx* ctx;
 
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "one io: ctx %p, lba 0x%lx, count %d\n",
-                ctx, lba_starting, lba_count);
+  assert(qpair != NULL);
+  assert(qdepth != 0);
 
-  assert(ctx->data_buf != NULL);
+  //validate all ranges before sending any command
+  for (uint32_t i=0; i<count; i++)
+  {
+    uint64_t lba = ranges[i*2];
+    uint64_t lba_count = ranges[i*2+1];
+
+    if (lba_count == 0 || lba_count > UINT32_MAX || lba+lba_count > num_sectors)
+    {
+      SPDK_ERRLOG("invalid range %d: lba 0x%lx, lba count %ld\n", i, lba, lba_count);
+      return -EINVAL;
+    }
+  }
+
+  if (count == 0)
+  {
+    return 0;
+  }
 
-  ret = ns_cmd_read_write(is_read, ns, qpair,
-                          ctx->data_buf, ctx->data_buf_len,
-                          lba_starting, lba_count,
-                          0,  //do not have more options in ioworkers
-                          ioworker_one_cb, ctx);
+  // update host-side table for the trimmed data
+  ret = ns_dsm_crc32_clear(ranges, count);
   if (ret != 0)
   {
-    SPDK_NOTICELOG("ioworker error happen in cpl\n");
-    gctx->flag_finish = true;
     return ret;
   }
 
-  //sent one io cmd successfully
-  gctx->sequential_lba += args->lba_align;
-  gctx->io_count_sent ++;
-  ctx->is_read = is_read;
-  gettimeofday(&ctx->time_sent, NULL);
-  return 0;
-}
+  ctx = calloc(1, sizeof(struct ns_dsm_ctx));
+  if (ctx == NULL)
+  {
+    return -ENOMEM;
+  }
 
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "deallocate %d ranges in %d commands\n", count, count_cmd);
+  gettimeofday(&now, NULL);
+  timeradd_second(&now, timeout_sec, &due_time);
+  while (ctx->count_cplt < count_sent || count_sent < count_cmd)
+  {
+    // fill the queue, and stop sending when any command fails
+    while (count_sent < count_cmd &&
+           count_sent-ctx->count_cplt < qdepth &&
+           ctx->count_error == 0)
+    {
+      uint32_t first = count_sent*NS_DSM_RANGE_MAX;
+      uint32_t num = MIN(NS_DSM_RANGE_MAX, count-first);
 
-int ioworker_entry(struct spdk_nvme_ns* ns,
-                   struct spdk_nvme_qpair *qpair,
-                   struct ioworker_args* args,
-                   struct ioworker_rets* rets)
-{
-  int ret = 0;
-  uint64_t nsze = spdk_nvme_ns_get_num_sectors(ns);
-  uint32_t sector_size = spdk_nvme_ns_get_sector_size(ns);
-  struct timeval test_start;
-  struct ioworker_global_ctx gctx;
-  struct ioworker_io_ctx* io_ctx = malloc(sizeof(struct ioworker_io_ctx)*args->qdepth);
+      // ranges are copied in spdk request, so the array can be reused
+      memset(dsm_ranges, 0, sizeof(dsm_ranges));
+      for (uint32_t i=0; i<num; i++)
+      {
+        dsm_ranges[i].starting_lba = ranges[(first+i)*2];
+        dsm_ranges[i].length = ranges[(first+i)*2+1];
+      }
 
-  assert(ns != NULL);
-  assert(qpair != NULL);
-  assert(args != NULL);
+      if (0 != spdk_nvme_ns_cmd_dataset_management(ns, qpair,
+                                                   SPDK_NVME_DSM_ATTR_DEALLOCATE,
+                                                   dsm_ranges, num,
+                                                   ns_dsm_cb, ctx))
+      {
+        // no more request available, reap some completions first
+        break;
+      }
+      count_sent ++;
+    }
+
+    spdk_nvme_qpair_process_completions(qpair, 0);
+
+    if (ctx->count_error != 0 && ctx->count_cplt == count_sent)
+    {
+      break;
+    }
+
+    // timeout when no completion in the time limit
+    gettimeofday(&now, NULL);
+    if (ctx->count_cplt != count_cplt_last)
+    {
+      count_cplt_last = ctx->count_cplt;
+      timeradd_second(&now, timeout_sec, &due_time);
+    }
+    else if (timercmp(&now, &due_time, >))
+    {
+      SPDK_ERRLOG("deallocate timeout, sent %d, completed %d\n",
+                  count_sent, ctx->count_cplt);
+
+      // context is still used by outstanding commands, so not free it
+      return -ETIMEDOUT;
+    }
+  }
+
+  ret = ctx->count_error ? -EIO : 0;
+  free(ctx);
+  return ret;
+}
+
+uint32_t ns_get_sector_size(struct spdk_nvme_ns* ns)
+{
+  return spdk_nvme_ns_get_sector_size(ns);
+}
+
+uint64_t ns_get_num_sectors(struct spdk_nvme_ns* ns)
+{
+  return spdk_nvme_ns_get_num_sectors(ns);
+}
+
+int ns_fini(struct spdk_nvme_ns* ns)
+{
+  crc32_fini(ns);
+  return 0;
+}
+
+
+////module: ioworker
+///////////////////////////////
+
+// used for callback
+struct ioworker_io_ctx {
+  void* data_buf;
+  size_t data_buf_len;
+  bool is_read;
+  struct timeval time_sent;
+  struct ioworker_global_ctx* gctx;
+};
+
+struct ioworker_global_ctx {
+  struct ioworker_args* args;
+  struct ioworker_rets* rets;
+  struct spdk_nvme_ns* ns;
+  struct spdk_nvme_qpair *qpair;
+  struct timeval due_time;
+  struct timeval io_due_time;
+  struct timeval io_delay_time;
+  struct timeval time_next_sec;
+  uint64_t io_count_till_last_sec;
+  struct timeval test_start;
+  struct timeval time_next_sample;
+  struct timeval sample_interval;
+  uint64_t read_till_last_sample;
+  uint64_t write_till_last_sample;
+  uint32_t io_bytes;
+  struct timeval time_next_latency;
+  struct timeval latency_interval;
+  uint32_t latency_hist_count;
+  uint32_t latency_hist_max;
+  uint32_t latency_hist[IOWORKER_LATENCY_BUCKETS];
+  uint64_t sequential_lba;
+  uint64_t io_count_sent;
+  uint64_t io_count_cplt;
+  uint32_t last_sec;
+  bool flag_finish;
+};
+
+#define ALIGN_UP(n, a)    (((n)%(a))?((n)+(a)-((n)%(a))):((n)))
+#define ALIGN_DOWN(n, a)  ((n)-((n)%(a)))
+
+static int ioworker_send_one(struct spdk_nvme_ns* ns,
+                             struct spdk_nvme_qpair *qpair,
+                             struct ioworker_io_ctx* ctx,
+                             struct ioworker_global_ctx* gctx);
+
+
+static bool ioworker_send_one_is_finish(struct ioworker_args* args,
+                                        struct ioworker_global_ctx* c)
+{
+  struct timeval now;
+
+  // limit by io count, and/or time, which happens first
+  if (c->io_count_sent == args->io_count)
+  {
+    SPDK_DEBUGLOG(SPDK_LOG_NVME, "ioworker finish, sent %ld io\n", c->io_count_sent);
+    return true;
+  }
+
+  assert(c->io_count_sent < args->io_count);
+  gettimeofday(&now, NULL);
+  if (true == timercmp(&now, &c->due_time, >))
+  {
+    SPDK_DEBUGLOG(SPDK_LOG_NVME, "ioworker finish, due time %ld us\n", c->due_time.tv_usec);
+    return true;
+  }
+
+  return false;
+}
+
+static void ioworker_one_io_throttle(struct ioworker_global_ctx* gctx,
+                                     struct timeval* now)
+{
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "this io due at %ld.%06ld\n",
+                gctx->io_due_time.tv_sec, gctx->io_due_time.tv_usec);
+  if (true == timercmp(&gctx->io_due_time, now, >))
+  {
+    //delay usec to meet the IOPS prequisit
+    struct timeval diff;
+    timersub(&gctx->io_due_time, now, &diff);
+    usleep(timeval_to_us(&diff));
+  }
+
+  timeradd(&gctx->io_due_time, &gctx->io_delay_time, &gctx->io_due_time);
+}
+
+static uint32_t ioworker_get_duration(struct timeval* start,
+                                      struct ioworker_global_ctx* gctx)
+{
+  struct timeval now;
+  struct timeval diff;
+  uint32_t msec;
+
+  gettimeofday(&now, NULL);
+  timersub(&now, start, &diff);
+  msec = diff.tv_sec * 1000UL;
+  return msec + (diff.tv_usec+500)/1000;
+}
+
+static uint32_t ioworker_update_rets(struct ioworker_io_ctx* ctx,
+                                     struct ioworker_rets* ret,
+                                     struct timeval* now)
+{
+  struct timeval diff;
+  uint32_t latency;
+
+  timersub(now, &ctx->time_sent, &diff);
+  latency = timeval_to_us(&diff);
+  if (latency > ret->latency_max_us)
+  {
+    ret->latency_max_us = latency;
+  }
+
+  if (ctx->is_read == true)
+  {
+    ret->io_count_read ++;
+  }
+  else
+  {
+    ret->io_count_write ++;
+  }
+
+  return latency;
+}
+
+static inline void ioworker_update_io_count_per_second(
+    struct ioworker_global_ctx* gctx,
+    struct ioworker_args* args,
+    struct ioworker_rets* rets)
+{
+  uint64_t current_io_count = rets->io_count_read + rets->io_count_write;
+
+  // update to next second
+  timeradd_second(&gctx->time_next_sec, 1, &gctx->time_next_sec);
+  args->io_counter_per_second[gctx->last_sec ++] = current_io_count - gctx->io_count_till_last_sec;
+  gctx->io_count_till_last_sec = current_io_count;
+}
+
+// keep the memory of samples bounded in long run: merge the older half of
+// samples in pairs, so older data has coarser resolution
+static void ioworker_sample_downsample(struct ioworker_args* args,
+                                       struct ioworker_rets* rets)
+{
+  ioworker_sample* samples = args->samples;
+  uint32_t pairs = rets->sample_count/4;
+
+  for (uint32_t i=0; i<pairs; i++)
+  {
+    ioworker_sample* a = &samples[i*2];
+    ioworker_sample* b = &samples[i*2+1];
+
+    samples[i].time_ms = b->time_ms;
+    samples[i].io_count_read = a->io_count_read + b->io_count_read;
+    samples[i].io_count_write = a->io_count_write + b->io_count_write;
+    samples[i].bytes = a->bytes + b->bytes;
+  }
+
+  memmove(&samples[pairs], &samples[pairs*2],
+          (rets->sample_count-pairs*2)*sizeof(ioworker_sample));
+  rets->sample_count -= pairs;
+}
+
+static void ioworker_sample_add(struct ioworker_global_ctx* gctx,
+                                struct ioworker_args* args,
+                                struct ioworker_rets* rets,
+                                struct timeval* end)
+{
+  ioworker_sample* sample;
+  struct timeval diff;
+
+  if (rets->sample_count == args->sample_max)
+  {
+    ioworker_sample_downsample(args, rets);
+  }
+
+  timersub(end, &gctx->test_start, &diff);
+  sample = &args->samples[rets->sample_count++];
+  sample->time_ms = diff.tv_sec*1000UL + diff.tv_usec/1000;
+  sample->io_count_read = rets->io_count_read - gctx->read_till_last_sample;
+  sample->io_count_write = rets->io_count_write - gctx->write_till_last_sample;
+  sample->bytes = (uint64_t)(sample->io_count_read+sample->io_count_write)*gctx->io_bytes;
+  gctx->read_till_last_sample = rets->io_count_read;
+  gctx->write_till_last_sample = rets->io_count_write;
+}
+
+static inline void ioworker_update_samples(struct ioworker_global_ctx* gctx,
+                                           struct ioworker_args* args,
+                                           struct ioworker_rets* rets,
+                                           struct timeval* now)
+{
+  // intervals without any completion are kept as empty samples
+  while (true == timercmp(now, &gctx->time_next_sample, >))
+  {
+    ioworker_sample_add(gctx, args, rets, &gctx->time_next_sample);
+    timeradd(&gctx->time_next_sample, &gctx->sample_interval, &gctx->time_next_sample);
+  }
+}
+
+static inline uint32_t ioworker_latency_bucket(uint32_t latency_us)
+{
+  uint32_t msb;
+
+  if (latency_us < 8)
+  {
+    return latency_us;
+  }
+
+  msb = 31-__builtin_clz(latency_us);
+  return (msb-2)*8 + ((latency_us>>(msb-3))&7);
+}
+
+// the largest latency in the bucket
+static inline uint32_t ioworker_latency_bucket_us(uint32_t bucket)
+{
+  uint32_t shift;
+
+  if (bucket < 8)
+  {
+    return bucket;
+  }
+
+  shift = bucket/8 - 1;
+  return ((8+bucket%8+1)<<shift) - 1;
+}
+
+static uint32_t ioworker_latency_percentile(struct ioworker_global_ctx* gctx,
+                                            uint32_t per_mille)
+{
+  uint64_t target = ((uint64_t)gctx->latency_hist_count*per_mille+999)/1000;
+  uint64_t total = 0;
+
+  for (uint32_t i=0; i<IOWORKER_LATENCY_BUCKETS; i++)
+  {
+    total += gctx->latency_hist[i];
+    if (total >= target)
+    {
+      return MIN(ioworker_latency_bucket_us(i), gctx->latency_hist_max);
+    }
+  }
+
+  return gctx->latency_hist_max;
+}
+
+// keep the memory of intervals bounded in long run, same as samples. The
+// histograms are gone, so merged intervals keep the larger percentiles.
+static void ioworker_latency_downsample(struct ioworker_args* args,
+                                        struct ioworker_rets* rets)
+{
+  ioworker_latency_interval* intervals = args->latency_intervals;
+  uint32_t pairs = rets->latency_interval_count/4;
+
+  for (uint32_t i=0; i<pairs; i++)
+  {
+    ioworker_latency_interval* a = &intervals[i*2];
+    ioworker_latency_interval* b = &intervals[i*2+1];
+
+    intervals[i].time_ms = b->time_ms;
+    intervals[i].io_count = a->io_count + b->io_count;
+    intervals[i].p50_us = MAX(a->p50_us, b->p50_us);
+    intervals[i].p99_us = MAX(a->p99_us, b->p99_us);
+    intervals[i].p999_us = MAX(a->p999_us, b->p999_us);
+    intervals[i].max_us = MAX(a->max_us, b->max_us);
+  }
+
+  memmove(&intervals[pairs], &intervals[pairs*2],
+          (rets->latency_interval_count-pairs*2)*sizeof(ioworker_latency_interval));
+  rets->latency_interval_count -= pairs;
+}
+
+// summarize the histogram of the interval, and start a new one
+static void ioworker_latency_rotate(struct ioworker_global_ctx* gctx,
+                                    struct ioworker_args* args,
+                                    struct ioworker_rets* rets,
+                                    struct timeval* end)
+{
+  ioworker_latency_interval* interval;
+  struct timeval diff;
+
+  if (rets->latency_interval_count == args->latency_interval_max)
+  {
+    ioworker_latency_downsample(args, rets);
+  }
+
+  timersub(end, &gctx->test_start, &diff);
+  interval = &args->latency_intervals[rets->latency_interval_count++];
+  interval->time_ms = diff.tv_sec*1000UL + diff.tv_usec/1000;
+  interval->io_count = gctx->latency_hist_count;
+  interval->p50_us = ioworker_latency_percentile(gctx, 500);
+  interval->p99_us = ioworker_latency_percentile(gctx, 990);
+  interval->p999_us = ioworker_latency_percentile(gctx, 999);
+  interval->max_us = gctx->latency_hist_max;
+
+  if (gctx->latency_hist_count != 0)
+  {
+    memset(gctx->latency_hist, 0, sizeof(gctx->latency_hist));
+    gctx->latency_hist_count = 0;
+    gctx->latency_hist_max = 0;
+  }
+}
+
+static inline void ioworker_update_latency(struct ioworker_global_ctx* gctx,
+                                           struct ioworker_args* args,
+                                           struct ioworker_rets* rets,
+                                           struct timeval* now,
+                                           uint32_t latency_us)
+{
+  while (true == timercmp(now, &gctx->time_next_latency, >))
+  {
+    ioworker_latency_rotate(gctx, args, rets, &gctx->time_next_latency);
+    timeradd(&gctx->time_next_latency, &gctx->latency_interval, &gctx->time_next_latency);
+  }
+
+  gctx->latency_hist[ioworker_latency_bucket(latency_us)] ++;
+  gctx->latency_hist_count ++;
+  gctx->latency_hist_max = MAX(gctx->latency_hist_max, latency_us);
+}
+
+static void ioworker_one_cb(void* ctx_in, const struct spdk_nvme_cpl *cpl)
+{
+  uint32_t latency_us;
+  struct timeval now;
+  struct ioworker_io_ctx* ctx = (struct ioworker_io_ctx*)ctx_in;
+  struct ioworker_args* args = ctx->gctx->args;
+  struct ioworker_global_ctx* gctx = ctx->gctx;
+  struct ioworker_rets* rets = gctx->rets;
+
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "one io completed, ctx %p, io delay time: %ld\n",
+               ctx, gctx->io_delay_time.tv_usec);
+
+  gctx->io_count_cplt ++;
+
+  // update statistics in ret structure
+  gettimeofday(&now, NULL);
   assert(rets != NULL);
 
-  //init rets
-  rets->io_count_read = 0;
-  rets->io_count_write = 0;
-  rets->latency_max_us = 0;
-  rets->mseconds = 0;
-  rets->error = 0;
+  // close the samples before this completion
+  if (args->samples != NULL)
+  {
+    ioworker_update_samples(gctx, args, rets, &now);
+  }
+
+  latency_us = ioworker_update_rets(ctx, rets, &now);
+
+  // update io count per latency
+  if (args->io_counter_per_latency != NULL)
+  {
+    args->io_counter_per_latency[MIN(US_PER_S-1, latency_us)] ++;
+  }
+
+  // update latency histogram of the interval
+  if (args->latency_intervals != NULL)
+  {
+    ioworker_update_latency(gctx, args, rets, &now, latency_us);
+  }
+
+  // throttle IOPS by delay
+  if (gctx->io_delay_time.tv_usec != 0)
+  {
+    ioworker_one_io_throttle(gctx, &now);
+  }
+
+  if (true == nvme_cpl_is_error(cpl))
+  {
+    // terminate ioworker when any error happen
+    // only keep the first error code
+    uint16_t error = ((*(unsigned short*)(&cpl->status))>>1)&0x7ff;
+    SPDK_DEBUGLOG(SPDK_LOG_NVME, "ioworker error happen in cpl\n");
+    gctx->flag_finish = true;
+    if (rets->error == 0)
+    {
+      rets->error = error;
+    }
+  }
+
+  // update io counter per second when required
+  if (args->io_counter_per_second != NULL)
+  {
+    if (true == timercmp(&now, &gctx->time_next_sec, >))
+    {
+      ioworker_update_io_count_per_second(gctx, args, rets);
+    }
+  }
+
+  // check if all io are sent
+  if (gctx->flag_finish != true)
+  {
+    //update finish flag
+    gctx->flag_finish = ioworker_send_one_is_finish(args, gctx);
+  }
+
+  if (gctx->flag_finish != true)
+  {
+    // send more io
+    ioworker_send_one(gctx->ns, gctx->qpair, ctx, gctx);
+  }
+}
+
+static inline bool ioworker_send_one_is_read(unsigned short read_percentage)
+{
+  return random()%100 < read_percentage;
+}
+
+static uint64_t ioworker_send_one_lba_sequential(struct ioworker_args* args,
+                                                 struct ioworker_global_ctx* gctx)
+{
+  uint64_t ret;
+
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "gctx lba: 0x%lx, align:%d, end: 0x%lx\n",
+                gctx->sequential_lba, args->lba_align, args->region_end);
+
+  ret = gctx->sequential_lba;
+  if (ret > args->region_end)
+  {
+    ret = args->region_start;
+  }
+
+  return ret;
+}
+
+static inline uint64_t ioworker_send_one_lba_random(struct ioworker_args* args)
+{
+  return (random()%(args->region_end-args->region_start)) + args->region_start;
+}
+
+static uint64_t ioworker_send_one_lba(struct ioworker_args* args,
+                                      struct ioworker_global_ctx* gctx)
+{
+  uint64_t ret;
+
+  if (args->lba_random == 0)
+  {
+    ret = ioworker_send_one_lba_sequential(args, gctx);
+    gctx->sequential_lba = ret;
+  }
+  else
+  {
+    ret = ioworker_send_one_lba_random(args);
+  }
+
+  return ALIGN_DOWN(ret, args->lba_align);
+}
+
+static int ioworker_send_one(struct spdk_nvme_ns* ns,
+                             struct spdk_nvme_qpair *qpair,
+                             struct ioworker_io_ctx* ctx,
+                             struct ioworker_global_ctx* gctx)
+{
+  int ret;
+  struct ioworker_args* args = gctx->args;
+  bool is_read = ioworker_send_one_is_read(args->read_percentage);
+  uint64_t lba_starting = ioworker_send_one_lba(args, gctx);
+  uint16_t lba_count = args->lba_size;
+
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "one io: ctx %p, lba 0x%lx, count %d\n",
+                ctx, lba_starting, lba_count);
+
+  assert(ctx->data_buf != NULL);
+
+  if (args->sgl_segment_size != 0)
+  {
+    ret = ns_cmd_io_sgl(is_read ? 2 : 1, ns, qpair,
+                        ctx->data_buf,
+                        lba_starting, lba_count,
+                        0,  //do not have more options in ioworkers
+                        ioworker_one_cb, ctx);
+  }
+  else
+  {
+    ret = ns_cmd_read_write(is_read, ns, qpair,
+                            ctx->data_buf, ctx->data_buf_len,
+                            lba_starting, lba_count,
+                            0,  //do not have more options in ioworkers
+                            ioworker_one_cb, ctx);
+  }
+  if (ret != 0)
+  {
+    SPDK_NOTICELOG("ioworker error happen in cpl\n");
+    gctx->flag_finish = true;
+    return ret;
+  }
+
+  //sent one io cmd successfully
+  gctx->sequential_lba += args->lba_align;
+  gctx->io_count_sent ++;
+  ctx->is_read = is_read;
+  gettimeofday(&ctx->time_sent, NULL);
+  return 0;
+}
+
+
+int ioworker_entry(struct spdk_nvme_ns* ns,
+                   struct spdk_nvme_qpair *qpair,
+                   struct ioworker_args* args,
+                   struct ioworker_rets* rets)
+{
+  int ret = 0;
+  uint64_t nsze = spdk_nvme_ns_get_num_sectors(ns);
+  uint32_t sector_size = spdk_nvme_ns_get_sector_size(ns);
+  struct timeval test_start;
+  struct ioworker_global_ctx gctx;
+  struct cmd_log_table_t* log_table;
+  struct ioworker_io_ctx* io_ctx = malloc(sizeof(struct ioworker_io_ctx)*args->qdepth);
+
+  assert(ns != NULL);
+  assert(qpair != NULL);
+  assert(args != NULL);
+  assert(rets != NULL);
+
+  //init rets
+  rets->io_count_read = 0;
+  rets->io_count_write = 0;
+  rets->latency_max_us = 0;
+  rets->mseconds = 0;
+  rets->sample_count = 0;
+  rets->latency_interval_count = 0;
+  rets->error = 0;
+
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.lba_start = %ld\n", args->lba_start);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.lba_size = %d\n", args->lba_size);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.lba_align = %d\n", args->lba_align);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.lba_random = %d\n", args->lba_random);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.region_start = %ld\n", args->region_start);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.region_end = %ld\n", args->region_end);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.read_percentage = %d\n", args->read_percentage);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.iops = %d\n", args->iops);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.io_count = %ld\n", args->io_count);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.seconds = %d\n", args->seconds);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.qdepth = %d\n", args->qdepth);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.sgl_segment_size = %d\n", args->sgl_segment_size);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.sample_interval_ms = %d\n", args->sample_interval_ms);
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.latency_interval_ms = %d\n", args->latency_interval_ms);
+
+  //check args
+  assert(args->read_percentage <= 100);
+  assert(args->io_count != 0 || args->seconds != 0);
+  assert(args->seconds < 24*3600ULL);
+  assert(args->lba_size != 0);
+  assert(args->region_start < args->region_end);
+  assert(args->read_percentage >= 0);
+  assert(args->read_percentage <= 100);
+  assert(args->qdepth <= CMD_LOG_DEPTH/2);
+  assert(args->samples == NULL || (args->sample_interval_ms != 0 && args->sample_max >= 4));
+  assert(args->latency_intervals == NULL ||
+         (args->latency_interval_ms != 0 && args->latency_interval_max >= 4));
+
+  // check io size
+  if (args->lba_size*sector_size > ns->ctrlr->max_xfer_size)
+  {
+    SPDK_ERRLOG("IO size is larger than max xfer size, %d\n", ns->ctrlr->max_xfer_size);
+    rets->error = 0x0002;  // Invalid Field in Command
+    free(io_ctx);
+    return -2;
+  }
+
+  // progress in live metrics
+  log_table = &cmd_log_queue_table[qpair->id];
+  log_table->ioworker_cpl_base = log_table->cpl_count;
+  log_table->ioworker_io_target = args->io_count;
+  log_table->ioworker_seconds = args->seconds;
+
+  //revise args
+  if (args->io_count == 0)
+  {
+    args->io_count = (unsigned long)-1;
+  }
+  if (args->seconds == 0 || args->seconds > 24*3600ULL)
+  {
+    // run ioworker for 24hr at most
+    args->seconds = 24*3600ULL;
+  }
+  if (args->region_end > nsze)
+  {
+    args->region_end = nsze;
+  }
+
+  //adjust region to start_lba's region
+  args->region_start = ALIGN_UP(args->region_start, args->lba_align);
+  args->region_end = args->region_end-args->lba_size;
+  args->region_end = ALIGN_DOWN(args->region_end, args->lba_align);
+  if (args->lba_start < args->region_start)
+  {
+    args->lba_start = args->region_start;
+  }
+  if (args->io_count < args->qdepth)
+  {
+    args->qdepth = args->io_count;
+  }
+
+  //init global ctx
+  memset(&gctx, 0, sizeof(gctx));
+  gctx.ns = ns;
+  gctx.qpair = qpair;
+  gctx.sequential_lba = args->lba_start;
+  gctx.io_count_sent = 0;
+  gctx.io_count_cplt = 0;
+  gctx.flag_finish = false;
+  gctx.args = args;
+  gctx.rets = rets;
+  gettimeofday(&test_start, NULL);
+  log_table->ioworker_start_us = test_start.tv_sec*US_PER_S + test_start.tv_usec;
+  timeradd_second(&test_start, args->seconds, &gctx.due_time);
+  gctx.io_delay_time.tv_sec = 0;
+  gctx.io_delay_time.tv_usec = args->iops ? US_PER_S/args->iops : 0;
+  timeradd(&test_start, &gctx.io_delay_time, &gctx.io_due_time);
+  timeradd_second(&test_start, 1, &gctx.time_next_sec);
+  gctx.io_count_till_last_sec = 0;
+  gctx.last_sec = 0;
+  gctx.test_start = test_start;
+  gctx.io_bytes = args->lba_size * sector_size;
+  gctx.sample_interval.tv_sec = args->sample_interval_ms/1000;
+  gctx.sample_interval.tv_usec = (args->sample_interval_ms%1000)*1000;
+  timeradd(&test_start, &gctx.sample_interval, &gctx.time_next_sample);
+  gctx.latency_interval.tv_sec = args->latency_interval_ms/1000;
+  gctx.latency_interval.tv_usec = (args->latency_interval_ms%1000)*1000;
+  timeradd(&test_start, &gctx.latency_interval, &gctx.time_next_latency);
+
+  // sending the first batch of IOs, all remaining IOs are sending
+  // in callbacks till end
+  for (unsigned int i=0; i<args->qdepth; i++)
+  {
+    io_ctx[i].data_buf_len = args->lba_size * sector_size;
+    if (args->sgl_segment_size != 0)
+    {
+      // large io without large contiguous dma memory
+      io_ctx[i].data_buf = buffer_sgl_init(io_ctx[i].data_buf_len,
+                                           args->sgl_segment_size);
+    }
+    else
+    {
+      io_ctx[i].data_buf = buffer_init(io_ctx[i].data_buf_len, NULL);
+    }
+    io_ctx[i].gctx = &gctx;
+    ioworker_send_one(ns, qpair, &io_ctx[i], &gctx);
+  }
+
+  // callbacks check the end condition and mark the flag. Check the
+  // flag here if it is time to stop the ioworker and return the
+  // statistics data
+  while (gctx.io_count_sent != gctx.io_count_cplt ||
+         gctx.flag_finish != true)
+  {
+    //exceed 30 seconds more than the expected test time, abort ioworker
+    if (ioworker_get_duration(&test_start, &gctx) >
+        args->seconds*1000UL + 30*1000UL)
+    {
+      //ioworker timeout
+      SPDK_INFOLOG(SPDK_LOG_NVME, "ioworker timeout, io sent %ld, io cplt %ld, finish %d\n",
+                   gctx.io_count_sent, gctx.io_count_cplt, gctx.flag_finish);
+      ret = -4;
+      break;
+    }
+
+    // collect completions
+    spdk_nvme_qpair_process_completions(qpair, 0);
+  }
+
+  // final duration
+  rets->mseconds = ioworker_get_duration(&test_start, &gctx);
+
+  // the last partial sample
+  if (args->samples != NULL)
+  {
+    struct timeval now;
+
+    gettimeofday(&now, NULL);
+    ioworker_update_samples(&gctx, args, rets, &now);
+    ioworker_sample_add(&gctx, args, rets, &now);
+  }
+
+  // the last partial interval
+  if (args->latency_intervals != NULL && gctx.latency_hist_count != 0)
+  {
+    struct timeval now;
+
+    gettimeofday(&now, NULL);
+    ioworker_latency_rotate(&gctx, args, rets, &now);
+  }
+  log_table->ioworker_start_us = 0;
+
+  //release io ctx
+  for (unsigned int i=0; i<args->qdepth; i++)
+  {
+    if (args->sgl_segment_size != 0)
+    {
+      buffer_sgl_fini(io_ctx[i].data_buf);
+    }
+    else
+    {
+      buffer_fini(io_ctx[i].data_buf);
+    }
+  }
+
+  free(io_ctx);
+  return ret;
+}
+
+
+////module: log
+///////////////////////////////
+
+char* log_buf_dump(const char* header, const void* buf, size_t len)
+{
+  size_t size;
+  FILE* fd = NULL;
+  char* tmpname = "/tmp/pynvme_buf_dump.tmp";
+  static char dump_buf[64*1024];
+
+  // dump buf is limited
+  assert(len <= 4096);
+
+  errno = 0;
+  fd = fopen(tmpname, "w+");
+  if (fd == NULL)
+  {
+    SPDK_WARNLOG("fopen: %s\n", strerror(errno));
+    return NULL;
+  }
+
+  spdk_log_dump(fd, header, buf, len);
+
+  // get file size
+  size = ftell(fd);
+
+  errno = 0;
+  if (-1 == fseek(fd, 0, SEEK_SET))
+  {
+    SPDK_WARNLOG("lseek: %s\n", strerror(errno));
+    return NULL;
+  }
+
+  // read the data from temporary file
+  errno=0;
+  if (fread(dump_buf, size, 1, fd) == 0)
+  {
+    SPDK_WARNLOG("read: %s\n", strerror(errno));
+    return NULL;
+  }
+
+  fclose(fd);
+  return dump_buf;
+}
+
+void log_cmd_dump(struct spdk_nvme_qpair* qpair, size_t count)
+{
+  uint32_t dump_count = count;
+  uint16_t qid = qpair->id;
+  struct cmd_log_table_t* table = &cmd_log_queue_table[qid];
+  uint32_t index = cmd_log_queue_table[qid].tail_index;
+  uint32_t seq = 0;
+
+  assert(qid < CMD_LOG_QPAIR_COUNT);
+  assert(table != NULL);
+
+  if (count == 0 || count > CMD_LOG_DEPTH)
+  {
+    dump_count = CMD_LOG_DEPTH;
+  }
+
+  // cmdlog is NOT SQ/CQ. cmdlog keeps CMD/CPL for script test debug purpose
+  SPDK_NOTICELOG("dump qpair %d, latest tail in cmdlog: %d\n",
+                 qid, table->tail_index);
+
+  // only send the most recent part of cmdlog
+  while (seq++ < dump_count)
+  {
+    // get the next index to read log
+    if (index == 0)
+    {
+      index = CMD_LOG_DEPTH;
+    }
+    index -= 1;
+
+    // no timeval, empty slot, not print
+    struct timeval tv = table->table[index].time_cmd;
+    if (timercmp(&tv, &(struct timeval){0}, !=))
+    {
+      struct tm* time;
+      char tmbuf[64];
+
+      //cmd part
+      tv = table->table[index].time_cmd;
+      time = localtime(&tv.tv_sec);
+      strftime(tmbuf, sizeof(tmbuf), "%Y-%m-%d %H:%M:%S", time);
+      SPDK_NOTICELOG("index %d, %s.%06ld\n", index, tmbuf, tv.tv_usec);
+      nvme_qpair_print_command(qpair, &table->table[index].cmd);
+
+      //cpl part
+      tv.tv_usec = table->table[index].cpl_latency_us;
+      timeradd(&table->table[index].time_cmd, &tv, &tv);
+      time = localtime(&tv.tv_sec);
+      strftime(tmbuf, sizeof(tmbuf), "%Y-%m-%d %H:%M:%S", time);
+      SPDK_NOTICELOG("index %d, %s.%06ld\n", index, tmbuf, tv.tv_usec);
+      nvme_qpair_print_completion(qpair, &table->table[index].cpl);
+    }
+  }
+}
+
+void log_cmd_dump_admin(struct spdk_nvme_ctrlr* ctrlr, size_t count)
+{
+  log_cmd_dump(ctrlr->adminq, count);
+}
+
+
+////module: commands name, SPDK
+///////////////////////////////
+
+static const char *
+admin_opc_name(uint8_t opc)
+{
+	switch (opc) {
+	case SPDK_NVME_OPC_DELETE_IO_SQ:
+		return "Delete I/O Submission Queue";
+	case SPDK_NVME_OPC_CREATE_IO_SQ:
+		return "Create I/O Submission Queue";
+	case SPDK_NVME_OPC_GET_LOG_PAGE:
+		return "Get Log Page";
+	case SPDK_NVME_OPC_DELETE_IO_CQ:
+		return "Delete I/O Completion Queue";
+	case SPDK_NVME_OPC_CREATE_IO_CQ:
+		return "Create I/O Completion Queue";
+	case SPDK_NVME_OPC_IDENTIFY:
+		return "Identify";
+	case SPDK_NVME_OPC_ABORT:
+		return "Abort";
+	case SPDK_NVME_OPC_SET_FEATURES:
+		return "Set Features";
+	case SPDK_NVME_OPC_GET_FEATURES:
+		return "Get Features";
+	case SPDK_NVME_OPC_ASYNC_EVENT_REQUEST:
+		return "Asynchronous Event Request";
+	case SPDK_NVME_OPC_NS_MANAGEMENT:
+		return "Namespace Management";
+	case SPDK_NVME_OPC_FIRMWARE_COMMIT:
+		return "Firmware Commit";
+	case SPDK_NVME_OPC_FIRMWARE_IMAGE_DOWNLOAD:
+		return "Firmware Image Download";
+	case SPDK_NVME_OPC_DEVICE_SELF_TEST:
+		return "Device Self-test";
+	case SPDK_NVME_OPC_NS_ATTACHMENT:
+		return "Namespace Attachment";
+	case SPDK_NVME_OPC_KEEP_ALIVE:
+		return "Keep Alive";
+	case SPDK_NVME_OPC_DIRECTIVE_SEND:
+		return "Directive Send";
+	case SPDK_NVME_OPC_DIRECTIVE_RECEIVE:
+		return "Directive Receive";
+	case SPDK_NVME_OPC_VIRTUALIZATION_MANAGEMENT:
+		return "Virtualization Management";
+	case SPDK_NVME_OPC_NVME_MI_SEND:
+		return "NVMe-MI Send";
+	case SPDK_NVME_OPC_NVME_MI_RECEIVE:
+		return "NVMe-MI Receive";
+	case SPDK_NVME_OPC_DOORBELL_BUFFER_CONFIG:
+		return "Doorbell Buffer Config";
+	case SPDK_NVME_OPC_FORMAT_NVM:
+		return "Format NVM";
+	case SPDK_NVME_OPC_SECURITY_SEND:
+		return "Security Send";
+	case SPDK_NVME_OPC_SECURITY_RECEIVE:
+		return "Security Receive";
+	case SPDK_NVME_OPC_SANITIZE:
+		return "Sanitize";
+	default:
+		if (opc >= 0xC0) {
+			return "Vendor specific";
+		}
+		return "Unknown";
+	}
+}
+
+static const char *
+io_opc_name(uint8_t opc)
+{
+	switch (opc) {
+	case SPDK_NVME_OPC_FLUSH:
+		return "Flush";
+	case SPDK_NVME_OPC_WRITE:
+		return "Write";
+	case SPDK_NVME_OPC_READ:
+		return "Read";
+	case SPDK_NVME_OPC_WRITE_UNCORRECTABLE:
+		return "Write Uncorrectable";
+	case SPDK_NVME_OPC_COMPARE:
+		return "Compare";
+	case SPDK_NVME_OPC_WRITE_ZEROES:
+		return "Write Zeroes";
+	case SPDK_NVME_OPC_DATASET_MANAGEMENT:
+		return "Dataset Management";
+	case SPDK_NVME_OPC_RESERVATION_REGISTER:
+		return "Reservation Register";
+	case SPDK_NVME_OPC_RESERVATION_REPORT:
+		return "Reservation Report";
+	case SPDK_NVME_OPC_RESERVATION_ACQUIRE:
+		return "Reservation Acquire";
+	case SPDK_NVME_OPC_RESERVATION_RELEASE:
+		return "Reservation Release";
+	default:
+		if (opc >= 0x80) {
+			return "Vendor specific";
+		}
+		return "Unknown command";
+	}
+}
+
+const char* cmd_name(uint8_t opc, int set)
+{
+  if (set == 0)
+  {
+    return admin_opc_name(opc);
+  }
+  else if (set == 1)
+  {
+    return io_opc_name(opc);
+  }
+  else
+  {
+    return "Unknown command set";
+  }
+}
+
+
+////rpc
+///////////////////////////////
+
+// a light JSON-RPC 2.0 server on the unix socket. Requests and responses
+// are JSON objects, responses and notifications end with a newline.
+#define RPC_MAX_CONNS           (16)
+#define RPC_MAX_VALUES          (1024)
+#define RPC_RECV_BUF_SIZE       (64*1024)
+#define RPC_SEND_BUF_SIZE       (4*1024*1024)
+#define RPC_SUBSCRIBE_MIN_MS    (10)
+
+// completion counters in the last metrics of one connection, for the rate
+struct rpc_metrics_base_t {
+  uint64_t cpl_count[CMD_LOG_QPAIR_COUNT];
+  uint64_t tsc[CMD_LOG_QPAIR_COUNT];
+};
+
+struct rpc_conn_t {
+  int fd;
+  bool closing;
+
+  // received data, may hold partial requests
+  size_t recv_len;
+  char recv_buf[RPC_RECV_BUF_SIZE];
+
+  // responses not sent yet
+  size_t send_off;
+  size_t send_len;
+  char* send_buf;
+
+  // subscription of new cmdlog and metrics
+  bool subscribed;
+  bool sub_cmdlog;
+  bool sub_metrics;
+  uint32_t sub_qid;
+  uint64_t sub_count;
+  uint32_t sub_interval_ms;
+  uint64_t sub_next_ms;
+
+  // metrics requested and pushed in this connection
+  struct rpc_metrics_base_t metrics_base;
+};
+
+struct rpc_request_t {
+  struct rpc_conn_t* conn;
+  const struct spdk_json_val* id;
+};
+
+typedef void (*rpc_method_func)(struct rpc_request_t* request,
+                                const struct spdk_json_val* params);
+
+struct rpc_method_t {
+  const char* name;
+  rpc_method_func func;
+};
+
+static int g_rpc_epoll_fd = -1;
+static struct rpc_conn_t* g_rpc_conns[RPC_MAX_CONNS];
+
+
+static uint64_t rpc_now_ms(void)
+{
+  struct timespec ts;
+
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec*1000ULL + ts.tv_nsec/1000000;
+}
+
+static int rpc_conn_write_cb(void* cb_ctx, const void* data, size_t size)
+{
+  struct rpc_conn_t* conn = (struct rpc_conn_t*)cb_ctx;
+
+  if (conn->send_len+size > RPC_SEND_BUF_SIZE)
+  {
+    // client does not read its responses, drop it
+    SPDK_NOTICELOG("rpc client is too slow, close it\n");
+    conn->closing = true;
+    return -1;
+  }
+
+  memcpy(conn->send_buf+conn->send_len, data, size);
+  conn->send_len += size;
+  return 0;
+}
+
+static void rpc_conn_flush(struct rpc_conn_t* conn)
+{
+  struct epoll_event event;
+
+  while (conn->send_off < conn->send_len)
+  {
+    ssize_t n = send(conn->fd, conn->send_buf+conn->send_off,
+                     conn->send_len-conn->send_off, MSG_NOSIGNAL|MSG_DONTWAIT);
+    if (n <= 0)
+    {
+      if (n < 0 && (errno == EAGAIN || errno == EWOULDBLOCK))
+      {
+        break;
+      }
+      conn->closing = true;
+      return;
+    }
+    conn->send_off += n;
+  }
+
+  // move the remaining data to the front for the following messages
+  memmove(conn->send_buf, conn->send_buf+conn->send_off,
+          conn->send_len-conn->send_off);
+  conn->send_len -= conn->send_off;
+  conn->send_off = 0;
+
+  // wait the socket writable for the remaining data
+  event.events = EPOLLIN | (conn->send_len ? EPOLLOUT : 0);
+  event.data.ptr = conn;
+  epoll_ctl(g_rpc_epoll_fd, EPOLL_CTL_MOD, conn->fd, &event);
+}
+
+static struct spdk_json_write_ctx* rpc_begin_message(struct rpc_conn_t* conn)
+{
+  struct spdk_json_write_ctx* w;
+
+  w = spdk_json_write_begin(rpc_conn_write_cb, conn, 0);
+  if (w != NULL)
+  {
+    spdk_json_write_object_begin(w);
+    spdk_json_write_named_string(w, "jsonrpc", "2.0");
+  }
+
+  return w;
+}
+
+static void rpc_end_message(struct rpc_conn_t* conn, struct spdk_json_write_ctx* w)
+{
+  spdk_json_write_object_end(w);
+  spdk_json_write_end(w);
+  rpc_conn_write_cb(conn, "\n", 1);
+}
 
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.lba_start = %ld\n", args->lba_start);
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.lba_size = %d\n", args->lba_size);
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.lba_align = %d\n", args->lba_align);
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.lba_random = %d\n", args->lba_random);
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.region_start = %ld\n", args->region_start);
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.region_end = %ld\n", args->region_end);
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.read_percentage = %d\n", args->read_percentage);
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.iops = %d\n", args->iops);
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.io_count = %ld\n", args->io_count);
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.seconds = %d\n", args->seconds);
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "args.qdepth = %d\n", args->qdepth);
+static struct spdk_json_write_ctx* rpc_begin_result(struct rpc_request_t* request)
+{
+  struct spdk_json_write_ctx* w = rpc_begin_message(request->conn);
 
-  //check args
-  assert(args->read_percentage <= 100);
-  assert(args->io_count != 0 || args->seconds != 0);
-  assert(args->seconds < 24*3600ULL);
-  assert(args->lba_size != 0);
-  assert(args->region_start < args->region_end);
-  assert(args->read_percentage >= 0);
-  assert(args->read_percentage <= 100);
-  assert(args->qdepth <= CMD_LOG_DEPTH/2);
+  if (w != NULL)
+  {
+    spdk_json_write_name(w, "id");
+    if (request->id != NULL)
+    {
+      spdk_json_write_val(w, request->id);
+    }
+    else
+    {
+      spdk_json_write_null(w);
+    }
+    spdk_json_write_name(w, "result");
+  }
 
-  // check io size
-  if (args->lba_size*sector_size > ns->ctrlr->max_xfer_size)
+  return w;
+}
+
+static void rpc_end_result(struct rpc_request_t* request, struct spdk_json_write_ctx* w)
+{
+  rpc_end_message(request->conn, w);
+}
+
+static void rpc_send_error(struct rpc_request_t* request, int code, const char* msg)
+{
+  struct spdk_json_write_ctx* w = rpc_begin_message(request->conn);
+
+  if (w != NULL)
   {
-    SPDK_ERRLOG("IO size is larger than max xfer size, %d\n", ns->ctrlr->max_xfer_size);
-    rets->error = 0x0002;  // Invalid Field in Command
-    free(io_ctx);
-    return -2;
+    spdk_json_write_name(w, "id");
+    if (request->id != NULL)
+    {
+      spdk_json_write_val(w, request->id);
+    }
+    else
+    {
+      spdk_json_write_null(w);
+    }
+    spdk_json_write_named_object_begin(w, "error");
+    spdk_json_write_named_int32(w, "code", code);
+    spdk_json_write_named_string(w, "message", msg);
+    spdk_json_write_object_end(w);
+    rpc_end_message(request->conn, w);
   }
+}
 
-  //revise args
-  if (args->io_count == 0)
+// keep the raw json value, parameters are decoded by each method
+static int rpc_decode_val(const struct spdk_json_val* val, void* out)
+{
+  *(const struct spdk_json_val**)out = val;
+  return 0;
+}
+
+
+static void
+rpc_list_all_qpair(struct rpc_request_t* request,
+                   const struct spdk_json_val *params)
+{
+  struct spdk_json_write_ctx *w;
+
+  w = rpc_begin_result(request);
+  if (w == NULL)
   {
-    args->io_count = (unsigned long)-1;
+    return;
   }
-  if (args->seconds == 0 || args->seconds > 24*3600ULL)
+
+  spdk_json_write_array_begin(w);
+  for (int i=0; i<CMD_LOG_QPAIR_COUNT; i++)
   {
-    // run ioworker for 24hr at most
-    args->seconds = 24*3600ULL;
+    // only send valid qpair
+    if (cmd_log_queue_table[i].tail_index < CMD_LOG_DEPTH)
+    {
+      uint32_t outstanding = 0;
+      struct spdk_nvme_qpair* qpair = cmd_log_queue_table[i].qpair;
+
+      if (qpair != NULL)
+      {
+        outstanding = nvme_pcie_qpair_outstanding_count(qpair);
+      }
+
+      // limit blocks in UI
+      if (outstanding > 100)
+      {
+        outstanding = 100;
+      }
+
+      //json: leading 0 means octal, so +1 to avoid it
+      spdk_json_write_uint32(w, i+1 + ((outstanding/4)<<16));
+    }
   }
-  if (args->region_end > nsze)
+  spdk_json_write_array_end(w);
+  rpc_end_result(request, w);
+}
+
+
+// one cmdlog entry in numbers
+static void rpc_write_cmdlog_record(struct spdk_json_write_ctx* w,
+                                    uint32_t index,
+                                    struct cmd_log_entry_t* entry)
+{
+  uint32_t* cmd = (uint32_t*)&entry->cmd;
+  uint32_t* cpl = (uint32_t*)&entry->cpl;
+
+  spdk_json_write_object_begin(w);
+  spdk_json_write_named_uint32(w, "index", index);
+  spdk_json_write_named_uint64(w, "time_us",
+                               entry->time_cmd.tv_sec*US_PER_S + entry->time_cmd.tv_usec);
+  spdk_json_write_named_array_begin(w, "cmd");
+  for (int i=0; i<16; i++)
   {
-    args->region_end = nsze;
+    spdk_json_write_uint32(w, cmd[i]);
   }
+  spdk_json_write_array_end(w);
 
-  //adjust region to start_lba's region
-  args->region_start = ALIGN_UP(args->region_start, args->lba_align);
-  args->region_end = args->region_end-args->lba_size;
-  args->region_end = ALIGN_DOWN(args->region_end, args->lba_align);
-  if (args->lba_start < args->region_start)
+  // completed command
+  if (entry->req == NULL && entry->cpl_latency_us != 0)
   {
-    args->lba_start = args->region_start;
+    spdk_json_write_named_uint32(w, "latency_us", entry->cpl_latency_us);
+    spdk_json_write_named_array_begin(w, "cpl");
+    for (int i=0; i<4; i++)
+    {
+      spdk_json_write_uint32(w, cpl[i]);
+    }
+    spdk_json_write_array_end(w);
   }
-  if (args->io_count < args->qdepth)
+  spdk_json_write_object_end(w);
+}
+
+struct rpc_get_cmdlog_params_t {
+  uint32_t qid;
+  uint32_t offset;
+  uint32_t count;
+};
+
+static const struct spdk_json_object_decoder rpc_get_cmdlog_decoders[] = {
+  {"qid", offsetof(struct rpc_get_cmdlog_params_t, qid), spdk_json_decode_uint32, false},
+  {"offset", offsetof(struct rpc_get_cmdlog_params_t, offset), spdk_json_decode_uint32, true},
+  {"count", offsetof(struct rpc_get_cmdlog_params_t, count), spdk_json_decode_uint32, true},
+};
+
+// params: {"qid": 1, "offset": 0, "count": 100}, records from the newest one
+static void rpc_get_cmdlog_records(struct rpc_request_t* request,
+                                   const struct spdk_json_val *params)
+{
+  struct rpc_get_cmdlog_params_t req = {0, 0, 100};
+  struct spdk_json_write_ctx *w;
+  struct cmd_log_table_t* log_table;
+  uint32_t index;
+
+  if (spdk_json_decode_object(params, rpc_get_cmdlog_decoders,
+                              SPDK_COUNTOF(rpc_get_cmdlog_decoders), &req) ||
+      req.qid >= CMD_LOG_QPAIR_COUNT)
   {
-    args->qdepth = args->io_count;
+    rpc_send_error(request, SPDK_JSONRPC_ERROR_INVALID_PARAMS,
+                   "Invalid parameters");
+    return;
   }
 
-  //init global ctx
-  memset(&gctx, 0, sizeof(gctx));
-  gctx.ns = ns;
-  gctx.qpair = qpair;
-  gctx.sequential_lba = args->lba_start;
-  gctx.io_count_sent = 0;
-  gctx.io_count_cplt = 0;
-  gctx.flag_finish = false;
-  gctx.args = args;
-  gctx.rets = rets;
-  gettimeofday(&test_start, NULL);
-  timeradd_second(&test_start, args->seconds, &gctx.due_time);
-  gctx.io_delay_time.tv_sec = 0;
-  gctx.io_delay_time.tv_usec = args->iops ? US_PER_S/args->iops : 0;
-  timeradd(&test_start, &gctx.io_delay_time, &gctx.io_due_time);
-  timeradd_second(&test_start, 1, &gctx.time_next_sec);
-  gctx.io_count_till_last_sec = 0;
-  gctx.last_sec = 0;
+  log_table = &cmd_log_queue_table[req.qid];
+  w = rpc_begin_result(request);
+  if (w == NULL)
+  {
+    return;
+  }
 
-  // sending the first batch of IOs, all remaining IOs are sending
-  // in callbacks till end
-  for (unsigned int i=0; i<args->qdepth; i++)
+  spdk_json_write_object_begin(w);
+  spdk_json_write_named_uint32(w, "qid", req.qid);
+  spdk_json_write_named_uint32(w, "tail", log_table->tail_index);
+  spdk_json_write_named_uint32(w, "offset", req.offset);
+  spdk_json_write_named_array_begin(w, "records");
+  if (log_table->tail_index < CMD_LOG_DEPTH)
   {
-    io_ctx[i].data_buf_len = args->lba_size * sector_size;
-    io_ctx[i].data_buf = buffer_init(io_ctx[i].data_buf_len, NULL);
-    io_ctx[i].gctx = &gctx;
-    ioworker_send_one(ns, qpair, &io_ctx[i], &gctx);
+    // walk from the newest entry after the offset, only entries of
+    // the current qpair
+    uint32_t valid = cmd_log_valid_count(log_table);
+
+    index = (log_table->tail_index + CMD_LOG_DEPTH -
+             req.offset%CMD_LOG_DEPTH) % CMD_LOG_DEPTH;
+    for (uint32_t i=req.offset; i<MIN(req.offset+req.count, valid); i++)
+    {
+      index = (index == 0) ? CMD_LOG_DEPTH-1 : index-1;
+      rpc_write_cmdlog_record(w, index, &log_table->table[index]);
+    }
   }
+  spdk_json_write_array_end(w);
+  spdk_json_write_object_end(w);
+  rpc_end_result(request, w);
+}
 
-  // callbacks check the end condition and mark the flag. Check the
-  // flag here if it is time to stop the ioworker and return the
-  // statistics data
-  while (gctx.io_count_sent != gctx.io_count_cplt ||
-         gctx.flag_finish != true)
+static void
+rpc_get_cmdlog(struct rpc_request_t* request,
+               const struct spdk_json_val *params)
+{
+  uint32_t qid;
+  size_t count;
+  struct spdk_json_write_ctx *w;
+
+  // structured records in pages, or the legacy text of latest 100 entries
+  if (params != NULL && params->type == SPDK_JSON_VAL_OBJECT_BEGIN)
   {
-    //exceed 30 seconds more than the expected test time, abort ioworker
-    if (ioworker_get_duration(&test_start, &gctx) >
-        args->seconds*1000UL + 30*1000UL)
+    rpc_get_cmdlog_records(request, params);
+    return;
+  }
+
+	if (params == NULL)
+  {
+    SPDK_ERRLOG("no parameters\n");
+    rpc_send_error(request, SPDK_JSONRPC_ERROR_INVALID_PARAMS,
+                   "Invalid parameters");
+    return;
+  }
+
+  if (spdk_json_decode_array(params, spdk_json_decode_uint32,
+                             &qid, 1, &count, sizeof(uint32_t)))
+  {
+    SPDK_ERRLOG("spdk_json_decode_object failed\n");
+    rpc_send_error(request, SPDK_JSONRPC_ERROR_INVALID_PARAMS,
+                   "Invalid parameters");
+    return;
+  }
+
+  if (count != 1)
+  {
+    SPDK_ERRLOG("only 1 parameter required for qid\n");
+    rpc_send_error(request, SPDK_JSONRPC_ERROR_INVALID_PARAMS,
+                   "Invalid parameters");
+    return;
+  }
+
+  qid = qid-1;  //avoid 0 in json
+
+  w = rpc_begin_result(request);
+  if (w == NULL)
+  {
+    return;
+  }
+
+  struct cmd_log_entry_t* table = cmd_log_queue_table[qid].table;
+  uint32_t index = cmd_log_queue_table[qid].tail_index;
+  uint32_t seq = 0;
+
+  // list the cmdlog in reversed order
+  spdk_json_write_array_begin(w);
+
+  // only send the most recent part of cmdlog
+  do
+  {
+    // get the next index to read log
+    if (index == 0)
     {
-      //ioworker timeout
-      SPDK_INFOLOG(SPDK_LOG_NVME, "ioworker timeout, io sent %ld, io cplt %ld, finish %d\n",
-                   gctx.io_count_sent, gctx.io_count_cplt, gctx.flag_finish);
-      ret = -4;
-      break;
+      index = CMD_LOG_DEPTH;
+    }
+    index -= 1;
+
+    // no timeval, empty slot, not print
+    struct timeval time_cmd = table[index].time_cmd;
+    if (timercmp(&time_cmd, &(struct timeval){0}, !=))
+    {
+      // get the string of the op name
+      const char* cmdname = cmd_name(table[index].cmd.opc, qid==0?0:1);
+      uint32_t* cmd = (uint32_t*)&table[index].cmd;
+      spdk_json_write_string_fmt(w, "%ld.%06ld: [cmd: %s] \n"
+                                 "0x%08x, 0x%08x, 0x%08x, 0x%08x\n"
+                                 "0x%08x, 0x%08x, 0x%08x, 0x%08x\n"
+                                 "0x%08x, 0x%08x, 0x%08x, 0x%08x\n"
+                                 "0x%08x, 0x%08x, 0x%08x, 0x%08x",
+                                 time_cmd.tv_sec, time_cmd.tv_usec,
+                                 cmdname,
+                                 cmd[0], cmd[1], cmd[2], cmd[3],
+                                 cmd[4], cmd[5], cmd[6], cmd[7],
+                                 cmd[8], cmd[9], cmd[10], cmd[11],
+                                 cmd[12], cmd[13], cmd[14], cmd[15]);
+
+      if (table[index].cpl_latency_us != 0)
+      {
+        // a completed command, display its cpl cdws
+        struct timeval time_cpl = (struct timeval){0};
+        time_cpl.tv_usec = table[index].cpl_latency_us;
+        timeradd(&time_cmd, &time_cpl, &time_cpl);
+
+        uint32_t* cpl = (uint32_t*)&table[index].cpl;
+        const char* sts = nvme_qpair_get_status_string(&table[index].cpl);
+        spdk_json_write_string_fmt(w, "%ld.%06ld: [cpl: %s] \n"
+                                   "0x%08x, 0x%08x, 0x%08x, 0x%08x\n",
+                                   time_cpl.tv_sec, time_cpl.tv_usec,
+                                   sts,
+                                   cpl[0], cpl[1], cpl[2], cpl[3]);
+      }
+      else
+      {
+        spdk_json_write_string_fmt(w, "not completed ...\n");
+      }
     }
+  } while (seq++ < 100);
 
-    // collect completions
-    spdk_nvme_qpair_process_completions(qpair, 0);
-  }
-
-  // final duration
-  rets->mseconds = ioworker_get_duration(&test_start, &gctx);
+  spdk_json_write_array_end(w);
+  rpc_end_result(request, w);
+}
 
-  //release io ctx
-  for (unsigned int i=0; i<args->qdepth; i++)
-  {
-    buffer_fini(io_ctx[i].data_buf);
-  }
 
-  free(io_ctx);
-  return ret;
-}
+// live metrics of one qpair
+struct rpc_qpair_metrics_t {
+  uint32_t qid;
+  uint32_t outstanding;
+  uint64_t cpl_count;
+  uint64_t error_count;
+  uint32_t cpl_per_second;
+  uint32_t latency_us[5];     // p50, p90, p99, p99.9, max
+  bool ioworker_active;
+  uint64_t ioworker_io_done;
+  uint64_t ioworker_io_target;
+  uint32_t ioworker_elapsed_ms;
+  uint32_t ioworker_seconds;
+};
 
+static const char* rpc_latency_quantiles[5] = {"0.5", "0.9", "0.99", "0.999", "1"};
 
-////module: log
-///////////////////////////////
+// latencies of commands sent in this window are counted in the quantiles
+#define RPC_METRICS_LATENCY_WINDOW_US (10*US_PER_S)
 
-char* log_buf_dump(const char* header, const void* buf, size_t len)
+static int rpc_latency_cmp(const void* a, const void* b)
 {
-  size_t size;
-  FILE* fd = NULL;
-  char* tmpname = "/tmp/pynvme_buf_dump.tmp";
-  static char dump_buf[64*1024];
+  uint32_t x = *(const uint32_t*)a;
+  uint32_t y = *(const uint32_t*)b;
 
-  // dump buf is limited
-  assert(len <= 4096);
+  return (x > y) - (x < y);
+}
 
-  errno = 0;
-  fd = fopen(tmpname, "w+");
-  if (fd == NULL)
+// collect metrics of all valid qpairs, return the number of qpairs. The
+// rate is calculated since the last metrics collected with the same base.
+static uint32_t rpc_collect_metrics(struct rpc_metrics_base_t* base,
+                                    struct rpc_qpair_metrics_t* metrics)
+{
+  static uint32_t latency[CMD_LOG_DEPTH];
+  uint32_t count = 0;
+  uint64_t now_tsc = spdk_get_ticks();
+  uint64_t now_us;
+  struct timeval now;
+
+  gettimeofday(&now, NULL);
+  now_us = now.tv_sec*US_PER_S + now.tv_usec;
+  for (uint32_t i=0; i<CMD_LOG_QPAIR_COUNT; i++)
   {
-    SPDK_WARNLOG("fopen: %s\n", strerror(errno));
-    return NULL;
-  }
+    struct cmd_log_table_t* log_table = &cmd_log_queue_table[i];
+    struct rpc_qpair_metrics_t* m = &metrics[count];
+    uint32_t completed = 0;
 
-  spdk_log_dump(fd, header, buf, len);
+    if (log_table->tail_index >= CMD_LOG_DEPTH)
+    {
+      // invalid qpair
+      base->tsc[i] = 0;
+      continue;
+    }
 
-  // get file size
-  size = ftell(fd);
+    memset(m, 0, sizeof(*m));
+    m->qid = i;
+    m->cpl_count = log_table->cpl_count;
+    m->error_count = log_table->error_count;
 
-  errno = 0;
-  if (-1 == fseek(fd, 0, SEEK_SET))
-  {
-    SPDK_WARNLOG("lseek: %s\n", strerror(errno));
-    return NULL;
-  }
+    // scan the cmdlog of this qpair for outstanding commands and recent
+    // latencies, from the newest entry. Latencies of old commands are not
+    // counted, so an idle qpair has no latency.
+    for (uint32_t j=0, index=log_table->tail_index;
+         j<cmd_log_valid_count(log_table); j++)
+    {
+      struct cmd_log_entry_t* entry;
+      uint64_t cmd_us;
 
-  // read the data from temporary file
-  errno=0;
-  if (fread(dump_buf, size, 1, fd) == 0)
-  {
-    SPDK_WARNLOG("read: %s\n", strerror(errno));
-    return NULL;
+      index = (index == 0) ? CMD_LOG_DEPTH-1 : index-1;
+      entry = &log_table->table[index];
+      cmd_us = entry->time_cmd.tv_sec*US_PER_S + entry->time_cmd.tv_usec;
+      if (entry->req != NULL)
+      {
+        m->outstanding++;
+      }
+      else if (entry->cpl_latency_us != 0 &&
+               cmd_us+RPC_METRICS_LATENCY_WINDOW_US > now_us)
+      {
+        latency[completed++] = entry->cpl_latency_us;
+      }
+    }
+    if (completed != 0)
+    {
+      qsort(latency, completed, sizeof(uint32_t), rpc_latency_cmp);
+      m->latency_us[0] = latency[completed*50/100];
+      m->latency_us[1] = latency[completed*90/100];
+      m->latency_us[2] = latency[completed*99/100];
+      m->latency_us[3] = latency[completed*999/1000];
+      m->latency_us[4] = latency[completed-1];
+    }
+
+    // completion rate since the last call
+    if (base->tsc[i] != 0 && now_tsc > base->tsc[i] && m->cpl_count >= base->cpl_count[i])
+    {
+      m->cpl_per_second = (m->cpl_count-base->cpl_count[i])*spdk_get_ticks_hz()/(now_tsc-base->tsc[i]);
+    }
+    base->cpl_count[i] = m->cpl_count;
+    base->tsc[i] = now_tsc;
+
+    // ioworker progress
+    if (log_table->ioworker_start_us != 0)
+    {
+      m->ioworker_active = true;
+      m->ioworker_io_done = m->cpl_count - log_table->ioworker_cpl_base;
+      m->ioworker_io_target = log_table->ioworker_io_target;
+      m->ioworker_seconds = log_table->ioworker_seconds;
+      m->ioworker_elapsed_ms = (now.tv_sec*US_PER_S + now.tv_usec -
+                                log_table->ioworker_start_us)/1000;
+    }
+
+    count++;
   }
 
-  fclose(fd);
-  return dump_buf;
+  return count;
 }
 
-void log_cmd_dump(struct spdk_nvme_qpair* qpair, size_t count)
+static uint64_t rpc_crc32_table_bytes(void)
 {
-  uint32_t dump_count = count;
-  uint16_t qid = qpair->id;
-  struct cmd_log_table_t* table = &cmd_log_queue_table[qid];
-  uint32_t index = cmd_log_queue_table[qid].tail_index;
-  uint32_t seq = 0;
-
-  assert(qid < CMD_LOG_QPAIR_COUNT);
-  assert(table != NULL);
-
-  if (count == 0 || count > CMD_LOG_DEPTH)
+  if (g_driver_csum_table_ptr == NULL)
   {
-    dump_count = CMD_LOG_DEPTH;
+    return 0;
   }
 
-  // cmdlog is NOT SQ/CQ. cmdlog keeps CMD/CPL for script test debug purpose
-  SPDK_NOTICELOG("dump qpair %d, latest tail in cmdlog: %d\n",
-                 qid, table->tail_index);
+  return g_driver_table_size + sizeof(struct crc32_gen_table_t) +
+    crc32_chunk_count(g_driver_table_size)*sizeof(uint32_t);
+}
 
-  // only send the most recent part of cmdlog
-  while (seq++ < dump_count)
+static void rpc_write_metrics(struct spdk_json_write_ctx *w,
+                              struct rpc_metrics_base_t* base)
+{
+  uint32_t count;
+  buffer_pool_stats pool;
+  struct rpc_qpair_metrics_t metrics[CMD_LOG_QPAIR_COUNT];
+
+  count = rpc_collect_metrics(base, metrics);
+  buffer_pool_get_stats(&pool);
+
+  spdk_json_write_object_begin(w);
+  spdk_json_write_named_uint64(w, "checksum_table_bytes", rpc_crc32_table_bytes());
+  spdk_json_write_named_uint64(w, "buffer_bytes_in_use", pool.bytes_in_use);
+  spdk_json_write_named_uint64(w, "buffer_bytes_cached", pool.bytes_cached);
+  spdk_json_write_named_array_begin(w, "qpairs");
+  for (uint32_t i=0; i<count; i++)
   {
-    // get the next index to read log
-    if (index == 0)
+    struct rpc_qpair_metrics_t* m = &metrics[i];
+
+    spdk_json_write_object_begin(w);
+    spdk_json_write_named_uint32(w, "qid", m->qid);
+    spdk_json_write_named_uint32(w, "outstanding", m->outstanding);
+    spdk_json_write_named_uint64(w, "completions", m->cpl_count);
+    spdk_json_write_named_uint32(w, "completions_per_second", m->cpl_per_second);
+    spdk_json_write_named_uint64(w, "errors", m->error_count);
+    spdk_json_write_named_object_begin(w, "latency_us");
+    for (uint32_t j=0; j<5; j++)
     {
-      index = CMD_LOG_DEPTH;
+      spdk_json_write_named_uint32(w, rpc_latency_quantiles[j], m->latency_us[j]);
     }
-    index -= 1;
-
-    // no timeval, empty slot, not print
-    struct timeval tv = table->table[index].time_cmd;
-    if (timercmp(&tv, &(struct timeval){0}, !=))
+    spdk_json_write_object_end(w);
+    if (m->ioworker_active)
     {
-      struct tm* time;
-      char tmbuf[64];
-
-      //cmd part
-      tv = table->table[index].time_cmd;
-      time = localtime(&tv.tv_sec);
-      strftime(tmbuf, sizeof(tmbuf), "%Y-%m-%d %H:%M:%S", time);
-      SPDK_NOTICELOG("index %d, %s.%06ld\n", index, tmbuf, tv.tv_usec);
-      nvme_qpair_print_command(qpair, &table->table[index].cmd);
-
-      //cpl part
-      tv.tv_usec = table->table[index].cpl_latency_us;
-      timeradd(&table->table[index].time_cmd, &tv, &tv);
-      time = localtime(&tv.tv_sec);
-      strftime(tmbuf, sizeof(tmbuf), "%Y-%m-%d %H:%M:%S", time);
-      SPDK_NOTICELOG("index %d, %s.%06ld\n", index, tmbuf, tv.tv_usec);
-      nvme_qpair_print_completion(qpair, &table->table[index].cpl);
+      spdk_json_write_named_object_begin(w, "ioworker");
+      spdk_json_write_named_uint64(w, "io_count", m->ioworker_io_done);
+      spdk_json_write_named_uint64(w, "io_count_target", m->ioworker_io_target);
+      spdk_json_write_named_uint32(w, "elapsed_ms", m->ioworker_elapsed_ms);
+      spdk_json_write_named_uint32(w, "seconds_target", m->ioworker_seconds);
+      spdk_json_write_object_end(w);
     }
+    spdk_json_write_object_end(w);
   }
+  spdk_json_write_array_end(w);
+  spdk_json_write_object_end(w);
 }
 
-void log_cmd_dump_admin(struct spdk_nvme_ctrlr* ctrlr, size_t count)
+static void
+rpc_get_metrics(struct rpc_request_t* request,
+                const struct spdk_json_val *params)
 {
-  log_cmd_dump(ctrlr->adminq, count);
+  struct spdk_json_write_ctx *w;
+
+  w = rpc_begin_result(request);
+  if (w == NULL)
+  {
+    return;
+  }
+
+  rpc_write_metrics(w, &request->conn->metrics_base);
+  rpc_end_result(request, w);
 }
 
 
-////module: commands name, SPDK
-///////////////////////////////
+#define RPC_METRICS_TEXT_SIZE (64*1024)
 
-static const char *
-admin_opc_name(uint8_t opc)
-{
-	switch (opc) {
-	case SPDK_NVME_OPC_DELETE_IO_SQ:
-		return "Delete I/O Submission Queue";
-	case SPDK_NVME_OPC_CREATE_IO_SQ:
-		return "Create I/O Submission Queue";
-	case SPDK_NVME_OPC_GET_LOG_PAGE:
-		return "Get Log Page";
-	case SPDK_NVME_OPC_DELETE_IO_CQ:
-		return "Delete I/O Completion Queue";
-	case SPDK_NVME_OPC_CREATE_IO_CQ:
-		return "Create I/O Completion Queue";
-	case SPDK_NVME_OPC_IDENTIFY:
-		return "Identify";
-	case SPDK_NVME_OPC_ABORT:
-		return "Abort";
-	case SPDK_NVME_OPC_SET_FEATURES:
-		return "Set Features";
-	case SPDK_NVME_OPC_GET_FEATURES:
-		return "Get Features";
-	case SPDK_NVME_OPC_ASYNC_EVENT_REQUEST:
-		return "Asynchronous Event Request";
-	case SPDK_NVME_OPC_NS_MANAGEMENT:
-		return "Namespace Management";
-	case SPDK_NVME_OPC_FIRMWARE_COMMIT:
-		return "Firmware Commit";
-	case SPDK_NVME_OPC_FIRMWARE_IMAGE_DOWNLOAD:
-		return "Firmware Image Download";
-	case SPDK_NVME_OPC_DEVICE_SELF_TEST:
-		return "Device Self-test";
-	case SPDK_NVME_OPC_NS_ATTACHMENT:
-		return "Namespace Attachment";
-	case SPDK_NVME_OPC_KEEP_ALIVE:
-		return "Keep Alive";
-	case SPDK_NVME_OPC_DIRECTIVE_SEND:
-		return "Directive Send";
-	case SPDK_NVME_OPC_DIRECTIVE_RECEIVE:
-		return "Directive Receive";
-	case SPDK_NVME_OPC_VIRTUALIZATION_MANAGEMENT:
-		return "Virtualization Management";
-	case SPDK_NVME_OPC_NVME_MI_SEND:
-		return "NVMe-MI Send";
-	case SPDK_NVME_OPC_NVME_MI_RECEIVE:
-		return "NVMe-MI Receive";
-	case SPDK_NVME_OPC_DOORBELL_BUFFER_CONFIG:
-		return "Doorbell Buffer Config";
-	case SPDK_NVME_OPC_FORMAT_NVM:
-		return "Format NVM";
-	case SPDK_NVME_OPC_SECURITY_SEND:
-		return "Security Send";
-	case SPDK_NVME_OPC_SECURITY_RECEIVE:
-		return "Security Receive";
-	case SPDK_NVME_OPC_SANITIZE:
-		return "Sanitize";
-	default:
-		if (opc >= 0xC0) {
-			return "Vendor specific";
-		}
-		return "Unknown";
-	}
-}
+#define rpc_metrics_printf(buf, len, ...) \
+  len += snprintf(buf+len, len<RPC_METRICS_TEXT_SIZE ? RPC_METRICS_TEXT_SIZE-len : 0, __VA_ARGS__)
 
-static const char *
-io_opc_name(uint8_t opc)
+// the same metrics in OpenMetrics text format, for prometheus exporters
+static void
+rpc_get_metrics_text(struct rpc_request_t* request,
+                     const struct spdk_json_val *params)
 {
-	switch (opc) {
-	case SPDK_NVME_OPC_FLUSH:
-		return "Flush";
-	case SPDK_NVME_OPC_WRITE:
-		return "Write";
-	case SPDK_NVME_OPC_READ:
-		return "Read";
-	case SPDK_NVME_OPC_WRITE_UNCORRECTABLE:
-		return "Write Uncorrectable";
-	case SPDK_NVME_OPC_COMPARE:
-		return "Compare";
-	case SPDK_NVME_OPC_WRITE_ZEROES:
-		return "Write Zeroes";
-	case SPDK_NVME_OPC_DATASET_MANAGEMENT:
-		return "Dataset Management";
-	case SPDK_NVME_OPC_RESERVATION_REGISTER:
-		return "Reservation Register";
-	case SPDK_NVME_OPC_RESERVATION_REPORT:
-		return "Reservation Report";
-	case SPDK_NVME_OPC_RESERVATION_ACQUIRE:
-		return "Reservation Acquire";
-	case SPDK_NVME_OPC_RESERVATION_RELEASE:
-		return "Reservation Release";
-	default:
-		if (opc >= 0x80) {
-			return "Vendor specific";
-		}
-		return "Unknown command";
-	}
-}
+  uint32_t count;
+  size_t len = 0;
+  char* buf;
+  struct spdk_json_write_ctx *w;
+  struct rpc_qpair_metrics_t metrics[CMD_LOG_QPAIR_COUNT];
 
-const char* cmd_name(uint8_t opc, int set)
-{
-  if (set == 0)
+  buf = malloc(RPC_METRICS_TEXT_SIZE);
+  if (buf == NULL)
   {
-    return admin_opc_name(opc);
+    rpc_send_error(request, SPDK_JSONRPC_ERROR_INTERNAL_ERROR,
+                   "no memory");
+    return;
+  }
+
+  count = rpc_collect_metrics(&request->conn->metrics_base, metrics);
+  rpc_metrics_printf(buf, len, "# TYPE pynvme_checksum_table_bytes gauge\n"
+                     "pynvme_checksum_table_bytes %lu\n", rpc_crc32_table_bytes());
+
+  rpc_metrics_printf(buf, len, "# TYPE pynvme_qpair_outstanding gauge\n");
+  for (uint32_t i=0; i<count; i++)
+  {
+    rpc_metrics_printf(buf, len, "pynvme_qpair_outstanding{qid=\"%u\"} %u\n",
+                       metrics[i].qid, metrics[i].outstanding);
+  }
+  rpc_metrics_printf(buf, len, "# TYPE pynvme_qpair_completions counter\n");
+  for (uint32_t i=0; i<count; i++)
+  {
+    rpc_metrics_printf(buf, len, "pynvme_qpair_completions_total{qid=\"%u\"} %lu\n",
+                       metrics[i].qid, metrics[i].cpl_count);
+  }
+  rpc_metrics_printf(buf, len, "# TYPE pynvme_qpair_completions_per_second gauge\n");
+  for (uint32_t i=0; i<count; i++)
+  {
+    rpc_metrics_printf(buf, len, "pynvme_qpair_completions_per_second{qid=\"%u\"} %u\n",
+                       metrics[i].qid, metrics[i].cpl_per_second);
+  }
+  rpc_metrics_printf(buf, len, "# TYPE pynvme_qpair_errors counter\n");
+  for (uint32_t i=0; i<count; i++)
+  {
+    rpc_metrics_printf(buf, len, "pynvme_qpair_errors_total{qid=\"%u\"} %lu\n",
+                       metrics[i].qid, metrics[i].error_count);
+  }
+  rpc_metrics_printf(buf, len, "# TYPE pynvme_qpair_latency_us summary\n");
+  for (uint32_t i=0; i<count; i++)
+  {
+    for (uint32_t j=0; j<5; j++)
+    {
+      rpc_metrics_printf(buf, len, "pynvme_qpair_latency_us{qid=\"%u\",quantile=\"%s\"} %u\n",
+                         metrics[i].qid, rpc_latency_quantiles[j], metrics[i].latency_us[j]);
+    }
+  }
+  rpc_metrics_printf(buf, len, "# TYPE pynvme_ioworker_io_count gauge\n");
+  for (uint32_t i=0; i<count; i++)
+  {
+    if (metrics[i].ioworker_active)
+    {
+      rpc_metrics_printf(buf, len, "pynvme_ioworker_io_count{qid=\"%u\"} %lu\n",
+                         metrics[i].qid, metrics[i].ioworker_io_done);
+    }
   }
-  else if (set == 1)
+  rpc_metrics_printf(buf, len, "# TYPE pynvme_ioworker_elapsed_ms gauge\n");
+  for (uint32_t i=0; i<count; i++)
   {
-    return io_opc_name(opc);
+    if (metrics[i].ioworker_active)
+    {
+      rpc_metrics_printf(buf, len, "pynvme_ioworker_elapsed_ms{qid=\"%u\"} %u\n",
+                         metrics[i].qid, metrics[i].ioworker_elapsed_ms);
+    }
   }
-  else
+  rpc_metrics_printf(buf, len, "# EOF\n");
+
+  w = rpc_begin_result(request);
+  if (w != NULL)
   {
-    return "Unknown command set";
+    spdk_json_write_string(w, buf);
+    rpc_end_result(request, w);
   }
+  free(buf);
 }
 
 
-////rpc
-///////////////////////////////
+struct rpc_subscribe_params_t {
+  uint32_t qid;
+  uint32_t interval_ms;
+  bool cmdlog;
+  bool metrics;
+};
 
-static void* rpc_server(void* args)
-{
-  int rc = 0;
+static const struct spdk_json_object_decoder rpc_subscribe_decoders[] = {
+  {"qid", offsetof(struct rpc_subscribe_params_t, qid), spdk_json_decode_uint32, true},
+  {"interval_ms", offsetof(struct rpc_subscribe_params_t, interval_ms), spdk_json_decode_uint32, true},
+  {"cmdlog", offsetof(struct rpc_subscribe_params_t, cmdlog), spdk_json_decode_bool, true},
+  {"metrics", offsetof(struct rpc_subscribe_params_t, metrics), spdk_json_decode_bool, true},
+};
 
-  SPDK_DEBUGLOG(SPDK_LOG_NVME, "starting rpc server ...\n");
+// params: {"qid": 1, "interval_ms": 100, "cmdlog": true, "metrics": true}
+// then the server pushes notifications "cmdlog" and "metrics" to the client.
+// "dropped" of cmdlog is the number of records overwritten before pushed.
+static void
+rpc_subscribe(struct rpc_request_t* request,
+              const struct spdk_json_val *params)
+{
+  struct rpc_conn_t* conn = request->conn;
+  struct rpc_subscribe_params_t req = {0, 100, true, true};
+  struct spdk_json_write_ctx *w;
 
-  // start the rpc
-  rc = spdk_rpc_listen("/var/tmp/pynvme.sock");
-  if (rc != 0)
+  if ((params != NULL &&
+       spdk_json_decode_object(params, rpc_subscribe_decoders,
+                               SPDK_COUNTOF(rpc_subscribe_decoders), &req)) ||
+      req.qid >= CMD_LOG_QPAIR_COUNT)
   {
-    SPDK_ERRLOG("rpc fail to get the sock \n");
-    return NULL;
+    rpc_send_error(request, SPDK_JSONRPC_ERROR_INVALID_PARAMS,
+                   "Invalid parameters");
+    return;
   }
 
-  // pynvme run as root, but rpc client no need
-  chmod("/var/tmp/pynvme.sock", 0777);
+  // push commands sent after now
+  conn->subscribed = true;
+  conn->sub_qid = req.qid;
+  conn->sub_cmdlog = req.cmdlog;
+  conn->sub_metrics = req.metrics;
+  conn->sub_interval_ms = MAX(req.interval_ms, RPC_SUBSCRIBE_MIN_MS);
+  conn->sub_next_ms = rpc_now_ms() + conn->sub_interval_ms;
+  conn->sub_count = cmd_log_queue_table[req.qid].cmd_count;
+
+  w = rpc_begin_result(request);
+  if (w != NULL)
+  {
+    spdk_json_write_bool(w, true);
+    rpc_end_result(request, w);
+  }
+}
 
-  spdk_rpc_set_state(SPDK_RPC_STARTUP);
+static void
+rpc_unsubscribe(struct rpc_request_t* request,
+                const struct spdk_json_val *params)
+{
+  struct spdk_json_write_ctx *w;
 
-  while(1)
+  request->conn->subscribed = false;
+  w = rpc_begin_result(request);
+  if (w != NULL)
   {
-    spdk_rpc_accept();
-    usleep(100000);
+    spdk_json_write_bool(w, true);
+    rpc_end_result(request, w);
   }
-
-  spdk_rpc_close();
 }
 
+static const struct rpc_method_t rpc_methods[] = {
+  {"list_all_qpair", rpc_list_all_qpair},
+  {"get_cmdlog", rpc_get_cmdlog},
+  {"get_metrics", rpc_get_metrics},
+  {"get_metrics_text", rpc_get_metrics_text},
+  {"subscribe", rpc_subscribe},
+  {"unsubscribe", rpc_unsubscribe},
+};
 
-static void
-rpc_list_all_qpair(struct spdk_jsonrpc_request *request,
-                   const struct spdk_json_val *params)
+static void rpc_push_cmdlog(struct rpc_conn_t* conn)
 {
+  struct cmd_log_table_t* log_table = &cmd_log_queue_table[conn->sub_qid];
+  uint64_t count = log_table->cmd_count;
+  uint64_t dropped = 0;
   struct spdk_json_write_ctx *w;
+  struct timeval now;
+
+  // qpair is deleted, or no new commands
+  if (log_table->tail_index >= CMD_LOG_DEPTH || count == conn->sub_count)
+  {
+    return;
+  }
+
+  if (count < conn->sub_count)
+  {
+    // qpair is created again, push from its first command
+    conn->sub_count = 0;
+  }
+
+  if (count - conn->sub_count > CMD_LOG_DEPTH)
+  {
+    // the subscriber is lapped, these entries are overwritten
+    dropped = count - conn->sub_count - CMD_LOG_DEPTH;
+    conn->sub_count += dropped;
+  }
 
-  w = spdk_jsonrpc_begin_result(request);
+  w = rpc_begin_message(conn);
   if (w == NULL)
   {
     return;
   }
 
-  spdk_json_write_array_begin(w);
-  for (int i=0; i<CMD_LOG_QPAIR_COUNT; i++)
+  gettimeofday(&now, NULL);
+  spdk_json_write_named_string(w, "method", "cmdlog");
+  spdk_json_write_named_object_begin(w, "params");
+  spdk_json_write_named_uint32(w, "qid", conn->sub_qid);
+  spdk_json_write_named_uint64(w, "dropped", dropped);
+  spdk_json_write_named_array_begin(w, "records");
+  while (conn->sub_count != count)
   {
-    // only send valid qpair
-    if (cmd_log_queue_table[i].tail_index < CMD_LOG_DEPTH)
+    uint32_t index = conn->sub_count % CMD_LOG_DEPTH;
+    struct cmd_log_entry_t* entry = &log_table->table[index];
+
+    // wait the completion of the command in the next push, but do not
+    // block the stream by a lost command
+    if (entry->req != NULL && now.tv_sec - entry->time_cmd.tv_sec < 2)
     {
-      uint32_t outstanding = 0;
-      struct spdk_nvme_qpair* qpair = cmd_log_queue_table[i].qpair;
+      break;
+    }
 
-      if (qpair != NULL)
+    rpc_write_cmdlog_record(w, index, entry);
+    conn->sub_count++;
+  }
+  spdk_json_write_array_end(w);
+  spdk_json_write_object_end(w);
+  rpc_end_message(conn, w);
+}
+
+static void rpc_push_metrics(struct rpc_conn_t* conn)
+{
+  struct spdk_json_write_ctx *w = rpc_begin_message(conn);
+
+  if (w != NULL)
+  {
+    spdk_json_write_named_string(w, "method", "metrics");
+    spdk_json_write_name(w, "params");
+    rpc_write_metrics(w, &conn->metrics_base);
+    rpc_end_message(conn, w);
+  }
+}
+
+// push to subscribers in time, return the time to wait for the next push
+static int rpc_push_all(void)
+{
+  int timeout = -1;
+  uint64_t now = rpc_now_ms();
+
+  for (int i=0; i<RPC_MAX_CONNS; i++)
+  {
+    struct rpc_conn_t* conn = g_rpc_conns[i];
+
+    if (conn == NULL || !conn->subscribed)
+    {
+      continue;
+    }
+
+    if (now >= conn->sub_next_ms)
+    {
+      if (conn->sub_cmdlog)
       {
-        outstanding = nvme_pcie_qpair_outstanding_count(qpair);
+        rpc_push_cmdlog(conn);
       }
-
-      // limit blocks in UI
-      if (outstanding > 100)
+      if (conn->sub_metrics)
       {
-        outstanding = 100;
+        rpc_push_metrics(conn);
       }
+      rpc_conn_flush(conn);
+      conn->sub_next_ms = now + conn->sub_interval_ms;
+    }
 
-      //json: leading 0 means octal, so +1 to avoid it
-      spdk_json_write_uint32(w, i+1 + ((outstanding/4)<<16));
+    if (timeout < 0 || conn->sub_next_ms-now < (uint64_t)timeout)
+    {
+      timeout = conn->sub_next_ms-now;
     }
   }
-  spdk_json_write_array_end(w);
-  spdk_jsonrpc_end_result(request, w);
+
+  return timeout;
 }
-SPDK_RPC_REGISTER("list_all_qpair", rpc_list_all_qpair, SPDK_RPC_STARTUP | SPDK_RPC_RUNTIME)
 
+struct rpc_request_fields_t {
+  const struct spdk_json_val* jsonrpc;
+  const struct spdk_json_val* method;
+  const struct spdk_json_val* params;
+  const struct spdk_json_val* id;
+};
 
-static void
-rpc_get_cmdlog(struct spdk_jsonrpc_request *request,
-               const struct spdk_json_val *params)
+static const struct spdk_json_object_decoder rpc_request_decoders[] = {
+  {"jsonrpc", offsetof(struct rpc_request_fields_t, jsonrpc), rpc_decode_val, true},
+  {"method", offsetof(struct rpc_request_fields_t, method), rpc_decode_val, false},
+  {"params", offsetof(struct rpc_request_fields_t, params), rpc_decode_val, true},
+  {"id", offsetof(struct rpc_request_fields_t, id), rpc_decode_val, true},
+};
+
+static void rpc_handle_request(struct rpc_conn_t* conn, struct spdk_json_val* values)
 {
-  uint32_t qid;
-  size_t count;
-  struct spdk_json_write_ctx *w;
+  struct rpc_request_fields_t fields = {NULL, NULL, NULL, NULL};
+  struct rpc_request_t request = {conn, NULL};
 
-	if (params == NULL)
+  if (values[0].type != SPDK_JSON_VAL_OBJECT_BEGIN ||
+      spdk_json_decode_object(values, rpc_request_decoders,
+                              SPDK_COUNTOF(rpc_request_decoders), &fields) ||
+      fields.method->type != SPDK_JSON_VAL_STRING)
   {
-    SPDK_ERRLOG("no parameters\n");
-    spdk_jsonrpc_send_error_response(request, SPDK_JSONRPC_ERROR_INVALID_PARAMS,
-                                     "Invalid parameters");
+    rpc_send_error(&request, SPDK_JSONRPC_ERROR_INVALID_REQUEST, "Invalid request");
     return;
   }
 
-  if (spdk_json_decode_array(params, spdk_json_decode_uint32,
-                             &qid, 1, &count, sizeof(uint32_t)))
+  request.id = fields.id;
+  for (size_t i=0; i<SPDK_COUNTOF(rpc_methods); i++)
   {
-    SPDK_ERRLOG("spdk_json_decode_object failed\n");
-    spdk_jsonrpc_send_error_response(request, SPDK_JSONRPC_ERROR_INVALID_PARAMS,
-                                     "Invalid parameters");
-    return;
+    if (spdk_json_strequal(fields.method, rpc_methods[i].name))
+    {
+      rpc_methods[i].func(&request, fields.params);
+      return;
+    }
   }
 
-  if (count != 1)
+  rpc_send_error(&request, SPDK_JSONRPC_ERROR_METHOD_NOT_FOUND, "Method not found");
+}
+
+static void rpc_conn_close(struct rpc_conn_t* conn)
+{
+  for (int i=0; i<RPC_MAX_CONNS; i++)
   {
-    SPDK_ERRLOG("only 1 parameter required for qid\n");
-    spdk_jsonrpc_send_error_response(request, SPDK_JSONRPC_ERROR_INVALID_PARAMS,
-                                     "Invalid parameters");
-    return;
+    if (g_rpc_conns[i] == conn)
+    {
+      g_rpc_conns[i] = NULL;
+    }
   }
 
-  qid = qid-1;  //avoid 0 in json
+  epoll_ctl(g_rpc_epoll_fd, EPOLL_CTL_DEL, conn->fd, NULL);
+  close(conn->fd);
+  free(conn->send_buf);
+  free(conn);
+}
 
-  w = spdk_jsonrpc_begin_result(request);
-  if (w == NULL)
+static void rpc_conn_accept(int listen_fd)
+{
+  int fd;
+  struct epoll_event event;
+  struct rpc_conn_t* conn;
+
+  fd = accept(listen_fd, NULL, NULL);
+  if (fd < 0)
   {
     return;
   }
+  fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK);
 
-  struct cmd_log_entry_t* table = cmd_log_queue_table[qid].table;
-  uint32_t index = cmd_log_queue_table[qid].tail_index;
-  uint32_t seq = 0;
+  for (int i=0; i<RPC_MAX_CONNS; i++)
+  {
+    if (g_rpc_conns[i] == NULL)
+    {
+      conn = calloc(1, sizeof(struct rpc_conn_t));
+      if (conn != NULL)
+      {
+        conn->send_buf = malloc(RPC_SEND_BUF_SIZE);
+        if (conn->send_buf == NULL)
+        {
+          free(conn);
+          break;
+        }
+
+        conn->fd = fd;
+        event.events = EPOLLIN;
+        event.data.ptr = conn;
+        epoll_ctl(g_rpc_epoll_fd, EPOLL_CTL_ADD, fd, &event);
+        g_rpc_conns[i] = conn;
+        return;
+      }
+      break;
+    }
+  }
 
-  // list the cmdlog in reversed order
-  spdk_json_write_array_begin(w);
+  SPDK_NOTICELOG("too many rpc clients\n");
+  close(fd);
+}
 
-  // only send the most recent part of cmdlog
-  do
+static void rpc_conn_recv(struct rpc_conn_t* conn)
+{
+  static struct spdk_json_val values[RPC_MAX_VALUES];
+  ssize_t n;
+
+  n = recv(conn->fd, conn->recv_buf+conn->recv_len,
+           RPC_RECV_BUF_SIZE-conn->recv_len, MSG_DONTWAIT);
+  if (n <= 0)
   {
-    // get the next index to read log
-    if (index == 0)
+    if (n == 0 || (errno != EAGAIN && errno != EWOULDBLOCK))
     {
-      index = CMD_LOG_DEPTH;
+      conn->closing = true;
     }
-    index -= 1;
+    return;
+  }
+  conn->recv_len += n;
 
-    // no timeval, empty slot, not print
-    struct timeval time_cmd = table[index].time_cmd;
-    if (timercmp(&time_cmd, &(struct timeval){0}, !=))
+  // handle all complete requests in the buffer
+  while (conn->recv_len != 0 && !conn->closing)
+  {
+    void* end = NULL;
+    size_t used;
+
+    n = spdk_json_parse(conn->recv_buf, conn->recv_len, NULL, 0, &end, 0);
+    if (n == SPDK_JSON_PARSE_INCOMPLETE)
     {
-      // get the string of the op name
-      const char* cmdname = cmd_name(table[index].cmd.opc, qid==0?0:1);
-      uint32_t* cmd = (uint32_t*)&table[index].cmd;
-      spdk_json_write_string_fmt(w, "%ld.%06ld: [cmd: %s] \n"
-                                 "0x%08x, 0x%08x, 0x%08x, 0x%08x\n"
-                                 "0x%08x, 0x%08x, 0x%08x, 0x%08x\n"
-                                 "0x%08x, 0x%08x, 0x%08x, 0x%08x\n"
-                                 "0x%08x, 0x%08x, 0x%08x, 0x%08x",
-                                 time_cmd.tv_sec, time_cmd.tv_usec,
-                                 cmdname,
-                                 cmd[0], cmd[1], cmd[2], cmd[3],
-                                 cmd[4], cmd[5], cmd[6], cmd[7],
-                                 cmd[8], cmd[9], cmd[10], cmd[11],
-                                 cmd[12], cmd[13], cmd[14], cmd[15]);
+      if (conn->recv_len == RPC_RECV_BUF_SIZE)
+      {
+        // request is too large
+        conn->closing = true;
+      }
+      break;
+    }
 
-      if (table[index].cpl_latency_us != 0)
+    if (n < 0 || n > RPC_MAX_VALUES)
+    {
+      struct rpc_request_t request = {conn, NULL};
+      rpc_send_error(&request, SPDK_JSONRPC_ERROR_PARSE_ERROR, "Parse error");
+      conn->closing = true;
+      break;
+    }
+
+    spdk_json_parse(conn->recv_buf, conn->recv_len, values, RPC_MAX_VALUES,
+                    &end, SPDK_JSON_PARSE_FLAG_DECODE_IN_PLACE);
+    rpc_handle_request(conn, values);
+
+    // keep the remaining data for the next request
+    used = (char*)end - conn->recv_buf;
+    memmove(conn->recv_buf, conn->recv_buf+used, conn->recv_len-used);
+    conn->recv_len -= used;
+  }
+
+  rpc_conn_flush(conn);
+}
+
+static void* rpc_server(void* args)
+{
+  int listen_fd;
+  const char* sock_path = (const char*)args;
+  struct sockaddr_un addr;
+  struct epoll_event event;
+  struct epoll_event events[RPC_MAX_CONNS+1];
+
+  SPDK_DEBUGLOG(SPDK_LOG_NVME, "starting rpc server on %s ...\n", sock_path);
+
+  // start the rpc
+  memset(&addr, 0, sizeof(addr));
+  addr.sun_family = AF_UNIX;
+  snprintf(addr.sun_path, sizeof(addr.sun_path), "%s", sock_path);
+  unlink(sock_path);
+  listen_fd = socket(AF_UNIX, SOCK_STREAM|SOCK_NONBLOCK|SOCK_CLOEXEC, 0);
+  if (listen_fd < 0 ||
+      bind(listen_fd, (struct sockaddr*)&addr, sizeof(addr)) != 0 ||
+      listen(listen_fd, RPC_MAX_CONNS) != 0)
+  {
+    SPDK_ERRLOG("rpc fail to get the sock \n");
+    return NULL;
+  }
+
+  // pynvme run as root, but rpc client no need
+  chmod(sock_path, 0777);
+
+  g_rpc_epoll_fd = epoll_create1(EPOLL_CLOEXEC);
+  event.events = EPOLLIN;
+  event.data.ptr = NULL;
+  epoll_ctl(g_rpc_epoll_fd, EPOLL_CTL_ADD, listen_fd, &event);
+
+  // requests are handled as soon as they arrive, and the wait timeout is
+  // the time of the next push to subscribers
+  while(1)
+  {
+    int n = epoll_wait(g_rpc_epoll_fd, events, RPC_MAX_CONNS+1, rpc_push_all());
+
+    for (int i=0; i<n; i++)
+    {
+      struct rpc_conn_t* conn = events[i].data.ptr;
+
+      if (conn == NULL)
       {
-        // a completed command, display its cpl cdws
-        struct timeval time_cpl = (struct timeval){0};
-        time_cpl.tv_usec = table[index].cpl_latency_us;
-        timeradd(&time_cmd, &time_cpl, &time_cpl);
+        rpc_conn_accept(listen_fd);
+        continue;
+      }
 
-        uint32_t* cpl = (uint32_t*)&table[index].cpl;
-        const char* sts = nvme_qpair_get_status_string(&table[index].cpl);
-        spdk_json_write_string_fmt(w, "%ld.%06ld: [cpl: %s] \n"
-                                   "0x%08x, 0x%08x, 0x%08x, 0x%08x\n",
-                                   time_cpl.tv_sec, time_cpl.tv_usec,
-                                   sts,
-                                   cpl[0], cpl[1], cpl[2], cpl[3]);
+      if (events[i].events & EPOLLIN)
+      {
+        rpc_conn_recv(conn);
       }
-      else
+      if (events[i].events & EPOLLOUT)
       {
-        spdk_json_write_string_fmt(w, "not completed ...\n");
+        rpc_conn_flush(conn);
+      }
+      if ((events[i].events & (EPOLLERR|EPOLLHUP)) || conn->closing)
+      {
+        rpc_conn_close(conn);
       }
     }
-  } while (seq++ < 100);
+  }
 
-  spdk_json_write_array_end(w);
-  spdk_jsonrpc_end_result(request, w);
+  return NULL;
 }
-SPDK_RPC_REGISTER("get_cmdlog", rpc_get_cmdlog, SPDK_RPC_STARTUP | SPDK_RPC_RUNTIME)
-
 
 ////driver system
 ///////////////////////////////
 
-int driver_init(void)
+// test one core in the hex core mask, which can be wider than 64 bits
+static bool driver_core_in_mask(const char* core_mask, uint32_t core)
+{
+  const char* begin = core_mask;
+  const char* p;
+  char digit[2] = {0, 0};
+
+  if (begin[0] == '0' && (begin[1] == 'x' || begin[1] == 'X'))
+  {
+    begin += 2;
+  }
+
+  // the lowest core is in the last digit
+  p = core_mask + strlen(core_mask) - 1 - core/4;
+  if (p < begin)
+  {
+    return false;
+  }
+
+  digit[0] = *p;
+  return (strtoul(digit, NULL, 16) >> (core%4)) & 1;
+}
+
+// pick one core of the given core mask for this process, so
+// multiprocessing workers of the same device share its core set
+static uint32_t driver_init_core(const char* core_mask)
+{
+  uint32_t count = 0;
+  uint32_t nprocs = get_nprocs();
+  uint32_t pick;
+  uint32_t i;
+
+  if (core_mask != NULL && core_mask[0] != '\0')
+  {
+    for (i = 0; i < nprocs; i++)
+    {
+      count += driver_core_in_mask(core_mask, i);
+    }
+  }
+
+  if (count == 0)
+  {
+    // all cores
+    return getpid()%nprocs;
+  }
+
+  pick = getpid()%count;
+  for (i = 0; i < nprocs; i++)
+  {
+    if (driver_core_in_mask(core_mask, i) && pick-- == 0)
+    {
+      break;
+    }
+  }
+
+  return i;
+}
+
+int driver_init(int shm_id, const char* core_mask,
+                uint32_t mem_size, const char* pciaddr)
 {
   int ret = 0;
-  char buf[20];
+  char buf[300];
+  uint32_t core;
   struct spdk_env_opts opts;
+  struct spdk_pci_addr whitelist;
+  static char rpc_sock_path[64];
 
   //init random sequence reproducible
   srandom(1);
 
   // distribute multiprocessing to different cores
   spdk_env_opts_init(&opts);
-  sprintf(buf, "0x%x", 1<<(getpid()%get_nprocs()));
+  // the hex mask of one core: a digit followed by zeroes
+  core = driver_init_core(core_mask);
+  assert(core/4+4 < sizeof(buf));
+  sprintf(buf, "0x%x", 1<<(core%4));
+  memset(buf+3, '0', core/4);
+  buf[3+core/4] = '\0';
   opts.core_mask = buf;
-  opts.shm_id = 0;
+  opts.shm_id = shm_id;
   opts.name = "pynvme";
-  opts.mem_size = 512;
+  opts.mem_size = mem_size ? mem_size : 512;
+
+  // each device worker attaches only its own device
+  if (pciaddr != NULL && spdk_pci_addr_parse(&whitelist, pciaddr) == 0)
+  {
+    opts.pci_whitelist = &whitelist;
+    opts.num_pci_addr = 1;
+  }
+
   if (spdk_env_init(&opts) < 0)
   {
     fprintf(stderr, "Unable to initialize SPDK env\n");
@@ -1923,7 +4901,17 @@ int driver_init(void)
   if (spdk_process_is_primary())
   {
     pthread_t rpc_t;
-    pthread_create(&rpc_t, NULL, rpc_server, NULL);
+
+    // one rpc socket for each driver instance
+    if (shm_id == 0)
+    {
+      sprintf(rpc_sock_path, "/var/tmp/pynvme.sock");
+    }
+    else
+    {
+      sprintf(rpc_sock_path, "/var/tmp/pynvme.sock.%d", shm_id);
+    }
+    pthread_create(&rpc_t, NULL, rpc_server, rpc_sock_path);
   }
 
   // init cmd log
@@ -1945,6 +4933,9 @@ int driver_init(void)
 
 int driver_fini(void)
 {
+  // release cached dma buffers before env cleanup
+  buffer_pool_release();
+
   //delete cmd log of admin queue
   if (spdk_process_is_primary())
   {
@@ -1959,14 +4950,19 @@ int driver_fini(void)
 
 uint64_t driver_config(uint64_t cfg_word)
 {
-  if (g_driver_csum_table_ptr != NULL)
-  {
-    *g_driver_global_config_ptr = cfg_word;
-  }
-  else
+  *g_driver_global_config_ptr = cfg_word;
+
+  // verification takes effect when the checksum table is available again
+  if (g_driver_csum_table_ptr == NULL)
   {
-    SPDK_INFOLOG(SPDK_LOG_NVME, "no enough memory, not to enable data verification feature.\n");
+    SPDK_INFOLOG(SPDK_LOG_NVME, "checksum table is not available, data verification is disabled.\n");
+    return cfg_word & ~DCFG_VERIFY_READ;
   }
 
-  return *g_driver_global_config_ptr;
+  return cfg_word;
+}
+
+bool driver_verify_available(void)
+{
+  return g_driver_csum_table_ptr != NULL;
 }
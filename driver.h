@@ -39,7 +39,34 @@ typedef struct spdk_nvme_ctrlr ctrlr;
 typedef struct spdk_nvme_ns namespace;
 typedef struct spdk_pci_device pcie;
 typedef struct spdk_nvme_cpl cpl;
+typedef struct buffer_sgl_t buffer_sgl;
+typedef struct qpair_reap_ring_t qpair_reap_ring;
 
+#define QPAIR_WAIT_POLL         (0)
+#define QPAIR_WAIT_INTERRUPT    (1)
+#define QPAIR_WAIT_HYBRID       (2)
+
+
+typedef struct ioworker_sample
+{
+  unsigned int time_ms;         // end of the sample, since the start
+  unsigned int io_count_read;
+  unsigned int io_count_write;
+  unsigned long bytes;
+} ioworker_sample;
+
+// log-linear latency histogram: 8 buckets in each power of 2 of us
+#define IOWORKER_LATENCY_BUCKETS  240
+
+typedef struct ioworker_latency_interval
+{
+  unsigned int time_ms;         // end of the interval, since the start
+  unsigned int io_count;
+  unsigned int p50_us;
+  unsigned int p99_us;
+  unsigned int p999_us;
+  unsigned int max_us;
+} ioworker_latency_interval;
 
 typedef struct ioworker_args
 {
@@ -54,8 +81,15 @@ typedef struct ioworker_args
   unsigned long io_count;
   unsigned int seconds;
   unsigned int qdepth;
+  unsigned int sgl_segment_size;
   unsigned int* io_counter_per_second;
   unsigned int* io_counter_per_latency;
+  unsigned int sample_interval_ms;
+  unsigned int sample_max;
+  ioworker_sample* samples;
+  unsigned int latency_interval_ms;
+  unsigned int latency_interval_max;
+  ioworker_latency_interval* latency_intervals;
 } ioworker_args;
 
 typedef struct ioworker_rets
@@ -64,12 +98,67 @@ typedef struct ioworker_rets
   unsigned long io_count_write;
   unsigned int mseconds;
   unsigned int latency_max_us;
+  unsigned int sample_count;
+  unsigned int latency_interval_count;
   unsigned short error;
 } ioworker_rets;
 
-extern int driver_init(void);
+typedef struct buffer_pool_stats
+{
+  unsigned long alloc_count;
+  unsigned long reuse_count;
+  unsigned long bytes_in_use;
+  unsigned long bytes_in_use_max;
+  unsigned long bytes_cached;
+} buffer_pool_stats;
+
+typedef struct nvme_reset_timing
+{
+  unsigned int disable_us;
+  unsigned int admin_us;
+  unsigned int io_us;
+  unsigned int qpair_count;
+} nvme_reset_timing;
+
+typedef struct qpair_reap_entry
+{
+  unsigned short cid;
+  unsigned short status;
+  unsigned int cdw0;
+  unsigned int latency_us;
+} qpair_reap_entry;
+
+// intervals between stages of commands
+#define CMD_STAGE_INTERVAL_PYTHON     0   // python entry => driver
+#define CMD_STAGE_INTERVAL_BUILD      1   // sqe build and data fill
+#define CMD_STAGE_INTERVAL_SUBMIT     2   // spdk submit => doorbell
+#define CMD_STAGE_INTERVAL_DEVICE     3   // doorbell => cqe reaped
+#define CMD_STAGE_INTERVAL_CMDLOG     4   // cmdlog callback, and read verify
+#define CMD_STAGE_INTERVAL_CALLBACK   5   // cmdlog => user callback
+#define CMD_STAGE_INTERVAL_COUNT      6
+#define CMD_STAGE_HIST_COUNT          32  // log2 buckets in ns
+
+typedef struct cmd_stage_stats
+{
+  unsigned long count;
+  unsigned long sum_ns;
+  unsigned int hist[CMD_STAGE_HIST_COUNT];
+} cmd_stage_stats;
+
+typedef struct nvme_transport_opts
+{
+  unsigned short trsvcid;
+  char subnqn[SPDK_NVMF_NQN_MAX_LEN+1];
+  unsigned char hdgst;
+  unsigned char ddgst;
+  unsigned int io_queue_size;
+} nvme_transport_opts;
+
+extern int driver_init(int shm_id, const char* core_mask,
+                       uint32_t mem_size, const char* pciaddr);
 extern int driver_fini(void);
 extern uint64_t driver_config(uint64_t cfg_word);
+extern bool driver_verify_available(void);
 
 extern pcie* pcie_init(struct spdk_nvme_ctrlr* ctrlr);
 extern int pcie_cfg_read8(struct spdk_pci_device* pci,
@@ -78,9 +167,24 @@ extern int pcie_cfg_read8(struct spdk_pci_device* pci,
 extern int pcie_cfg_write8(struct spdk_pci_device* pci,
                            unsigned char value,
                            unsigned int offset);
+extern int pcie_cfg_read16(struct spdk_pci_device* pci,
+                           unsigned short* value,
+                           unsigned int offset);
+extern int pcie_cfg_write16(struct spdk_pci_device* pci,
+                            unsigned short value,
+                            unsigned int offset);
+extern int pcie_cfg_read32(struct spdk_pci_device* pci,
+                           unsigned int* value,
+                           unsigned int offset);
+extern int pcie_cfg_write32(struct spdk_pci_device* pci,
+                            unsigned int value,
+                            unsigned int offset);
+extern unsigned int pcie_cfg_snapshot(struct spdk_pci_device* pci,
+                                      void* buf,
+                                      unsigned int len);
 
-extern ctrlr* nvme_init(char * traddr);
-extern ctrlr* nvme_probe(char * traddr);
+extern ctrlr* nvme_init(char * traddr, nvme_transport_opts* opts);
+extern ctrlr* nvme_probe(char * traddr, nvme_transport_opts* opts);
 extern int nvme_fini(struct spdk_nvme_ctrlr* c);
 extern int nvme_set_reg32(struct spdk_nvme_ctrlr* ctrlr,
                           unsigned int offset,
@@ -88,7 +192,9 @@ extern int nvme_set_reg32(struct spdk_nvme_ctrlr* ctrlr,
 extern int nvme_get_reg32(struct spdk_nvme_ctrlr* ctrlr,
                           unsigned int offset,
                           unsigned int* value);
+extern const void* nvme_get_identify_data(struct spdk_nvme_ctrlr* ctrlr);
 
+extern int nvme_reset_inplace(struct spdk_nvme_ctrlr* ctrlr, nvme_reset_timing* timing);
 extern int nvme_wait_completion_admin(struct spdk_nvme_ctrlr* c);
 extern void nvme_deallocate_ranges(struct spdk_nvme_ctrlr* ctrlr,
                                    void* buf, unsigned int count);
@@ -121,13 +227,38 @@ extern void nvme_register_timeout_cb(struct spdk_nvme_ctrlr* ctrlr,
 
 extern void* buffer_init(size_t bytes, uint64_t *phys_addr);
 extern void buffer_fini(void* buf);
+extern void* buffer_pool_get(size_t bytes, uint64_t* phys_addr, int zero);
+extern void buffer_pool_put(void* buf, size_t bytes);
+extern void buffer_pool_get_stats(buffer_pool_stats* stats);
+extern void buffer_pool_release(void);
+
+extern buffer_sgl* buffer_sgl_init(size_t bytes, uint32_t seg_size);
+extern void buffer_sgl_fini(buffer_sgl* sgl);
+extern void* buffer_sgl_addr(buffer_sgl* sgl, size_t offset, size_t* len);
 
 extern qpair* qpair_create(struct spdk_nvme_ctrlr *c,
                            int prio, int depth);
 extern int qpair_wait_completion(struct spdk_nvme_qpair *q, uint32_t max_completions);
+extern int qpair_wait_completion_until(struct spdk_nvme_qpair *q,
+                                       uint32_t expected,
+                                       uint32_t timeout_ms,
+                                       uint32_t wait_mode);
 extern int qpair_get_id(struct spdk_nvme_qpair* q);
 extern int qpair_free(struct spdk_nvme_qpair* q);
 
+extern qpair_reap_ring* qpair_reap_init(struct spdk_nvme_qpair* q, uint32_t depth);
+extern void qpair_reap_fini(qpair_reap_ring* ring);
+extern void qpair_reap_cb(void* cb_arg, const struct spdk_nvme_cpl* cpl);
+extern uint32_t qpair_reap(qpair_reap_ring* ring,
+                           struct spdk_nvme_qpair* q,
+                           uint32_t max_count,
+                           qpair_reap_entry* entries);
+extern uint64_t qpair_reap_dropped(qpair_reap_ring* ring);
+
+extern void cmdlog_stage_entry(struct spdk_nvme_qpair* qpair);
+extern void cmdlog_stage_cb(const struct spdk_nvme_cpl* cpl);
+extern void cmdlog_stage_stats(uint16_t qid, cmd_stage_stats* stats, bool clear);
+
 extern namespace* ns_init(ctrlr* c, unsigned int nsid);
 extern int ns_refresh(struct spdk_nvme_ns *ns, uint32_t id, struct spdk_nvme_ctrlr *ctrlr);
 extern int ns_cmd_read_write(int is_read,
@@ -140,6 +271,44 @@ extern int ns_cmd_read_write(int is_read,
                              uint32_t io_flags,
                              cmd_cb_func cb_fn,
                              void* cb_arg);
+extern int ns_cmd_io_sgl(unsigned int opcode,
+                         struct spdk_nvme_ns* ns,
+                         struct spdk_nvme_qpair *qpair,
+                         buffer_sgl* sgl,
+                         uint64_t lba,
+                         uint32_t lba_count,
+                         uint32_t io_flags,
+                         cmd_cb_func cb_fn,
+                         void* cb_arg);
+extern int ns_cmd_read_write_many(int is_read,
+                                  struct spdk_nvme_ns* ns,
+                                  struct spdk_nvme_qpair* qpair,
+                                  void* buf,
+                                  size_t len,
+                                  uint32_t count,
+                                  const uint64_t* lbas,
+                                  const uint16_t* lba_counts,
+                                  const uint64_t* buf_offsets,
+                                  uint32_t io_flags,
+                                  uint32_t qdepth,
+                                  uint32_t timeout_sec,
+                                  uint16_t* status,
+                                  uint32_t* latency_us);
+extern int ns_cmd_file(int is_load,
+                       struct spdk_nvme_ns* ns,
+                       struct spdk_nvme_qpair* qpair,
+                       const char* path,
+                       uint64_t lba,
+                       uint64_t lba_count,
+                       uint32_t io_size,
+                       uint32_t qdepth,
+                       uint32_t timeout_sec);
+extern int ns_cmd_deallocate(struct spdk_nvme_ns* ns,
+                             struct spdk_nvme_qpair* qpair,
+                             const uint64_t* ranges,
+                             uint32_t count,
+                             uint32_t qdepth,
+                             uint32_t timeout_sec);
 extern uint32_t ns_get_sector_size(namespace* ns);
 extern uint64_t ns_get_num_sectors(namespace* ns);
 extern int ns_fini(struct spdk_nvme_ns* ns);
@@ -35,7 +35,9 @@
 
 
 import os
+import json
 import time
+import socket
 import pytest
 import logging
 import warnings
@@ -142,6 +144,36 @@ def test_get_pcie_config_class_code(nvme0):
     assert p[9:12] == [2, 8, 1]
 
 
+def test_pcie_register_access(pcie):
+    cfg = pcie.snapshot()
+    assert len(cfg) in (256, 4096)
+    assert pcie.read16(0) == int.from_bytes(cfg[0:2], 'little')
+    assert pcie.read32(0) == pcie.register(0, 4)
+    assert pcie.register(0, 4) == pcie.register(0, 2) + (pcie.register(2, 2)<<16)
+    assert pcie.read32(8)>>8 == 0x010802  # nvme class code
+
+    # capability index
+    pm_offset = pcie.cap_offset(1)
+    assert pm_offset is not None
+    assert cfg[pm_offset] == 1
+    assert pcie.cap_offset(0x10) is not None  # pcie capability
+    assert pcie.cap_offset(2) is None
+    if len(cfg) == 4096 and pcie.ext_cap_offset(1) is not None:
+        assert pcie.read16(pcie.ext_cap_offset(1)) == 1  # AER
+
+    # 16-bit write: D3hot and back to D0
+    pmcs = pcie.read16(pm_offset+4)
+    pcie.write16(pm_offset+4, pmcs|3)
+    assert pcie.read16(pm_offset+4)&3 == 3
+    time.sleep(1)
+    pcie.write16(pm_offset+4, pmcs&0xfffc)
+    assert pcie.read16(pm_offset+4)&3 == 0
+
+    # index is refreshed after reset
+    pcie.reset()
+    assert pcie.cap_offset(1) == pm_offset
+
+
 def test_get_pcie_registers(pcie):
     vid = pcie.register(0, 2)
     did = pcie.register(2, 2)
@@ -181,6 +213,51 @@ def test_get_lba_format(nvme0n1):
     assert nvme0n1.get_lba_format() < 16
 
 
+def test_get_identify_cached(nvme0, nvme0n1):
+    id_buf = d.Buffer(4096)
+    nvme0.identify(id_buf).waitdone()
+    assert nvme0.id_data(63, 24, str) == id_buf.data(63, 24, str)
+    assert nvme0.id_data(77) == id_buf.data(77)
+
+    # no identify command sent when data is cached
+    start_time = time.time()
+    for i in range(1000):
+        nvme0n1.get_lba_format(512, 0)
+        nvme0n1.capacity
+        nvme0.supports(0x80)
+    assert time.time()-start_time < 1
+
+    # cache is refreshed after format
+    nvme0.format(nvme0n1.get_lba_format(512, 0)).waitdone()
+    nvme0.identify(id_buf, 1, 0).waitdone()
+    assert nvme0n1.id_data(23, 16) == id_buf.data(23, 16)
+
+
+def test_get_identify_not_cached_on_error(nvme0):
+    # identify of an invalid namespace fails, and its data is not cached
+    with pytest.warns(UserWarning, match="ERROR status"):
+        assert nvme0.id_data(3, 0, nsid=0xfffffff0, cns=0) == 0
+    with pytest.warns(UserWarning, match="ERROR status"):
+        assert nvme0.id_data(3, 0, nsid=0xfffffff0, cns=0) == 0
+
+
+def test_get_identify_cache_cleared_at_completion(nvme0, nvme0n1):
+    status = []
+
+    def cb(cdw0, status1):
+        status.append(status1)
+
+    # the script callback is still called at completion
+    lbaf = nvme0n1.get_lba_format(512, 0)
+    nvme0.format(lbaf, cb=cb).waitdone()
+    assert len(status) == 1 and status[0]>>1 == 0
+    assert nvme0n1.get_lba_format(512, 0) == lbaf
+
+    # the driver still checks the completion without script callback
+    with pytest.warns(UserWarning, match="ERROR status"):
+        nvme0.format(lbaf, nsid=0xfffffff0).waitdone()
+
+
 def test_enable_and_disable_hmb(nvme0):
     # setfeatures on hmb
     hmb_size = nvme0.id_data(275, 272)
@@ -491,6 +568,26 @@ def test_firmware_download(nvme0, size, offset):
     nvme0.fw_download(buf, offset).waitdone()
 
 
+@pytest.mark.parametrize("qdepth", [1, 4])
+def test_firmware_download_file(nvme0, tmp_path, qdepth):
+    # image size is not aligned to the chunk
+    image = tmp_path/"fw.bin"
+    image.write_bytes(os.urandom(3*1024*1024+10))
+    with pytest.warns(UserWarning) as record:
+        nvme0.downfw(str(image), slot=1, action=0, qdepth=qdepth)
+
+    # all chunks are downloaded, and the random image is rejected in commit
+    errors = [str(w.message) for w in record if "ERROR status" in str(w.message)]
+    assert errors == ["ERROR status: 01/07"]
+
+
+def test_firmware_download_empty_file(nvme0, tmp_path):
+    image = tmp_path/"empty.bin"
+    image.write_bytes(b'')
+    with pytest.raises(ValueError, match="empty"):
+        nvme0.downfw(str(image))
+
+
 def test_firmware_commit(nvme0):
     logging.info("commit without valid firmware image")
     with pytest.warns(UserWarning, match="ERROR status: 01/07"):
@@ -501,6 +598,54 @@ def test_firmware_commit(nvme0):
         nvme0.fw_commit(7, 2).waitdone()
 
 
+def test_namespace_open_twice(nvme0, nvme0n1, verify, recwarn):
+    q = d.Qpair(nvme0, 8)
+    buf = d.Buffer(16*512)
+    nvme0n1.write(q, buf, 0, 8).waitdone()
+
+    # verification is disabled when more than one namespace is opened
+    with pytest.warns(UserWarning, match="data verification is disabled"):
+        n = d.Namespace(nvme0, 1)
+    assert d.config(verify=True) & 1 == 0
+    n.write(q, buf, 0, 8).waitdone()
+    n.read(q, buf, 0, 8).waitdone()
+    nvme0n1.read(q, buf, 0, 8).waitdone()
+    n.close()
+
+    # and enabled again after it is closed
+    assert d.config(verify=True) & 1 == 1
+    nvme0n1.write(q, buf, 8, 8).waitdone()
+    nvme0n1.read(q, buf, 0, 16).waitdone()
+    assert not [w for w in recwarn if "ERROR status" in str(w.message)]
+    del q
+
+
+def test_format_invalidate_checksum(nvme0, nvme0n1, verify, recwarn):
+    buf = d.Buffer(4096)
+    q = d.Qpair(nvme0, 8)
+    lbas = [0, 4096*5+3, 4096*10]
+
+    for i in range(3):
+        nvme0n1.write(q, buf, lbas[0], 8).waitdone()
+        nvme0n1.write(q, buf, lbas[1], 8).waitdone()
+        nvme0n1.write_uncorrectable(q, lbas[2], 8).waitdone()
+        nvme0.format(nvme0n1.get_lba_format(512, 0)).waitdone()
+
+        # all checksum are invalidated after format. The warning is issued
+        # in the completion callback, so it cannot be raised as an error.
+        recwarn.clear()
+        for lba in lbas:
+            nvme0n1.read(q, buf, lba, 8).waitdone()
+        assert not [w for w in recwarn
+                    if issubclass(w.category, UserWarning) and
+                    "ERROR status: 02/81" in str(w.message)]
+
+    # checksum works again after written
+    nvme0n1.write(q, buf, lbas[1], 8).waitdone()
+    nvme0n1.read(q, buf, lbas[1], 8).waitdone()
+    assert buf.data(7, 0) == lbas[1]
+
+
 def test_sanitize_basic(nvme0, nvme0n1):
     buf = d.Buffer(4096)
 
@@ -630,6 +775,66 @@ def test_different_io_size_and_count(nvme0, nvme0n1,
     io_qpair.waitdone(io_count)
 
 
+def test_async_io_and_admin_commands(nvme0, nvme0n1):
+    import asyncio
+
+    q1 = d.Qpair(nvme0, 8)
+    q2 = d.Qpair(nvme0, 8)
+    smart_log = d.Buffer(512)
+
+    async def write_read(q, lba):
+        wbuf = d.Buffer(512)
+        rbuf = d.Buffer(512)
+        await nvme0n1.write_async(q, wbuf, lba)
+        cdw0, status = await nvme0n1.read_async(q, rbuf, lba)
+        assert rbuf[:] == wbuf[:]
+        return status
+
+    async def get_temperature():
+        cdw0, status = await nvme0.getlogpage_async(0x02, smart_log, 512)
+        return status
+
+    async def test():
+        return await asyncio.gather(write_read(q1, 0),
+                                    write_read(q2, 8),
+                                    get_temperature())
+
+    for status in asyncio.run(test()):
+        assert (status>>1)&0x7ff == 0
+    assert smart_log.data(2, 1) != 0
+
+    # error status is warned
+    with pytest.warns(UserWarning, match="ERROR status: 00/01"):
+        asyncio.run(nvme0n1.send_cmd_async(0xff, q1, nsid=1))
+
+
+def test_async_cancel_and_error(nvme0, nvme0n1):
+    import asyncio
+
+    q = d.Qpair(nvme0, 8)
+    buf = d.Buffer(512)
+
+    async def cancel():
+        t = asyncio.ensure_future(nvme0n1.read_async(q, buf, 0))
+        await asyncio.sleep(0)
+        t.cancel()
+
+    # the poller works in later event loops
+    asyncio.run(cancel())
+    cdw0, status = asyncio.run(asyncio.wait_for(nvme0n1.read_async(q, buf, 0), 5))
+    assert (status>>1)&0x7ff == 0
+
+    # the completion of the cancelled command is reaped too
+    assert not d._poller._callbacks
+    assert not any(d._poller._qpairs.values())
+
+    # error status raises in the awaiting task when warnings are errors
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        with pytest.raises(UserWarning, match="ERROR status: 00/01"):
+            asyncio.run(nvme0n1.send_cmd_async(0xff, q, nsid=1))
+
+
 def test_create_invalid_qpair(nvme0):
     with pytest.raises(d.QpairCreationError):
         q = d.Qpair(nvme0, 20, prio=1)
@@ -664,6 +869,233 @@ def test_buffer_set_get():
     assert b[0:] != b"Z234567890"
 
 
+def test_submit_many(nvme0, nvme0n1, verify):
+    import array
+
+    q = d.Qpair(nvme0, 16)
+    buf = d.Buffer(64*512)
+    lbas = array.array('L', range(0, 8*100, 8))
+    counts = array.array('H', [8]*100)
+    offsets = array.array('L', [(i%8)*8*512 for i in range(100)])
+
+    status, latency = nvme0n1.submit_many(q, 'write', buf, lbas, counts, offsets)
+    assert len(status) == 100
+    assert not any(status)
+    assert all(latency)
+
+    # sequences are converted, and data is verified on read
+    status, latency = nvme0n1.submit_many(q, 'read', buf, list(range(0, 800, 8)),
+                                          [8]*100, qdepth=4)
+    assert not any(status)
+
+    # error status of each command
+    status, latency = nvme0n1.submit_many(q, 'read', buf, [0, nvme0n1.id_data(7, 0)], [1, 1])
+    assert status[0] == 0
+    assert status[1] != 0
+
+
+def test_qpair_reap(nvme0, nvme0n1):
+    q = d.Qpair(nvme0, 16, reap_depth=256)
+    buf = d.Buffer(512)
+
+    for i in range(100):
+        nvme0n1.read(q, buf, i)
+    q.waitdone(100)
+    cpls = q.reap(60)
+    assert len(cpls.cid) == 60
+    assert not any(cpls.status)
+    cpls = q.reap()
+    assert len(cpls.status) == 40
+    assert len(q.reap().cid) == 0
+
+    # error status is kept in ring without warning
+    nvme0n1.send_cmd(0xff, q, nsid=1).waitdone()
+    assert q.reap().status[0] & 0x7ff == 0x0001
+
+    # callback functions are still called
+    def cb(cdw0, status1):
+        nonlocal called; called = True
+    called = False
+    nvme0n1.read(q, buf, 0, cb=cb).waitdone()
+    assert called
+    assert len(q.reap().cid) == 0
+
+
+def test_dump_load_range(nvme0, nvme0n1, tmp_path, verify):
+    q = d.Qpair(nvme0, 16)
+    buf = d.Buffer(256*512)
+    nvme0n1.write(q, buf, 0, 256).waitdone()
+    nvme0n1.write(q, buf, 256, 256).waitdone()
+
+    path = str(tmp_path/"range.bin")
+    nvme0n1.dump_range(0, 300, path, qdepth=8, io_size=64)
+    assert os.path.getsize(path) == 300*512
+    with open(path, 'rb') as f:
+        data = f.read()
+    nvme0n1.read(q, buf, 0, 256).waitdone()
+    assert data[:256*512] == buf[:]
+
+    # load to the same lba, and data is verified in read
+    nvme0n1.write_zeroes(q, 0, 300).waitdone()
+    nvme0n1.load_range(path, 0, qdepth=8, io_size=64)
+    nvme0n1.read(q, buf, 0, 256).waitdone()
+    assert data[:256*512] == buf[:]
+
+    # out of namespace
+    with pytest.raises(SystemError):
+        nvme0n1.dump_range(nvme0n1.id_data(7, 0), 1, path)
+
+
+def test_deallocate_many_ranges(nvme0, nvme0n1, verify):
+    import array
+
+    q = d.Qpair(nvme0, 16)
+    buf = d.Buffer(4096)
+    for i in range(0, 1000*8, 8):
+        nvme0n1.write(q, buf, i, 8)
+    q.waitdone(1000)
+
+    # more than 256 ranges, overlapped and unsorted
+    ranges = [(i, 8) for i in range(1000*8-8, -1, -8)] + [(4, 8)]
+    nvme0n1.deallocate(ranges, qdepth=2)
+    nvme0n1.read(q, buf, 8, 8).waitdone()
+
+    # 2-d buffer of pairs
+    ranges = memoryview(array.array('L', [0, 16, 100, 16])).cast('B').cast('L', (2, 2))
+    nvme0n1.deallocate(ranges)
+
+    with pytest.raises(SystemError):
+        nvme0n1.deallocate([(nvme0n1.id_data(7, 0), 1)])
+
+
+def test_sgl_buffer_set_get():
+    b = d.SglBuffer(3*4096+10, 'sgl', 4096)
+    assert len(b) == 3*4096+10
+    assert b.segment_count == 4
+    assert b[:] == bytes(3*4096+10)
+
+    # across segments
+    b[4094:4098] = b"1234"
+    assert b[4094:4098] == b"1234"
+    assert b.data(4097, 4094) == 0x34333231
+    b[3*4096+9] = 0x5a
+    assert b[3*4096+9] == 0x5a
+
+    # the whole buffer, and a list of integers
+    data = os.urandom(3*4096+10)
+    b[0:] = data
+    assert b[:] == data
+    b[8190:8194] = [1, 2, 3, 4]
+    assert b[8190:8194] == b"\x01\x02\x03\x04"
+    with pytest.raises(AssertionError, match="out of range"):
+        b[3*4096+8:] = b"123"
+
+
+@pytest.mark.parametrize("segment_size", [4096, 2*1024*1024])
+def test_sgl_buffer_write_read_compare(nvme0, nvme0n1, segment_size, verify):
+    q = d.Qpair(nvme0, 16)
+    lba_count = 256
+    wbuf = d.SglBuffer(lba_count*512, 'write', segment_size)
+    rbuf = d.SglBuffer(lba_count*512, 'read', segment_size)
+
+    nvme0n1.write(q, wbuf, 0, lba_count).waitdone()
+    nvme0n1.read(q, rbuf, 0, lba_count).waitdone()
+    assert rbuf[:] == wbuf[:]
+    assert rbuf.data(7, 0) == 0
+    assert rbuf.data(4096+7, 4096) == 8
+
+    nvme0n1.compare(q, rbuf, 0, lba_count).waitdone()
+    rbuf[100] = rbuf[100]^0xff
+    with pytest.warns(UserWarning, match="ERROR status: 02/85"):
+        nvme0n1.compare(q, rbuf, 0, lba_count).waitdone()
+
+
+def test_ioworker_sgl_buffer(nvme0, nvme0n1):
+    nvme0.format(nvme0n1.get_lba_format(512, 0)).waitdone()
+    io_size = min(nvme0.mdts, 1024*1024)//512
+    r = nvme0n1.ioworker(io_size=io_size, lba_align=io_size,
+                         lba_random=False, qdepth=256,
+                         read_percentage=50, time=5,
+                         sgl_segment_size=4096).start().close()
+    assert r.error == 0
+    assert r.io_count_read != 0
+
+
+def test_ioworker_sgl_buffer_released(nvme0, nvme0n1):
+    def hugepages_free():
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("HugePages_Free"):
+                    return int(line.split()[1])
+
+    def sgl_ioworker():
+        return nvme0n1.ioworker(io_size=256, lba_align=256,
+                                lba_random=False, qdepth=256,
+                                read_percentage=100, time=2,
+                                sgl_segment_size=4096).start().close()
+
+    sgl_ioworker()
+    bytes_in_use = d.buffer_pool_stats().bytes_in_use
+    free = hugepages_free()
+
+    # each worker caches segments of all its io in its own buffer pool,
+    # and releases them before it exits
+    for i in range(8):
+        assert sgl_ioworker().error == 0
+    assert hugepages_free() >= free
+    assert d.buffer_pool_stats().bytes_in_use == bytes_in_use
+
+
+def test_buffer_pool_reuse():
+    d.buffer_pool_release()
+    b = d.Buffer.from_pool(4096, 'pool')
+    phys_addr = b.phys_addr
+    assert b[0] == 0
+    b[0] = 0x5a
+    del b
+
+    # same size class, get the same buffer, and cleared
+    b = d.Buffer.from_pool(4000)
+    assert len(b) == 4000
+    assert b.phys_addr == phys_addr
+    assert b[0] == 0
+    b[0] = 0x5a
+    del b
+
+    # not to clear the buffer
+    b = d.Buffer.from_pool(4096, zero=False)
+    assert b.phys_addr == phys_addr
+    assert b[0] == 0x5a
+    del b
+
+    # different size class
+    b = d.Buffer.from_pool(4097)
+    assert b.phys_addr != phys_addr
+    del b
+
+
+def test_buffer_pool_stats(nvme0):
+    d.buffer_pool_release()
+    s = d.buffer_pool_stats()
+    assert s.bytes_cached == 0
+
+    l = [d.Buffer.from_pool(8192) for i in range(8)]
+    s = d.buffer_pool_stats()
+    assert s.bytes_in_use_max >= 8*8192
+    del l
+    s = d.buffer_pool_stats()
+    assert s.bytes_cached == 8*8192
+
+    # helpers reuse the buffers in the pool
+    reuse_count = s.reuse_count
+    for i in range(10):
+        nvme0.id_data(63, 24, str)
+    assert d.buffer_pool_stats().reuse_count >= reuse_count+9
+
+    d.buffer_pool_release()
+    assert d.buffer_pool_stats().bytes_cached == 0
+
+
 @pytest.mark.parametrize("repeat", range(2))
 def test_create_many_qpair(nvme0, repeat):
     q = []
@@ -1190,6 +1622,143 @@ def test_ioworker_output_io_per_second_consistency(nvme0n1, nvme0):
         w.iops_consistency()
 
 
+def test_ioworker_sample_interval(nvme0n1, nvme0):
+    r = nvme0n1.ioworker(io_size=8, lba_align=8,
+                         lba_random=True, qdepth=16,
+                         read_percentage=50, time=3,
+                         iops=10000,
+                         sample_interval_ms=10).start().close()
+    samples = r.samples
+    logging.info(samples.io_count_read[:10])
+    assert 290 < len(samples.time_ms) < 310
+    assert samples.time_ms[0] == 10
+    assert sum(samples.io_count_read)+sum(samples.io_count_write) == \
+        r.io_count_read+r.io_count_write
+    assert sum(samples.bytes) == (r.io_count_read+r.io_count_write)*8*512
+    assert 80 < samples.io_count_read[10]+samples.io_count_write[10] < 120
+
+    # without time limit, samples are kept in the buffer of max size
+    r = nvme0n1.ioworker(io_size=8, lba_align=8,
+                         lba_random=True, qdepth=16,
+                         read_percentage=100, io_count=1000000,
+                         sample_interval_ms=1).start().close()
+    assert len(r.samples.time_ms) <= 65536
+    assert sum(r.samples.io_count_read) == r.io_count_read
+    assert list(r.samples.time_ms) == sorted(r.samples.time_ms)
+
+
+def test_ioworker_latency_interval(nvme0n1, nvme0):
+    output_io_per_second = []
+    r = nvme0n1.ioworker(io_size=8, lba_align=8,
+                         lba_random=True, qdepth=16,
+                         read_percentage=100, time=5,
+                         output_io_per_second=output_io_per_second,
+                         latency_interval_ms=1000).start().close()
+    intervals = r.latency_intervals
+    logging.info(intervals)
+    assert len(intervals.time_ms) >= len(output_io_per_second)
+    assert list(intervals.time_ms[:5]) == [1000, 2000, 3000, 4000, 5000]
+    assert sum(intervals.io_count) == r.io_count_read
+    assert max(intervals.max_us) == r.latency_max_us
+    for i in range(5):
+        assert intervals.p50_us[i] <= intervals.p99_us[i] <= \
+            intervals.p999_us[i] <= intervals.max_us[i]
+
+    # no time limit: intervals are collected till the io count
+    r = nvme0n1.ioworker(io_size=8, lba_align=8,
+                         lba_random=True, qdepth=16,
+                         read_percentage=100, io_count=100,
+                         latency_interval_ms=1000).start().close()
+    assert sum(r.latency_intervals.io_count) == 100
+
+    # intervals are kept in the buffer of max size
+    r = nvme0n1.ioworker(io_size=8, lba_align=8,
+                         lba_random=True, qdepth=16,
+                         read_percentage=100, io_count=1000000,
+                         latency_interval_ms=1).start().close()
+    intervals = r.latency_intervals
+    assert len(intervals.time_ms) <= 65536
+    assert sum(intervals.io_count) == r.io_count_read
+    assert max(intervals.max_us) == r.latency_max_us
+    assert list(intervals.time_ms) == sorted(intervals.time_ms)
+
+    with pytest.raises(AssertionError, match="need time duration"):
+        nvme0n1.ioworker(io_size=8, lba_align=8, io_count=100,
+                         output_io_per_second=[])
+
+
+def test_ioworker_admin_outstanding(nvme0, nvme0n1):
+    status = []
+
+    def cb(cdw0, status1):
+        status.append(status1)
+
+    # ioworker sends no admin command, even when identify data is not cached
+    nvme0._cache_clear()
+    nvme0.getfeatures(7, cb=cb)
+    r = nvme0n1.ioworker(io_size=8, lba_align=8,
+                         lba_random=True, qdepth=16,
+                         read_percentage=100, io_count=100).start().close()
+    nvme0.waitdone()
+    assert len(status) == 1
+    assert r.device.model == nvme0.id_data(63, 24, str)
+    assert r.device.serial == nvme0.id_data(23, 4, str)
+
+
+def test_ioworker_result_export(nvme0, nvme0n1, tmp_path):
+    r = nvme0n1.ioworker(io_size=8, lba_align=8,
+                         lba_random=True, qdepth=16,
+                         read_percentage=100, time=3,
+                         output_io_per_second=[],
+                         output_percentile_latency={99: None},
+                         sample_interval_ms=100,
+                         latency_interval_ms=1000).start().close()
+    assert r.device.model == nvme0.id_data(63, 24, str)
+    assert r.device.firmware == nvme0.id_data(71, 64, str)
+    assert r.args.qdepth == 16
+    assert len(r.io_per_second) == 3
+
+    summary = json.loads(r.to_json(str(tmp_path/"result.json")))
+    assert summary["io_count_read"] == r.io_count_read
+    assert summary["device"]["serial"] == nvme0.id_data(23, 4, str)
+    assert "samples" not in summary
+    assert "samples.time_ms" in r.columns()
+    assert "latency_intervals.p99_us" in r.columns()
+
+    numpy = pytest.importorskip("numpy")
+    r.to_npz(str(tmp_path/"result.npz"))
+    data = numpy.load(str(tmp_path/"result.npz"))
+    assert list(data["samples.io_count_read"]) == list(r.samples.io_count_read)
+    assert list(data["io_per_second"]) == list(r.io_per_second)
+    assert json.loads(str(data["summary"]))["args"]["time"] == 3
+
+
+def test_ioworker_baseline(nvme0n1, tmp_path):
+    from baseline import Baseline
+
+    def run():
+        return nvme0n1.ioworker(io_size=8, lba_align=8,
+                                lba_random=True, qdepth=16,
+                                read_percentage=100, time=3, iops=10000,
+                                output_io_per_second=[]).start().close()
+
+    # recorded as the baseline in the first run
+    b = Baseline(str(tmp_path/"baseline.json"))
+    assert b.check([run(), run()]) == []
+    b.save()
+
+    b = Baseline(str(tmp_path/"baseline.json"))
+    rows = b.check([run(), run()])
+    assert not any(r["regression"] for r in rows)
+
+    # 5% better baseline fails the same workload
+    r = run()
+    for base in b.data[b.key(r)]["runs"]:
+        base["metrics"]["iops"] *= 1.05
+    with pytest.raises(pytest.fail.Exception, match="REGRESSION"):
+        b.check(r)
+
+
 @pytest.mark.parametrize('depth', [256, 512, 1023])
 def test_ioworker_huge_qdepth(nvme0, nvme0n1, depth):
     # """test huge queue in ioworker"""
@@ -1788,6 +2357,280 @@ def test_reset_admin_io_mixed(nvme0, nvme0n1):
     test_buffer_token_single_process(nvme0, nvme0n1)
 
 
+def rpc_connect():
+    shm_id = int(os.environ.get("PYNVME_SHM_ID", "0"))
+    path = "/var/tmp/pynvme.sock" + (".%d" % shm_id if shm_id else "")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5)
+    sock.connect(path)
+    return sock
+
+
+def rpc_call(method, params=None, sock=None):
+    request = {"jsonrpc": "2.0", "method": method, "id": 1}
+    if params is not None:
+        request["params"] = params
+
+    if sock is None:
+        with rpc_connect() as sock:
+            return rpc_call(method, params, sock)
+
+    sock.sendall(json.dumps(request).encode('utf-8'))
+    response = b''
+    while True:
+        response += sock.recv(65536)
+        try:
+            return json.loads(response)["result"]
+        except ValueError:
+            continue
+
+
+def test_rpc_get_metrics(nvme0, nvme0n1):
+    q = d.Qpair(nvme0, 16)
+    buf = d.Buffer(4096)
+    for i in range(100):
+        nvme0n1.read(q, buf, i).waitdone()
+
+    metrics = rpc_call("get_metrics")
+    m = [m for m in metrics["qpairs"] if m["qid"] == q.sqid][0]
+    assert m["completions"] == 100
+    assert m["outstanding"] == 0
+    assert m["errors"] == 0
+    assert 0 < m["latency_us"]["0.5"] <= m["latency_us"]["1"]
+    assert "ioworker" not in m
+
+    nvme0n1.send_cmd(0xff, q, nsid=1).waitdone()
+    text = rpc_call("get_metrics_text")
+    assert 'pynvme_qpair_errors_total{qid="%d"} 1\n' % q.sqid in text
+    assert 'pynvme_qpair_completions_total{qid="%d"} 101\n' % q.sqid in text
+    assert text.endswith("# EOF\n")
+
+
+def test_rpc_get_metrics_new_qpair(nvme0, nvme0n1):
+    q = d.Qpair(nvme0, 16)
+    buf = d.Buffer(4096)
+    for i in range(100):
+        nvme0n1.read(q, buf, i).waitdone()
+    qid = q.sqid
+    del q
+
+    # entries of the deleted qpair are not counted in the new one
+    q = d.Qpair(nvme0, 16)
+    assert q.sqid == qid
+    m = [m for m in rpc_call("get_metrics")["qpairs"] if m["qid"] == qid][0]
+    assert m["completions"] == 0
+    assert m["latency_us"]["1"] == 0
+
+    nvme0n1.read(q, buf, 0).waitdone()
+    m = [m for m in rpc_call("get_metrics")["qpairs"] if m["qid"] == qid][0]
+    assert m["completions"] == 1
+    assert m["latency_us"]["0.5"] == m["latency_us"]["1"] > 0
+
+
+def test_rpc_get_metrics_rate(nvme0, nvme0n1):
+    def rates(metrics):
+        return [m["completions_per_second"] for m in metrics["qpairs"] if "ioworker" in m]
+
+    w = nvme0n1.ioworker(io_size=8, lba_align=8, lba_random=True,
+                         read_percentage=100, time=5).start()
+    time.sleep(1)
+    with rpc_connect() as sock:
+        rpc_call("get_metrics", sock=sock)
+        time.sleep(1)
+
+        # the rate is calculated since the last call in the same connection
+        other = rates(rpc_call("get_metrics"))
+        this = rates(rpc_call("get_metrics", sock=sock))
+    w.close()
+    assert other == [0]
+    assert len(this) == 1 and this[0] > 0
+
+
+def test_rpc_get_metrics_idle(nvme0, nvme0n1):
+    q = d.Qpair(nvme0, 16)
+    buf = d.Buffer(4096)
+    nvme0n1.read(q, buf, 0).waitdone()
+    m = [m for m in rpc_call("get_metrics")["qpairs"] if m["qid"] == q.sqid][0]
+    assert m["latency_us"]["1"] > 0
+
+    # latencies of old commands are not reported
+    time.sleep(11)
+    m = [m for m in rpc_call("get_metrics")["qpairs"] if m["qid"] == q.sqid][0]
+    assert m["completions"] == 1
+    assert m["latency_us"]["1"] == 0
+
+
+def test_rpc_get_metrics_ioworker(nvme0, nvme0n1):
+    w = nvme0n1.ioworker(io_size=8, lba_align=8, lba_random=True,
+                         read_percentage=100, time=5).start()
+    time.sleep(3)
+    workers = [m["ioworker"] for m in rpc_call("get_metrics")["qpairs"] if "ioworker" in m]
+    w.close()
+    assert len(workers) == 1
+    assert workers[0]["io_count"] > 0
+    assert workers[0]["seconds_target"] == 5
+    assert 1000 < workers[0]["elapsed_ms"] < 5000
+
+
+def test_rpc_cmdlog_paging(nvme0, nvme0n1):
+    q = d.Qpair(nvme0, 16)
+    buf = d.Buffer(4096)
+    for i in range(300):
+        nvme0n1.read(q, buf, i).waitdone()
+
+    # newest first, in pages
+    page = rpc_call("get_cmdlog", {"qid": q.sqid, "count": 200})
+    assert len(page["records"]) == 200
+    assert page["records"][0]["cmd"][10] == 299
+    assert page["records"][0]["latency_us"] > 0
+    page = rpc_call("get_cmdlog", {"qid": q.sqid, "offset": 200, "count": 200})
+    assert len(page["records"]) == 100
+    assert page["records"][0]["cmd"][10] == 99
+
+    # legacy text format
+    assert type(rpc_call("get_cmdlog", [q.sqid+1])[0]) == str
+
+    # no records of the deleted qpair of the same qid
+    qid = q.sqid
+    del q
+    q = d.Qpair(nvme0, 16)
+    assert q.sqid == qid
+    for i in range(5):
+        nvme0n1.read(q, buf, 1000+i).waitdone()
+    page = rpc_call("get_cmdlog", {"qid": q.sqid, "count": 200})
+    assert [r["cmd"][10] for r in page["records"]] == [1004, 1003, 1002, 1001, 1000]
+
+
+def test_rpc_subscribe(nvme0, nvme0n1):
+    q = d.Qpair(nvme0, 16)
+    buf = d.Buffer(4096)
+    shm_id = int(os.environ.get("PYNVME_SHM_ID", "0"))
+    path = "/var/tmp/pynvme.sock" + (".%d" % shm_id if shm_id else "")
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(5)
+        sock.connect(path)
+        f = sock.makefile('r')
+        sock.sendall(json.dumps({"jsonrpc": "2.0", "method": "subscribe", "id": 1,
+                                 "params": {"qid": q.sqid, "interval_ms": 10,
+                                            "metrics": False}}).encode('utf-8'))
+        assert json.loads(f.readline())["result"] == True
+
+        for i in range(10):
+            nvme0n1.read(q, buf, i).waitdone()
+
+        # pushed without polling
+        lbas = []
+        while len(lbas) < 10:
+            msg = json.loads(f.readline())
+            assert msg["method"] == "cmdlog"
+            assert msg["params"]["qid"] == q.sqid
+            lbas += [r["cmd"][10] for r in msg["params"]["records"]]
+        assert lbas == list(range(10))
+
+
+def test_rpc_subscribe_lapped(nvme0, nvme0n1):
+    q = d.Qpair(nvme0, 16)
+    buf = d.Buffer(4096)
+    shm_id = int(os.environ.get("PYNVME_SHM_ID", "0"))
+    path = "/var/tmp/pynvme.sock" + (".%d" % shm_id if shm_id else "")
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(10)
+        sock.connect(path)
+        f = sock.makefile('r')
+        sock.sendall(json.dumps({"jsonrpc": "2.0", "method": "subscribe", "id": 1,
+                                 "params": {"qid": q.sqid, "interval_ms": 3000,
+                                            "metrics": False}}).encode('utf-8'))
+        assert json.loads(f.readline())["result"] == True
+
+        # more commands than the cmdlog keeps before the next push
+        for i in range(3000):
+            nvme0n1.read(q, buf, i).waitdone()
+
+        msg = json.loads(f.readline())
+        assert msg["method"] == "cmdlog"
+        records = msg["params"]["records"]
+        assert msg["params"]["dropped"] + len(records) == 3000
+        assert msg["params"]["dropped"] == 3000-2047
+        assert records[0]["cmd"][10] == 3000-2047
+        assert records[-1]["cmd"][10] == 2999
+
+
+def test_qpair_stages(nvme0, nvme0n1):
+    q = d.Qpair(nvme0, 16)
+    buf = d.Buffer(4096)
+
+    # not traced by default
+    nvme0n1.read(q, buf, 0).waitdone()
+    assert q.stages().device.count == 0
+
+    d.config(verify=True, stages=True)
+    for i in range(100):
+        nvme0n1.write(q, buf, i).waitdone()
+        nvme0n1.read(q, buf, i).waitdone()
+    d.config(verify=False)
+
+    stages = q.stages(clear=True)
+    for name in ('python', 'build', 'submit', 'device', 'cmdlog', 'callback'):
+        logging.info("%s: %.3f us" % (name, stages[name].average_us))
+        assert stages[name].count == 200
+        assert sum(stages[name].histogram) == 200
+    assert stages.device.average_us > stages.submit.average_us
+    assert q.stages().python.count == 0
+
+
+def test_qpair_waitdone_many(nvme0, nvme0n1):
+    q = d.Qpair(nvme0, 1024)
+    buf = d.Buffer(512)
+
+    for i in range(1000):
+        nvme0n1.read(q, buf, i)
+    q.waitdone(1000)
+
+    # no more completions to reap
+    with pytest.raises(TimeoutError):
+        q.waitdone()
+
+
+@pytest.mark.parametrize("wait", ['poll', 'interrupt', 'hybrid'])
+def test_qpair_wait_mode(nvme0, nvme0n1, wait):
+    q = d.Qpair(nvme0, 64, wait=wait)
+    buf = d.Buffer(4096)
+
+    for i in range(1000):
+        nvme0n1.read(q, buf, i*8, 8)
+        if i%32 == 31:
+            q.waitdone(32)
+    q.waitdone(1000%32)
+
+    # wait a long command with low cpu usage
+    nvme0n1.write_zeroes(q, 0, 64*1024-1).waitdone()
+
+    with pytest.raises(d.QpairCreationError):
+        d.Qpair(nvme0, 64, wait='sleep')
+
+
+def test_controller_fast_reset(nvme0, nvme0n1, verify):
+    buf = d.Buffer(4096)
+    q1 = d.Qpair(nvme0, 16)
+    q2 = d.Qpair(nvme0, 8, prio=1)
+    nvme0n1.write(q1, buf, 0, 8).waitdone()
+
+    for i in range(10):
+        timing = nvme0.fast_reset()
+        assert timing.qpair_count == 2
+        assert timing.admin_us > 0
+
+    # qpairs are still usable after reset
+    sqid = q1.sqid
+    nvme0n1.read(q1, buf, 0, 8).waitdone()
+    assert buf.data(7, 0) == 0
+    nvme0n1.read(q2, buf, 0, 8).waitdone()
+    assert q1.sqid == sqid
+    nvme0.getfeatures(7).waitdone()
+
+
 def test_reap_without_command(nvme0, nvme0n1):
     # pynvme driver timeout
     with pytest.raises(TimeoutError):
@@ -60,6 +60,7 @@
   * [Namespace](#namespace)
   * [Qpair](#qpair)
   * [Buffer](#buffer)
+  * [SglBuffer](#sglbuffer)
   * [IOWorker](#ioworker)
   * [Subsystem](#subsystem)
 
@@ -358,11 +359,16 @@ Classes
 import os
 import sys
 import time
+import mmap
+import array
 import glob
+import json
 import atexit
 import signal
+import socket
 import struct
 import logging
+import asyncio
 import warnings
 import statistics
 import subprocess
@@ -370,8 +376,9 @@ import multiprocessing
 
 # c library
 import cython
-from libc.string cimport strncpy, memset, strlen
+from libc.string cimport strncpy, memset, strlen, memcpy
 from libc.stdio cimport printf
+from libc.errno cimport ETIMEDOUT
 from cpython.mem cimport PyMem_Malloc, PyMem_Free
 from cpython.exc cimport PyErr_CheckSignals
 
@@ -427,6 +434,7 @@ cdef struct _cpl:
     unsigned short status1  #this word actully inculdes some other bites
 
 cdef void cmd_cb(void* f, const d.cpl* cpl):
+    d.cmdlog_stage_cb(cpl)
     arg = <_cpl*>cpl  # no qa
     status1 = arg.status1
     func = <object>f   # no qa
@@ -450,6 +458,90 @@ cdef void aer_cmd_cb(void* f, const d.cpl* cpl):
     cmd_cb(f, cpl)
 
 
+class _CompletionPoller(object):
+    """poll completions of admin and io qpairs in asyncio event loop.
+
+    Commands sent by async methods are counted in their qpairs till they
+    complete, even after their waiting is timeout or cancelled. The poller
+    is scheduled in the event loop when any command is outstanding. It
+    polls again soon after reaping any completion, otherwise it backs off
+    up to 1ms, so the event loop is not busy with slow commands.
+    """
+
+    _DELAY_MIN = 0.00005
+    _DELAY_MAX = 0.001
+
+    def __init__(self):
+        self._qpairs = {}  # poll function => outstanding command count
+        self._callbacks = set()
+        self._loop = None  # the event loop where the poller is scheduled
+        self._delay = 0
+
+    def submit(self, poll, send):
+        """send a command, and return the future of its completion"""
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def cb(cdw0, status1):
+            # keep the callback and polling till the completion, even
+            # after timeout, so late completions are reaped
+            self._qpairs[poll] -= 1
+            self._callbacks.discard(cb)
+            if not future.done():
+                future.set_result((cdw0, status1))
+
+        # hold the callback until the command completes
+        self._callbacks.add(cb)
+        try:
+            send(cb)
+        except:
+            self._callbacks.discard(cb)
+            raise
+        self._qpairs[poll] = self._qpairs.get(poll, 0) + 1
+
+        # the poller of a closed event loop never runs again
+        self._delay = 0
+        if self._loop is not loop:
+            self._loop = loop
+            loop.call_soon(self._poll, loop)
+        return self._wait(future)
+
+    async def _wait(self, future):
+        cdw0, status1 = await asyncio.wait_for(future, _cTIMEOUT_wrap)
+
+        # check the status in the task, not in the driver's callback
+        if (status1>>1) & 0x7ff:
+            sc = (status1>>1) & 0xff
+            sct = (status1>>9) & 0x7
+            warnings.warn("ERROR status: %02x/%02x" % (sct, sc))
+        return cdw0, status1
+
+    def _poll(self, loop):
+        if self._loop is not loop:
+            # the poller is moved to another event loop
+            return
+
+        reaped = 0
+        for poll, outstanding in list(self._qpairs.items()):
+            if outstanding > 0:
+                reaped += max(0, poll())
+            else:
+                del self._qpairs[poll]
+
+        if not self._qpairs:
+            self._loop = None
+        elif reaped or self._delay == 0:
+            # more completions may come soon
+            self._delay = self._DELAY_MIN
+            loop.call_soon(self._poll, loop)
+        else:
+            loop.call_later(self._delay, self._poll, loop)
+            self._delay = min(self._delay*2, self._DELAY_MAX)
+
+_poller = _CompletionPoller()
+
+
 cdef class Buffer(object):
     """Buffer class allocated in DPDK memzone,so can be used by DMA. Data in buffer is clear to 0 in initialization.
 
@@ -495,8 +587,9 @@ cdef class Buffer(object):
     cdef size_t size
     cdef char* name
     cdef unsigned long phys_addr
+    cdef bint pooled
 
-    def __cinit__(self, size=4096, name="buffer"):
+    def __cinit__(self, size=4096, name="buffer", pool=False, zero=True):
         assert size > 0, "0 is not valid size"
 
         # copy python string to c string
@@ -509,7 +602,11 @@ cdef class Buffer(object):
 
         # buffer init
         self.size = size
-        self.ptr = d.buffer_init(size, &self.phys_addr)
+        self.pooled = pool
+        if pool:
+            self.ptr = d.buffer_pool_get(size, &self.phys_addr, zero)
+        else:
+            self.ptr = d.buffer_init(size, &self.phys_addr)
         if self.ptr is NULL:
             raise MemoryError()
 
@@ -518,7 +615,27 @@ cdef class Buffer(object):
             PyMem_Free(self.name)
 
         if self.ptr is not NULL:
-            d.buffer_fini(self.ptr)
+            if self.pooled:
+                d.buffer_pool_put(self.ptr, self.size)
+            else:
+                d.buffer_fini(self.ptr)
+
+    @staticmethod
+    def from_pool(size=4096, name="buffer", zero=True):
+        """get a buffer from the buffer pool
+
+        The pool keeps released buffers in power-of-two size classes (4KB to 2MB), and reuses them in later allocations. It is recommended for temporary buffers allocated frequently.
+
+        # Attributes
+            size (int): the size (in bytes) of the buffer. Default: 4096
+            name (str): the name of the buffer. Default: 'buffer'
+            zero (bool): clear the reused buffer to 0. Default: True
+
+        # Returns
+            (Buffer): the buffer object
+        """
+
+        return Buffer(size, name, True, zero)
 
     @property
     def phys_addr(self):
@@ -596,6 +713,134 @@ cdef class Buffer(object):
         self[index*16:(index+1)*16] = struct.pack("<LLQ", 0, lba_count, lba)
 
 
+cdef class SglBuffer(object):
+    """Scatter-gather buffer class, which is made of fixed-size segments allocated in DPDK memzone. Large IO can use this buffer without large physically contiguous memory. Data in buffer is clear to 0 in initialization.
+
+    SglBuffer can be used in read, write and compare commands of Namespace. Driver describes the buffer with SGL or PRP list.
+
+    # Attributes
+        size (int): the size (in bytes) of the buffer. Default: 4096
+        name (str): the name of the buffer. Default: 'sgl buffer'
+        segment_size (int): the size (in bytes) of each segment, power of 2, from 4096 to 2MB. Default: 4096
+
+    Examples:
+```python
+        >>> b = SglBuffer(1024*1024, 'example', 4096)
+        >>> b.segment_count
+        256
+        >>> b[4095:4097] = [1, 2]
+        >>> b.data(4096, 4095)
+        513
+```
+    """
+
+    cdef d.buffer_sgl* sgl
+    cdef size_t size
+    cdef unsigned int segment_size
+    cdef str name
+
+    def __cinit__(self, size=4096, name="sgl buffer", segment_size=4096):
+        assert size > 0, "0 is not valid size"
+        assert segment_size >= 4096 and segment_size <= 2*1024*1024, \
+            "segment size should be in 4KB to 2MB"
+        assert (segment_size & (segment_size-1)) == 0, \
+            "segment size should be power of 2"
+
+        self.name = name
+        self.size = size
+        self.segment_size = segment_size
+        self.sgl = d.buffer_sgl_init(size, segment_size)
+        if self.sgl is NULL:
+            raise MemoryError()
+
+    def __dealloc__(self):
+        if self.sgl is not NULL:
+            d.buffer_sgl_fini(self.sgl)
+
+    @property
+    def segment_count(self):
+        return (self.size+self.segment_size-1)//self.segment_size
+
+    def data(self, byte_end, byte_begin=None, type=int):
+        """get field in the buffer. Little endian for integers.
+
+        # Attributes
+            byte_end (int): the end byte number of this field. Included.
+            byte_begin (int): the begin byte number of this field. Included. Default: None, means only get 1 byte defined in byte_end
+            type (type): the type of the field. It should be int or str. Default: int, convert to integer python object
+
+        # Returns
+            (int or str): the data in the specified field
+        """
+
+        if byte_begin is None:
+            byte_begin = byte_end
+
+        if type is int:
+            return int.from_bytes(self[byte_begin:byte_end+1], 'little')
+        else:
+            assert type is str, "data should be int or str"
+            return str(self[byte_begin:byte_end+1], "ascii").rstrip()
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return '<sgl buffer name: %s>' % self.name
+
+    def __getitem__(self, index):
+        cdef size_t length
+        cdef unsigned char* ptr
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return bytes([self[i] for i in range(start, stop, step)])
+
+            # copy segment by segment
+            ret = []
+            while start < stop:
+                ptr = <unsigned char*>d.buffer_sgl_addr(self.sgl, start, &length)
+                length = min(length, stop-start)
+                ret.append(ptr[:length])
+                start += length
+            return b''.join(ret)
+        elif isinstance(index, int):
+            assert index < self.size, "index out of range"
+            ptr = <unsigned char*>d.buffer_sgl_addr(self.sgl, index, NULL)
+            return ptr[0]
+        else:
+            raise TypeError()
+
+    def __setitem__(self, index, value):
+        cdef size_t length
+        cdef size_t offset = 0
+        cdef unsigned char* ptr
+        cdef const unsigned char[:] src
+
+        if isinstance(index, slice):
+            start = 0 if index.start is None else index.start
+            if index.step not in (None, 1):
+                for i, v in enumerate(value):
+                    self[start+i*index.step] = v
+                return
+
+            # copy segment by segment
+            src = bytes(value)
+            assert start+len(src) <= self.size, "index out of range"
+            while offset < len(src):
+                ptr = <unsigned char*>d.buffer_sgl_addr(self.sgl, start+offset, &length)
+                length = min(length, len(src)-offset)
+                memcpy(ptr, &src[offset], length)
+                offset += length
+        elif isinstance(index, int):
+            assert index < self.size, "index out of range"
+            ptr = <unsigned char*>d.buffer_sgl_addr(self.sgl, index, NULL)
+            ptr[0] = value
+        else:
+            raise TypeError()
+
+
 cdef class Subsystem(object):
     """Subsystem class. Prefer to use fixture "subsystem" in test scripts.
 
@@ -667,12 +912,14 @@ cdef class Pcie(object):
 
     cdef d.pcie * _pcie
     cdef Controller _nvme
+    cdef dict _caps
 
     def __cinit__(self, Controller nvme):
         self._nvme = nvme
         self._pcie = d.pcie_init(nvme._ctrlr)
         if self._pcie is NULL:
             raise SystemError()
+        self._caps = None
 
     def __getitem__(self, index):
         """access pcie config space by bytes."""
@@ -705,9 +952,107 @@ cdef class Pcie(object):
         """
 
         assert byte_count <= 8, "support uptp 8-byte PCIe register access"
+        if byte_count == 4 and offset%4 == 0:
+            return self.read32(offset)
+        if byte_count == 2 and offset%2 == 0:
+            return self.read16(offset)
         value = bytes(self[offset:offset+byte_count])
         return int.from_bytes(value, 'little')
 
+    def read16(self, offset):
+        """read a 16-bit register in pcie config space
+
+        # Attributes
+            offset (int): the offset (in bytes) of the register, 2-byte aligned
+
+        # Returns
+            (int): the value of the register
+        """
+
+        cdef unsigned short value
+
+        assert offset%2 == 0, "unaligned 16-bit access"
+        d.pcie_cfg_read16(self._pcie, &value, offset)
+        return value
+
+    def read32(self, offset):
+        """read a 32-bit register in pcie config space
+
+        # Attributes
+            offset (int): the offset (in bytes) of the register, 4-byte aligned
+
+        # Returns
+            (int): the value of the register
+        """
+
+        cdef unsigned int value
+
+        assert offset%4 == 0, "unaligned 32-bit access"
+        d.pcie_cfg_read32(self._pcie, &value, offset)
+        return value
+
+    def write16(self, offset, value):
+        """write a 16-bit register in pcie config space
+
+        # Attributes
+            offset (int): the offset (in bytes) of the register, 2-byte aligned
+            value (int): the value to write
+        """
+
+        assert offset%2 == 0, "unaligned 16-bit access"
+        d.pcie_cfg_write16(self._pcie, value, offset)
+
+    def write32(self, offset, value):
+        """write a 32-bit register in pcie config space
+
+        # Attributes
+            offset (int): the offset (in bytes) of the register, 4-byte aligned
+            value (int): the value to write
+        """
+
+        assert offset%4 == 0, "unaligned 32-bit access"
+        d.pcie_cfg_write32(self._pcie, value, offset)
+
+    def snapshot(self):
+        """read the whole config space in one access
+
+        # Returns
+            (bytes): 4096 bytes of extended config space, or 256 bytes if extended config space is not accessible
+        """
+
+        cdef unsigned char buf[4096]
+
+        length = d.pcie_cfg_snapshot(self._pcie, buf, sizeof(buf))
+        assert length != 0, "fail to read pcie config space"
+        return buf[:length]
+
+    def _cap_index(self):
+        # walk capability lists once in a snapshot, and keep the first one
+        # of each id. Extended capability id is keyed with 0x10000 offset.
+        if self._caps is not None:
+            return self._caps
+
+        cfg = self.snapshot()
+        caps = {}
+        visited = set()
+        next_offset = cfg[0x34]
+        while next_offset != 0 and next_offset+1 < len(cfg) and next_offset not in visited:
+            visited.add(next_offset)
+            caps.setdefault(cfg[next_offset], next_offset)
+            next_offset = cfg[next_offset+1]
+
+        next_offset = 0x100
+        while next_offset != 0 and next_offset+4 <= len(cfg) and next_offset not in visited:
+            visited.add(next_offset)
+            header = int.from_bytes(cfg[next_offset:next_offset+4], 'little')
+            if header == 0 or header == 0xffffffff:
+                break
+            caps.setdefault(0x10000+(header&0xffff), next_offset)
+            next_offset = (header>>20)&0xffc
+
+        self._caps = caps
+        return caps
+
     def cap_offset(self, cap_id):
         """get the offset of a capability
 
@@ -717,16 +1062,25 @@ cdef class Pcie(object):
         # Returns
             (int): the offset of the register
             or None if the capability is not existed
+
+        # Notices
+            The capability index is built once, and refreshed after reset().
+        """
+
+        return self._cap_index().get(cap_id)
+
+    def ext_cap_offset(self, cap_id):
+        """get the offset of an extended capability
+
+        # Attributes
+            cap_id (int): extended capability id
+
+        # Returns
+            (int): the offset of the register in extended config space
+            or None if the capability is not existed
         """
 
-        next_offset = self.register(0x34, 1)
-        while next_offset != 0:
-            value = self.register(next_offset, 2)
-            cid = value % 256
-            cap_offset = next_offset
-            next_offset = value>>8
-            if cid == cap_id:
-                return cap_offset
+        return self._cap_index().get(0x10000+cap_id)
 
     def reset(self):
         """reset this pcie device"""
@@ -736,23 +1090,143 @@ cdef class Pcie(object):
         vdid = '%04x %04x' % (vid, did)
         nvme = 'nvme'
         spdk = 'uio_pci_generic'
-        bdf = '0000:' + self._nvme._bdf.decode('utf-8')
+        bdf = self._nvme._bdf.decode('utf-8')
+        if bdf.count(':') == 1:
+            # sysfs needs the domain
+            bdf = '0000:' + bdf
         logging.debug("pci reset %s on %s" % (vdid, bdf))
 
-        # reset
-        subprocess.call('echo "%s" > "/sys/bus/pci/devices/%s/driver/remove_id" 2> /dev/null || true' % (vid, bdf), shell=True)
-        subprocess.call('echo "%s" > "/sys/bus/pci/devices/%s/driver/unbind" 2> /dev/null || true' % (bdf, bdf), shell=True)
-        subprocess.call('echo "%s" > "/sys/bus/pci/drivers/%s/new_id" 2> /dev/null || true' % (vid, nvme), shell=True)
-        subprocess.call('echo "%s" > "/sys/bus/pci/drivers/%s/bind" 2> /dev/null || true' % (bdf, nvme), shell=True)
-
-        # config
-        subprocess.call('echo "%s" > "/sys/bus/pci/devices/%s/driver/remove_id" 2> /dev/null || true' % (vid, bdf), shell=True)
-        subprocess.call('echo "%s" > "/sys/bus/pci/devices/%s/driver/unbind" 2> /dev/null || true' % (bdf, bdf), shell=True)
-        subprocess.call('echo "%s" > "/sys/bus/pci/drivers/%s/new_id" 2> /dev/null || true' % (vid, spdk), shell=True)
-        subprocess.call('echo "%s" > "/sys/bus/pci/drivers/%s/bind" 2> /dev/null || true' % (bdf, spdk), shell=True)
+        # reset, and then config, in one shell
+        cmds = []
+        for driver in (nvme, spdk):
+            cmds += ['echo "%s" > "/sys/bus/pci/devices/%s/driver/remove_id" 2> /dev/null' % (vid, bdf),
+                     'echo "%s" > "/sys/bus/pci/devices/%s/driver/unbind" 2> /dev/null' % (bdf, bdf),
+                     'echo "%s" > "/sys/bus/pci/drivers/%s/new_id" 2> /dev/null' % (vid, driver),
+                     'echo "%s" > "/sys/bus/pci/drivers/%s/bind" 2> /dev/null' % (bdf, driver)]
+        subprocess.call('; '.join(cmds) + '; true', shell=True)
 
         # reset driver: namespace is init by every test, so no need reinit
         self._nvme._reinit()
+        self._caps = None
+
+
+class TcpTargetError(Exception):
+    pass
+
+
+class TcpTarget(object):
+    """NVMe/TCP target on the loopback interface. Prefer to use fixture "tcp_nvme0" in test scripts.
+
+    The target is an SPDK nvmf_tgt process with RAM based namespaces,
+    listening on a free TCP port of 127.0.0.1, so scripts can run the
+    data path, ioworker and data verification without any NVMe device.
+
+    # Attributes
+        size_mb (int): size of each namespace in MB. Default: 64
+        sector_size (int): sector size of each namespace in bytes. Default: 512
+        ns_count (int): number of namespaces. Default: 1
+        core_mask (int): cores polled by the target process. Default: 0, use the last core
+        in_capsule_data (int): in-capsule data size of the TCP transport in bytes. Default: 0, SPDK default
+
+    Example:
+```python
+        >>> with TcpTarget(size_mb=256) as target:
+        >>>     nvme0 = Controller(b'127.0.0.1', target.port)
+```
+    """
+
+    def __init__(self, size_mb=64, sector_size=512, ns_count=1, core_mask=0,
+                 in_capsule_data=0):
+        spdk = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spdk")
+        self._app = os.environ.get("PYNVME_NVMF_TGT", os.path.join(spdk, "app/nvmf_tgt/nvmf_tgt"))
+        self._rpc = os.path.join(spdk, "scripts/rpc.py")
+        self.size_mb = size_mb
+        self.sector_size = sector_size
+        self.ns_count = ns_count
+        self.core_mask = core_mask if core_mask else 1<<(os.cpu_count()-1)
+        self.in_capsule_data = in_capsule_data
+        self.port = 0
+        self.subnqn = None
+        self._p = None
+
+    @property
+    def available(self):
+        """True if the nvmf_tgt application is found"""
+        return os.path.exists(self._app)
+
+    def _rpc_call(self, *args):
+        cmd = [sys.executable, self._rpc, "-s", self._sock] + [str(a) for a in args]
+        if subprocess.call(cmd, stdout=subprocess.DEVNULL) != 0:
+            raise TcpTargetError("target rpc fail: %s" % ' '.join(cmd[2:]))
+
+    def start(self):
+        """start the target process, and create its subsystem and namespaces"""
+
+        assert self._p is None, "target is already started"
+        if not os.path.exists(self._app):
+            raise TcpTargetError("nvmf_tgt not found: %s" % self._app)
+
+        # find a free port
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.subnqn = "nqn.2016-06.io.spdk:pynvme%d" % self.port
+        self._sock = "/var/tmp/pynvme_tgt.%d.sock" % self.port
+
+        logging.debug("start nvme/tcp target on port %d" % self.port)
+        self._p = subprocess.Popen([self._app, "-m", hex(self.core_mask), "-r", self._sock,
+                                    "-s", str(self.size_mb*self.ns_count+256)],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # wait the rpc server of the target
+        deadline = time.time() + 10
+        while not os.path.exists(self._sock):
+            if self._p.poll() is not None or time.time() > deadline:
+                self.stop()
+                raise TcpTargetError("target fail to start")
+            time.sleep(0.1)
+
+        try:
+            if self.in_capsule_data:
+                self._rpc_call("nvmf_create_transport", "-t", "TCP",
+                               "-c", self.in_capsule_data)
+            else:
+                self._rpc_call("nvmf_create_transport", "-t", "TCP")
+            self._rpc_call("nvmf_subsystem_create", self.subnqn, "-a", "-s", "PYNVME%013d" % self.port)
+            for i in range(self.ns_count):
+                self._rpc_call("construct_malloc_bdev", "-b", "Malloc%d" % i,
+                               self.size_mb, self.sector_size)
+                self._rpc_call("nvmf_subsystem_add_ns", self.subnqn, "Malloc%d" % i)
+            self._rpc_call("nvmf_subsystem_add_listener", self.subnqn,
+                           "-t", "tcp", "-a", "127.0.0.1", "-s", self.port)
+        except TcpTargetError:
+            self.stop()
+            raise
+        return self
+
+    def stop(self):
+        """stop the target process"""
+
+        if self._p is None:
+            return
+
+        logging.debug("stop nvme/tcp target on port %d" % self.port)
+        self._p.terminate()
+        try:
+            self._p.wait(10)
+        except subprocess.TimeoutExpired:
+            self._p.kill()
+            self._p.wait()
+        self._p = None
+
+        if os.path.exists(self._sock):
+            os.remove(self._sock)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
 
 
 class NvmeEnumerateError(Exception):
@@ -770,6 +1244,15 @@ cdef class Controller(object):
         addr (bytes): the bus/device/function address of the DUT, for example:
                       b'01:00.0' (PCIe BDF address);
                       b'127.0.0.1' (TCP IP address).
+        trsvcid (int): TCP port of the NVMe/TCP target. Default: 4420
+        subnqn (bytes): NQN of the NVMe/TCP subsystem to connect. Default: None, the discovery subsystem
+        hdgst (bool): enable NVMe/TCP PDU header digest. Default: False
+        ddgst (bool): enable NVMe/TCP PDU data digest. Default: False
+        io_queue_size (int): entries of IO queues. Default: 0, the maximum the controller supports
+
+    Each ioworker connects the controller again with the same options in
+    its own process, so every ioworker qpair has its own TCP connection
+    polled on its own core.
 
     Example:
 ```python
@@ -807,10 +1290,28 @@ cdef class Controller(object):
 
     cdef d.ctrlr * _ctrlr
     cdef char _bdf[20]
+    cdef d.nvme_transport_opts _opts
+    cdef dict _transport
     cdef Buffer hmb_buf
+    cdef dict _cache
+    cdef set _cache_cbs
+    cdef object _aer_cb
 
-    def __cinit__(self, addr):
+    def __cinit__(self, addr, trsvcid=4420, subnqn=None,
+                  hdgst=False, ddgst=False, io_queue_size=0):
         strncpy(self._bdf, addr, strlen(addr)+1)
+        memset(&self._opts, 0, sizeof(self._opts))
+        self._opts.trsvcid = trsvcid
+        if subnqn:
+            assert len(subnqn) < sizeof(self._opts.subnqn), "subnqn is too long"
+            strncpy(self._opts.subnqn, subnqn, len(subnqn)+1)
+        self._opts.hdgst = hdgst
+        self._opts.ddgst = ddgst
+        self._opts.io_queue_size = io_queue_size
+        self._transport = dict(trsvcid=trsvcid, subnqn=subnqn, hdgst=hdgst,
+                               ddgst=ddgst, io_queue_size=io_queue_size)
+        self._cache = {}
+        self._cache_cbs = set()
         self._create()
 
     def __dealloc__(self):
@@ -823,7 +1324,8 @@ cdef class Controller(object):
         self._create()
 
     def _create(self):
-        self._ctrlr = d.nvme_init(self._bdf)
+        self._cache_clear()
+        self._ctrlr = d.nvme_init(self._bdf, &self._opts)
         # print("created ctrlr: %x" % <unsigned long>self._ctrlr); sys.stdout.flush()
         if self._ctrlr is NULL:
             raise NvmeEnumerateError(f"fail to create the controller")
@@ -831,6 +1333,59 @@ cdef class Controller(object):
         self.register_aer_cb(None)
         logging.debug("nvme initialized: %s", self._bdf)
 
+    def _cache_clear(self):
+        # identify data and commands supported log page are cached, and
+        # cleared by commands which may change them
+        logging.debug("clear identify data cache")
+        self._cache.clear()
+
+    def _cache_clear_cb(self, func):
+        # clear the cache again at completion, because identify data read
+        # before the command completes is stale
+        def cb(cdw0, status1):
+            self._cache_cbs.discard(cb)
+            self._cache_clear()
+            if func is not None:
+                func(cdw0, status1)
+            elif (status1>>1) & 0x7ff:
+                sc = (status1>>1) & 0xff
+                sct = (status1>>9) & 0x7
+                warnings.warn("ERROR status: %02x/%02x" % (sct, sc))
+
+        # hold the callback until the command completes
+        self._cache_cbs.add(cb)
+        return cb
+
+    def _cache_get(self, key, func):
+        cdef Buffer buf
+        status = []
+
+        def cb(cdw0, status1):
+            status.append(status1)
+
+        # get the data buffer from cache, or read it from device on miss
+        if key not in self._cache:
+            buf = Buffer.from_pool(4096)
+            func(buf, cb).waitdone()
+            if not status or (status[0]>>1)&0x7ff:
+                # not cache the data of a failed command
+                sc = (status[0]>>1)&0xff if status else 0
+                sct = (status[0]>>9)&0x7 if status else 0
+                warnings.warn("ERROR status: %02x/%02x" % (sct, sc))
+                return buf
+            self._cache[key] = buf
+        return self._cache[key]
+
+    def _identity(self):
+        # model, firmware and serial number in the identify data kept by
+        # the driver. No admin command is sent, so completions of the
+        # outstanding admin commands are left to the script.
+        cdef Buffer buf = Buffer.from_pool(4096)
+        memcpy(buf.ptr, d.nvme_get_identify_data(self._ctrlr), 4096)
+        return dict(model=buf.data(63, 24, str),
+                    firmware=buf.data(71, 64, str),
+                    serial=buf.data(23, 4, str))
+
     def enable_hmb(self):
         # init hmb function
         hmb_size = self.id_data(275, 272)
@@ -911,17 +1466,38 @@ cdef class Controller(object):
         logging.debug("cc.en 1=>0")
         self[0x14] = cc & 0xfffffffe
         while (self[0x1c] & 1) == 1:
-            logging.debug("wait csts.rdy, 0x%x" % self[0x1c])
+            pass
 
         logging.debug("cc.en 0=>1")
         cc = self[0x14]
         self[0x14] = cc | 1
         while (self[0x1c] & 1) == 0:
-            logging.debug("wait csts.rdy, 0x%x" % self[0x1c])
+            pass
 
         # reset driver
         self._reinit()
 
+    def fast_reset(self):
+        """controller reset in place: cc.en 1 => 0 => 1, without re-enumerating the controller
+
+        Existing io qpairs are re-created with the same qid, depth and priority after reset, so Qpair objects are still valid. Outstanding commands are aborted.
+
+        # Returns
+            (DotDict): timing of the reset in us: disable_us (cc.en 0 to csts.rdy 0), admin_us (cc.en 1 to admin queue ready, including csts.rdy 1), io_us (all io qpairs re-created), and qpair_count
+
+        # Raises
+            SystemError: the controller fails to reset
+        """
+
+        cdef d.nvme_reset_timing timing
+
+        ret = d.nvme_reset_inplace(self._ctrlr, &timing)
+        self._cache_clear()
+        if ret != 0:
+            raise SystemError("controller reset fail: %d" % ret)
+        logging.debug("fast reset timing: %s" % timing)
+        return DotDict(timing)
+
     def cmdname(self, opcode):
         """get the name of the admin command
 
@@ -947,9 +1523,9 @@ cdef class Controller(object):
         """
 
         assert opcode < 256*2 # *2 for nvm command set
-        logpage_buf = Buffer(4096)
-        self.getlogpage(5, logpage_buf).waitdone()
-        return logpage_buf.data((opcode+1)*4-1, opcode*4) != 0
+        buf = self._cache_get('commands_supported',
+                              lambda b, cb: self.getlogpage(5, b, cb=cb))
+        return buf.data((opcode+1)*4-1, opcode*4) != 0
 
     def waitdone(self, expected=1):
         """sync until expected commands completion
@@ -1050,10 +1626,20 @@ cdef class Controller(object):
 
         # Returns
             (int or str): the data in the specified field
+
+        # Notices
+            identify data of controller and namespaces are cached, and refreshed after reset, format, sanitize, firmware commit and namespace management.
         """
 
-        id_buf = Buffer(4096)
-        self.identify(id_buf, nsid, cns).waitdone()
+        cdef Buffer id_buf
+
+        if cns in (0, 1):
+            id_buf = self._cache_get(('identify', nsid, cns),
+                                     lambda b, cb: self.identify(b, nsid, cns, cb=cb))
+        else:
+            id_buf = Buffer.from_pool(4096)
+            self.identify(id_buf, nsid, cns).waitdone()
+
         return id_buf.data(byte_end, byte_begin, type)
 
     def getfeatures(self, fid, cdw11=0, cdw12=0, cdw13=0, cdw14=0, cdw15=0,
@@ -1282,23 +1868,54 @@ cdef class Controller(object):
                             cb_arg=<void*>cb)
         return self
 
-    def downfw(self, filename, slot=0, action=1):
-        """firmware download utility: by 4K, and activate in next reset
+    def downfw(self, filename, slot=0, action=1, qdepth=4):
+        """firmware download utility: by chunks in the granularity of FWUG and limited by mdts, and activate in next reset
 
         # Attributes
             filename (str): the pathname of the firmware binary file to download
             slot (int): firmware slot field in the command. Default: 0, decided by device
-            cb (function): callback function called at completion. Default: None
+            action (int): action field in the firmware commit command. Default: 1
+            qdepth (int): max number of firmware download commands outstanding at the same time. Default: 4
 
-        # Returns
+        # Raises
+            ValueError: the firmware image file is empty, or the FWUG granularity is larger than mdts
+
+        # Notices
+            The last chunk is padded with zeroes to the granularity. Set qdepth to 1 if the device cannot accept overlapped firmware download commands.
         """
 
-        logging.info("download firmware image %s to slot %d and activate" % (filename, slot))
-        with open(filename, "rb") as f:
-            buf = Buffer(4096)
-            for i, chunk in enumerate(iter(lambda: f.read(4096), b'')):
-                buf[:] = chunk
-                self.fw_download(buf, 4096*i).waitdone()
+        cdef Buffer buf
+        cdef const unsigned char[:] chunk
+
+        if os.path.getsize(filename) == 0:
+            raise ValueError("firmware image file is empty: %s" % filename)
+
+        # 0: no information, 0xff: no restriction
+        fwug = self.id_data(319)
+        granularity = 4096 if fwug in (0, 0xff) else fwug*4096
+        if granularity > self.mdts:
+            raise ValueError("FWUG granularity %d is larger than mdts %d" %
+                             (granularity, self.mdts))
+        chunk_size = min(self.mdts, 2*1024*1024)//granularity*granularity
+        if chunk_size == 0:
+            # granularity larger than 2MB still fits in one transfer
+            chunk_size = granularity
+
+        logging.info("download firmware image %s to slot %d and activate, chunk size %d" %
+                     (filename, slot, chunk_size))
+        with open(filename, "rb") as f, \
+             mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as image:
+            bufs = [Buffer.from_pool(chunk_size) for i in range(qdepth)]
+            offsets = range(0, len(image), chunk_size)
+            for i in range(0, len(offsets), qdepth):
+                batch = offsets[i:i+qdepth]
+                for buf, offset in zip(bufs, batch):
+                    chunk = image[offset:offset+chunk_size]
+                    size = (len(chunk)+granularity-1)//granularity*granularity
+                    memcpy(buf.ptr, &chunk[0], len(chunk))
+                    memset(<unsigned char*>buf.ptr+len(chunk), 0, size-len(chunk))
+                    self.fw_download(buf, offset, size)
+                self.waitdone(len(batch))
         self.fw_commit(slot, action).waitdone()
         logging.info("download firmware completed")
 
@@ -1326,18 +1943,117 @@ cdef class Controller(object):
                             cb_arg=<void*>cb)
         return self
 
+    def _poll(self):
+        return d.nvme_wait_completion_admin(self._ctrlr)
+
+    async def identify_async(self, buf, nsid=0, cns=1):
+        """identify admin command, awaitable in asyncio event loop
+
+        # Attributes
+            same as identify()
+
+        # Returns
+            (tuple): cdw0 and status of the completion
+        """
+
+        return await _poller.submit(self._poll,
+                                    lambda cb: self.identify(buf, nsid, cns, cb=cb))
+
+    async def getfeatures_async(self, fid, cdw11=0, cdw12=0, cdw13=0, cdw14=0, cdw15=0,
+                                sel=0, buf=None):
+        """getfeatures admin command, awaitable in asyncio event loop
+
+        # Attributes
+            same as getfeatures()
+
+        # Returns
+            (tuple): cdw0 and status of the completion
+        """
+
+        return await _poller.submit(self._poll,
+                                    lambda cb: self.getfeatures(fid, cdw11, cdw12, cdw13, cdw14, cdw15,
+                                                                sel, buf, cb=cb))
+
+    async def setfeatures_async(self, fid, cdw11=0, cdw12=0, cdw13=0, cdw14=0, cdw15=0,
+                                sv=0, buf=None):
+        """setfeatures admin command, awaitable in asyncio event loop
+
+        # Attributes
+            same as setfeatures()
+
+        # Returns
+            (tuple): cdw0 and status of the completion
+        """
+
+        return await _poller.submit(self._poll,
+                                    lambda cb: self.setfeatures(fid, cdw11, cdw12, cdw13, cdw14, cdw15,
+                                                                sv, buf, cb=cb))
+
+    async def getlogpage_async(self, lid, buf, size=None, offset=0, nsid=0xffffffff):
+        """getlogpage admin command, awaitable in asyncio event loop
+
+        Example:
+```python
+            >>> async def smart_temperature(nvme0):
+            ...     smart_log = Buffer(512)
+            ...     await nvme0.getlogpage_async(0x02, smart_log, 512)
+            ...     return smart_log.data(2, 1)
+```
+
+        # Attributes
+            same as getlogpage()
+
+        # Returns
+            (tuple): cdw0 and status of the completion
+        """
+
+        return await _poller.submit(self._poll,
+                                    lambda cb: self.getlogpage(lid, buf, size, offset, nsid, cb=cb))
+
+    async def send_cmd_async(self, opcode, buf=None, nsid=0,
+                             cdw10=0, cdw11=0, cdw12=0,
+                             cdw13=0, cdw14=0, cdw15=0):
+        """send generic admin commands, awaitable in asyncio event loop
+
+        # Attributes
+            same as send_cmd()
+
+        # Returns
+            (tuple): cdw0 and status of the completion
+        """
+
+        return await _poller.submit(self._poll,
+                                    lambda cb: self.send_cmd(opcode, buf, nsid,
+                                                             cdw10, cdw11, cdw12,
+                                                             cdw13, cdw14, cdw15, cb=cb))
+
     def register_aer_cb(self, func):
         """register aer callback to driver.
 
         It is recommended to use fixture aer(func) in pytest scripts.
         When aer is triggered, the python callback function will
         be called. It is unregistered by aer fixture when test finish.
+        The identify data cache is cleared by the Namespace Attribute
+        Changed event before the callback function is called.
 
         # Attributes
             func (function): callback function called at aer completion
         """
 
-        d.nvme_register_aer_cb(self._ctrlr, aer_cmd_cb, <void*>func)
+        def cb(cdw0, status1):
+            # namespace attribute changed
+            if cdw0&0x7 == 2 and (cdw0>>8)&0xff == 0:
+                self._cache_clear()
+            if func is not None:
+                func(cdw0, status1)
+            elif (status1>>1) & 0x7ff:
+                sc = (status1>>1) & 0xff
+                sct = (status1>>9) & 0x7
+                warnings.warn("ERROR status: %02x/%02x" % (sct, sc))
+
+        # hold the callback registered to the driver
+        self._aer_cb = cb
+        d.nvme_register_aer_cb(self._ctrlr, aer_cmd_cb, <void*>cb)
 
     def send_cmd(self, opcode, buf=None, nsid=0,
                  cdw10=0, cdw11=0, cdw12=0,
@@ -1383,6 +2099,7 @@ cdef class Controller(object):
                             void* cb_arg):
         cdef void* ptr
         cdef size_t size
+        cdef object cb
 
         if buf is None:
             ptr = NULL
@@ -1391,6 +2108,12 @@ cdef class Controller(object):
             ptr = buf.ptr
             size = buf.size
 
+        # fw commit, ns management, ns attachment, format and sanitize
+        if opcode in (0x10, 0x0d, 0x15, 0x80, 0x84) and cb_func == cmd_cb:
+            self._cache_clear()
+            cb = self._cache_clear_cb(<object>cb_arg)
+            cb_arg = <void*>cb
+
         logging.debug("send admin command, opcode %xh" % opcode)
         ret = d.nvme_send_cmd_raw(self._ctrlr, NULL, opcode, nsid, ptr, size,
                                   cdw10, cdw11, cdw12, cdw13, cdw14, cdw15,
@@ -1407,6 +2130,14 @@ class QpairDeletionError(Exception):
     pass
 
 
+_cmd_stage_names = ('python', 'build', 'submit', 'device', 'cmdlog', 'callback')
+
+
+_qpair_wait_modes = {'poll': d.QPAIR_WAIT_POLL,
+                     'interrupt': d.QPAIR_WAIT_INTERRUPT,
+                     'hybrid': d.QPAIR_WAIT_HYBRID}
+
+
 cdef class Qpair(object):
     """Qpair class. IO SQ and CQ are combinded as qpairs.
 
@@ -1414,20 +2145,38 @@ cdef class Qpair(object):
         nvme (Controller): controller where to create the queue
         depth (int): SQ/CQ queue depth
         prio (int): when Weighted Round Robin is enabled, specify SQ priority here
+        reap_depth (int): keep up to reap_depth completions of commands sent without callback functions, and scripts get them by reap(). Default: 0, the reap mode is disabled
+        wait (str): how waitdone() waits completions. 'poll': busy polling the CQ. 'interrupt': check the CQ only when its MSI-X vector fired, and back off with pause and sleep when nothing fired. 'hybrid': busy polling for a short while after each completion, then wait as 'interrupt'. Default: 'poll'
     """
 
     cdef d.qpair * _qpair
+    cdef d.qpair_reap_ring * _ring
+    cdef unsigned int _depth
+    cdef unsigned int _reap_depth
+    cdef unsigned int _wait_mode
 
     def __cinit__(self, Controller nvme,
                   unsigned int depth,
-                  unsigned int prio=0):
+                  unsigned int prio=0,
+                  unsigned int reap_depth=0,
+                  wait='poll'):
         # create CQ and SQ
         if depth < 2:
             raise QpairCreationError("depth should >= 2")
+        if wait not in _qpair_wait_modes:
+            raise QpairCreationError("wait should be one of %s" % list(_qpair_wait_modes))
+        self._wait_mode = _qpair_wait_modes[wait]
 
         self._qpair = d.qpair_create(nvme._ctrlr, prio, depth)
         if self._qpair is NULL:
             raise QpairCreationError("qpair create fail")
+        self._depth = depth
+
+        if reap_depth:
+            self._ring = d.qpair_reap_init(self._qpair, reap_depth)
+            if self._ring is NULL:
+                raise MemoryError()
+            self._reap_depth = reap_depth
 
     def __dealloc__(self):
         # print("dealloc qpair: %x" % <unsigned long>self._qpair); sys.stdout.flush()
@@ -1436,6 +2185,22 @@ cdef class Qpair(object):
                 raise QpairDeletionError()
             self._qpair = NULL
 
+        # no more completions after the qpair is freed
+        if self._ring is not NULL:
+            d.qpair_reap_fini(self._ring)
+            self._ring = NULL
+
+    cdef d.cmd_cb_func cb_func(self, d.cmd_cb_func cb_func, void* cb_arg):
+        # completions go to the reap ring when scripts give no callback
+        if self._ring is not NULL and cb_func == cmd_cb and cb_arg == <void*>None:
+            return d.qpair_reap_cb
+        return cb_func
+
+    cdef void* cb_arg(self, d.cmd_cb_func cb_func, void* cb_arg):
+        if self._ring is not NULL and cb_func == cmd_cb and cb_arg == <void*>None:
+            return self._ring
+        return cb_arg
+
     def __repr__(self):
         return "<qpair: %d>" % self.sqid
 
@@ -1452,6 +2217,9 @@ cdef class Qpair(object):
 
         d.log_cmd_dump(self._qpair, count)
 
+    def _poll(self):
+        return d.qpair_wait_completion(self._qpair, 0)
+
     def msix_clear(self):
         d.intc_clear(self._qpair)
 
@@ -1464,6 +2232,97 @@ cdef class Qpair(object):
     def msix_unmask(self):
         d.intc_unmask(self._qpair)
 
+    def reap(self, max_count=0):
+        """get completions kept in the reap ring, after processing the completion queue.
+
+        Example:
+```python
+            >>> q = Qpair(nvme0, 64, reap_depth=1024)
+            >>> for i in range(1000):
+            ...     nvme0n1.read(q, buf, i)
+            >>> q.waitdone(1000)
+            >>> cpls = q.reap()
+            >>> assert not any(cpls.status)
+```
+
+        # Attributes
+            max_count (int): the max number of completions to get. Default: 0, to get all completions in the ring
+
+        # Returns
+            (DotDict): array.array of cid, cdw0, status (without phase tag) and latency (in us) of completions, in the order of completion
+        """
+
+        cdef d.qpair_reap_entry* entries
+        cdef unsigned int[:] cdw0_view
+        cdef unsigned int[:] latency_view
+        cdef unsigned short[:] cid_view
+        cdef unsigned short[:] status_view
+        cdef unsigned int i
+
+        assert self._ring is not NULL, "reap mode is not enabled in this qpair"
+        if max_count == 0 or max_count > self._reap_depth:
+            max_count = self._reap_depth
+        entries = <d.qpair_reap_entry*>PyMem_Malloc(max_count*sizeof(d.qpair_reap_entry))
+        if not entries:
+            raise MemoryError()
+
+        count = d.qpair_reap(self._ring, self._qpair, max_count, entries)
+        cid = array.array('H', bytes(2*count))
+        status = array.array('H', bytes(2*count))
+        cdw0 = array.array('I', bytes(4*count))
+        latency = array.array('I', bytes(4*count))
+        if count:
+            cid_view = cid
+            status_view = status
+            cdw0_view = cdw0
+            latency_view = latency
+            for i in range(count):
+                cid_view[i] = entries[i].cid
+                status_view[i] = entries[i].status
+                cdw0_view[i] = entries[i].cdw0
+                latency_view[i] = entries[i].latency_us
+        PyMem_Free(entries)
+
+        dropped = d.qpair_reap_dropped(self._ring)
+        if dropped:
+            warnings.warn("%d completions dropped before reaped" % dropped)
+        return DotDict(cid=cid, cdw0=cdw0, status=status, latency=latency)
+
+    def stages(self, clear=False):
+        """get time spent in each stage of the commands sent in this qpair.
+
+        Stages are traced only after enabled by config(stages=True). Time
+        of each command is counted in log2 histograms of nanoseconds in
+        these intervals:
+            python: from the entry of read/write method to the driver
+            build: build the sqe and fill data in the driver
+            submit: submit the sqe to the doorbell
+            device: from the doorbell to the cqe is reaped
+            cmdlog: cmdlog callback, including read data verification
+            callback: from the cmdlog to the user callback
+
+        The same stages are also available as USDT probes in provider
+        pynvme (cmd_submit, cmd_doorbell, cmd_complete, cmd_callback), so
+        perf or bpftrace can trace them without enabling the config.
+
+        # Attributes
+            clear (bool): clear the statistics after getting them. Default: False
+
+        # Returns
+            (DotDict): count, average_us and histogram of each interval. The histogram is an array.array, and item i counts commands taking [2^i, 2^(i+1)) ns
+        """
+
+        cdef d.cmd_stage_stats stats[d.CMD_STAGE_INTERVAL_COUNT]
+
+        d.cmdlog_stage_stats(d.qpair_get_id(self._qpair), stats, clear)
+        ret = DotDict()
+        for i, name in enumerate(_cmd_stage_names):
+            count = stats[i].count
+            ret[name] = DotDict(count=count,
+                                average_us=stats[i].sum_ns/count/1000 if count else 0,
+                                histogram=array.array('L', [stats[i].hist[j] for j in range(d.CMD_STAGE_HIST_COUNT)]))
+        return ret
+
     def waitdone(self, expected=1):
         """sync until expected commands completion
 
@@ -1481,13 +2340,16 @@ cdef class Qpair(object):
         _reentry_flag = True
 
         logging.debug("to reap %d io commands, sqid %d" % (expected, self.sqid))
-        signal.alarm(_cTIMEOUT_wrap)
+        deadline = time.time() + _cTIMEOUT_wrap
         while reaped < expected:
-            # wait IO Q pair done, max 8 cpl in one time
-            max_to_reap = (expected-reaped) % 8
-            reaped += d.qpair_wait_completion(self._qpair, max_to_reap)
+            # reap in c, and come back to check signals every 100ms
+            ret = d.qpair_wait_completion_until(self._qpair, expected-reaped,
+                                                100, self._wait_mode)
+            assert ret >= 0, "error in processing completions: %d" % ret
+            reaped += ret
             PyErr_CheckSignals()
-        signal.alarm(0)
+            if reaped < expected and time.time() > deadline:
+                _timeout_signal_handler(None, None)
 
         assert reaped == expected, \
             "not reap the exact completions! reaped %d, expected %d" % (reaped, expected)
@@ -1508,10 +2370,13 @@ cdef class Namespace(object):
     # Attributes
         nvme (Controller): controller where to create the queue
         nsid (int): nsid of the namespace
+
+    # Notices
+        The checksum table of data verification is kept for the first namespace opened in the process. When another namespace is opened, e.g. on a NVMe/TCP controller, data verification is disabled for all namespaces with a warning, and config() reports verify as False. It is enabled again when only the first namespace is left, and checksums of the data written before are discarded.
     """
 
     cdef d.namespace * _ns
-    cdef char _bdf[8]
+    cdef char _bdf[20]
     cdef unsigned int _nsid
     cdef unsigned int sector_size
     cdef Controller _nvme
@@ -1519,13 +2384,15 @@ cdef class Namespace(object):
     def __cinit__(self, Controller nvme, unsigned int nsid=1):
         logging.debug("initialize namespace nsid %d" % nsid)
         self._nvme = nvme
-        strncpy(self._bdf, nvme._bdf, 8)
+        strncpy(self._bdf, nvme._bdf, 20)
         self._nsid = nsid
         self._ns = d.ns_init(nvme._ctrlr, nsid)
         # print("created namespace: %x" % <unsigned long>self._ns); sys.stdout.flush()
         if self._ns is NULL:
             raise NamespaceCreationError()
         self.sector_size = d.ns_get_sector_size(self._ns)
+        if not d.driver_verify_available():
+            warnings.warn("data verification is disabled: checksum table is not available to nsid %d" % nsid)
 
     def close(self):
         """close namespace to release it resources in host memory.
@@ -1633,7 +2500,8 @@ cdef class Namespace(object):
                  read_percentage, time=0, qdepth=64,
                  region_start=0, region_end=0xffff_ffff_ffff_ffff,
                  iops=0, io_count=0, lba_start=0, qprio=0,
-                 output_io_per_second=None, output_percentile_latency=None):
+                 output_io_per_second=None, output_percentile_latency=None,
+                 sgl_segment_size=0, sample_interval_ms=0, latency_interval_ms=0):
         """workers sending different read/write IO on different CPU cores.
 
         User defines IO characteristics in parameters, and then the ioworker
@@ -1661,29 +2529,64 @@ cdef class Namespace(object):
             qprio (int): SQ priority. Default: 0, as Round Robin arbitration
             output_io_per_second (list): list to hold the output data of io_per_second. Default: None, not to collect the data
             output_percentile_latency (dict): dict of io counter on different percentile latency. Dict key is the percentage, and the value is the latency in ms. Default: None, not to collect the data
+            sgl_segment_size (int): use scatter-gather data buffers made of segments in this size (in bytes), 4096 to 2MB. Default: 0, use contiguous data buffers
+            sample_interval_ms (int): collect IO counters in samples of this interval in ms, returned in samples of the result. Default: 0, not to collect the samples
+            latency_interval_ms (int): collect latency percentiles of each interval in ms, e.g. 1000, returned in latency_intervals of the result. Default: 0, not to collect the percentiles
 
         # Returns
             ioworker object
+
+        # Notices
+            Samples are kept in a buffer of at most 65536 samples. When it is full, the older half of samples are merged in pairs, so older samples cover longer intervals. The result's samples is a DotDict of array.array: time_ms (end of each sample since the start), io_count_read, io_count_write and bytes.
+
+            The result's latency_intervals is a DotDict of array.array: time_ms (end of each interval since the start), io_count, p50_us, p99_us, p999_us and max_us. Percentiles are taken from a histogram of 8 buckets in each power of 2 of us, so they are within 12.5% of the exact latency. Intervals are kept in a buffer of at most 65536 intervals, and merged in the same way as samples. Merged intervals keep the larger percentiles of the two.
         """
 
         assert not (time==0 and io_count==0), "when to stop the ioworker?"
         assert qdepth>0 and qdepth<=1023, "support qdepth upto 1023"
         assert qdepth <= (self._nvme[0]&0xffff) + 1, "qdepth is larger than specification"
         assert region_start < region_end, "region end is not included"
+        assert sgl_segment_size == 0 or \
+            (sgl_segment_size >= 4096 and sgl_segment_size <= 2*1024*1024 and \
+             (sgl_segment_size & (sgl_segment_size-1)) == 0), \
+            "segment size should be power of 2, in 4KB to 2MB"
+        assert sample_interval_ms >= 0, "sample interval should not be negative"
+        assert latency_interval_ms >= 0, "latency interval should not be negative"
+        assert time != 0 or output_io_per_second is None, \
+            "need time duration to collect io counter per second data"
 
         pciaddr = self._bdf
+        transport = self._nvme._transport
         nsid = self._nsid
-        return _IOWorker(pciaddr, nsid, lba_start, io_size, lba_align,
+
+        # embedded in the result for export
+        args = dict(io_size=io_size, lba_align=lba_align, lba_random=lba_random,
+                    read_percentage=read_percentage, time=time, qdepth=qdepth,
+                    region_start=region_start, region_end=region_end,
+                    iops=iops, io_count=io_count, lba_start=lba_start, qprio=qprio,
+                    sgl_segment_size=sgl_segment_size,
+                    sample_interval_ms=sample_interval_ms,
+                    latency_interval_ms=latency_interval_ms)
+        identity = self._nvme._identity()
+        device = dict(pciaddr=pciaddr.decode('ascii'), nsid=nsid,
+                      model=identity['model'],
+                      firmware=identity['firmware'],
+                      serial=identity['serial'],
+                      sector_size=self.sector_size)
+
+        return _IOWorker(pciaddr, transport, nsid, lba_start, io_size, lba_align,
                          lba_random, region_start, region_end,
                          read_percentage, iops, io_count, time, qdepth, qprio,
-                         output_io_per_second, output_percentile_latency)
+                         output_io_per_second, output_percentile_latency,
+                         sgl_segment_size, sample_interval_ms, latency_interval_ms,
+                         args, device)
 
     def read(self, qpair, buf, lba, lba_count=1, io_flags=0, cb=None):
         """read IO command
 
         # Attributes
             qpair (Qpair): use the qpair to send this command
-            buf (Buffer): the data buffer of the command, meta data is not supported.
+            buf (Buffer or SglBuffer): the data buffer of the command, meta data is not supported.
             lba (int): the starting lba address, 64 bits
             lba_count (int): the lba count of this command, 16 bits. Default: 1
             io_flags (int): io flags defined in NVMe specification, 16 bits. Default: 0
@@ -1699,10 +2602,16 @@ cdef class Namespace(object):
             buf cannot be released before the command completes.
         """
 
+        d.cmdlog_stage_entry((<Qpair?>qpair)._qpair)
         logging.debug(f"read, lba {lba}, lba_count {lba_count}")
         assert buf is not None, "no buffer allocated"
-        if 0 != self.send_read_write(True, qpair, buf, lba, lba_count,
-                                     io_flags, cmd_cb, <void*>cb):
+        if isinstance(buf, SglBuffer):
+            ret = self.send_sgl(2, qpair, buf, lba, lba_count,
+                                io_flags, cmd_cb, <void*>cb)
+        else:
+            ret = self.send_read_write(True, qpair, buf, lba, lba_count,
+                                       io_flags, cmd_cb, <void*>cb)
+        if 0 != ret:
             raise SystemError()
         return qpair
 
@@ -1711,7 +2620,7 @@ cdef class Namespace(object):
 
         # Attributes
             qpair (Qpair): use the qpair to send this command
-            buf (Buffer): the data buffer of the write command, meta data is not supported.
+            buf (Buffer or SglBuffer): the data buffer of the write command, meta data is not supported.
             lba (int): the starting lba address, 64 bits
             lba_count (int): the lba count of this command, 16 bits
             io_flags (int): io flags defined in NVMe specification, 16 bits. Default: 0
@@ -1727,10 +2636,16 @@ cdef class Namespace(object):
             buf cannot be released before the command completes.
         """
 
+        d.cmdlog_stage_entry((<Qpair?>qpair)._qpair)
         assert buf is not None, "no buffer allocated"
 
-        if 0 != self.send_read_write(False, qpair, buf, lba, lba_count,
-                                     io_flags, cmd_cb, <void*>cb):
+        if isinstance(buf, SglBuffer):
+            ret = self.send_sgl(1, qpair, buf, lba, lba_count,
+                                io_flags, cmd_cb, <void*>cb)
+        else:
+            ret = self.send_read_write(False, qpair, buf, lba, lba_count,
+                                       io_flags, cmd_cb, <void*>cb)
+        if 0 != ret:
             raise SystemError()
 
         return qpair
@@ -1772,7 +2687,7 @@ cdef class Namespace(object):
 
         # Attributes
             qpair (Qpair): use the qpair to send this command
-            buf (Buffer): the data buffer of the command, meta data is not supported.
+            buf (Buffer or SglBuffer): the data buffer of the command, meta data is not supported.
             lba (int): the starting lba address, 64 bits
             lba_count (int): the lba count of this command, 16 bits. Default: 1
             io_flags (int): io flags defined in NVMe specification, 16 bits. Default: 0
@@ -1790,11 +2705,15 @@ cdef class Namespace(object):
 
         assert buf is not None, "no buffer allocated"
 
-        self.send_io_raw(qpair, buf, 5, self._nsid,
-                         lba, lba>>32,
-                         (lba_count-1)+(io_flags<<16),
-                         0, 0, 0,
-                         cmd_cb, <void*>cb)
+        if isinstance(buf, SglBuffer):
+            self.send_sgl(5, qpair, buf, lba, lba_count,
+                          io_flags<<16, cmd_cb, <void*>cb)
+        else:
+            self.send_io_raw(qpair, buf, 5, self._nsid,
+                             lba, lba>>32,
+                             (lba_count-1)+(io_flags<<16),
+                             0, 0, 0,
+                             cmd_cb, <void*>cb)
         return qpair
 
     def flush(self, qpair, cb=None):
@@ -1865,6 +2784,252 @@ cdef class Namespace(object):
                          cmd_cb, <void*>cb)
         return qpair
 
+    def submit_many(self, Qpair qpair, op, Buffer buf, lbas, counts,
+                    buf_offsets=None, io_flags=0, qdepth=0):
+        """send a batch of read or write commands in one call, and wait all of them completed.
+
+        Commands are sent in the order of the arrays, and no more than qdepth commands are outstanding in the qpair. The whole batch is submitted and reaped in C without returning to Python for each command.
+
+        Example:
+```python
+            >>> lbas = numpy.arange(0, 8*1000, 8, dtype=numpy.uint64)
+            >>> counts = numpy.full(1000, 8, dtype=numpy.uint16)
+            >>> status, latency = nvme0n1.submit_many(qpair, 'read', buf, lbas, counts)
+            >>> assert not numpy.asarray(status).any()
+```
+
+        # Attributes
+            qpair (Qpair): use the qpair to send these commands
+            op (str): 'read' or 'write'
+            buf (Buffer): the data buffer shared by all commands
+            lbas (array): the starting lba of each command, uint64
+            counts (array): the lba count of each command, uint16
+            buf_offsets (array): the byte offset in buf of each command's data, uint64. Default: None, all commands use the beginning of buf
+            io_flags (int): io flags defined in NVMe specification, 16 bits. Default: 0
+            qdepth (int): max outstanding commands in the qpair. Default: 0, limited by the depth of the qpair only
+
+        # Returns
+            status (array.array): status field (without phase tag) of each command's completion, uint16. 0 for success.
+            latency (array.array): latency of each command in us, uint32
+
+        # Notices
+            Arrays can be numpy arrays, array.array or any object supporting the buffer protocol with the exact item type; other sequences are converted with a copy. Returned arrays can be converted to numpy arrays by numpy.asarray() without copy. Data of write commands is filled by the driver, the same as write().
+        """
+
+        cdef const unsigned long[:] lba_view
+        cdef const unsigned short[:] count_view
+        cdef const unsigned long[:] offset_view
+        cdef unsigned short[:] status_view
+        cdef unsigned int[:] latency_view
+        cdef const unsigned long* offset_ptr = NULL
+
+        assert op in ('read', 'write'), "op should be 'read' or 'write'"
+        try:
+            lba_view = lbas
+        except (ValueError, TypeError):
+            lba_view = array.array('L', lbas)
+        try:
+            count_view = counts
+        except (ValueError, TypeError):
+            count_view = array.array('H', counts)
+        if buf_offsets is not None:
+            try:
+                offset_view = buf_offsets
+            except (ValueError, TypeError):
+                offset_view = array.array('L', buf_offsets)
+            assert len(offset_view) == len(lba_view), "array length mismatch"
+        assert len(count_view) == len(lba_view), "array length mismatch"
+
+        n = len(lba_view)
+        status = array.array('H', bytes(2*n))
+        latency = array.array('I', bytes(4*n))
+        if n == 0:
+            return status, latency
+        status_view = status
+        latency_view = latency
+        if buf_offsets is not None:
+            offset_ptr = &offset_view[0]
+
+        # SQ holds depth-1 commands at most
+        if qdepth == 0 or qdepth > qpair._depth-1:
+            qdepth = qpair._depth-1
+
+        logging.debug(f"{op} {n} commands, qdepth {qdepth}")
+        ret = d.ns_cmd_read_write_many(op == 'read', self._ns, qpair._qpair,
+                                       buf.ptr, buf.size, n,
+                                       &lba_view[0], &count_view[0], offset_ptr,
+                                       io_flags, qdepth, _cTIMEOUT_wrap,
+                                       &status_view[0], &latency_view[0])
+        if ret == -ETIMEDOUT:
+            raise TimeoutError("batch commands timeout")
+        assert ret == 0, "error in submitting batch commands: %d" % ret
+        return status, latency
+
+    def dump_range(self, lba, lba_count, path, qdepth=64, io_size=256):
+        """copy a lba range of the namespace to a file.
+
+        Read commands are pipelined in an internal qpair, and the data is copied to the memory mapped file.
+
+        # Attributes
+            lba (int): the starting lba of the range
+            lba_count (int): the number of lba in the range
+            path (str): the file to write, which is created or truncated
+            qdepth (int): the number of outstanding read commands. Default: 64
+            io_size (int): lba count of each read command, limited by mdts. Default: 256
+
+        # Raises
+            SystemError: any read command fails
+        """
+
+        self._copy_file(False, path, lba, lba_count, qdepth, io_size)
+
+    def load_range(self, path, lba, qdepth=64, io_size=256):
+        """write the file to the namespace from the starting lba.
+
+        The file is memory mapped, and write commands are pipelined in an internal qpair. Data written by pynvme before can be verified after loading back to the same lba.
+
+        # Attributes
+            path (str): the file to read, which size should be multiple of the sector size
+            lba (int): the starting lba to write
+            qdepth (int): the number of outstanding write commands. Default: 64
+            io_size (int): lba count of each write command, limited by mdts. Default: 256
+
+        # Raises
+            SystemError: any write command fails
+        """
+
+        size = os.path.getsize(path)
+        assert size % self.sector_size == 0, "file size should be multiple of sector size"
+        self._copy_file(True, path, lba, size//self.sector_size, qdepth, io_size)
+
+    def deallocate(self, ranges, qdepth=8):
+        """deallocate (trim) many lba ranges.
+
+        Ranges are packed into DSM commands of up to 256 ranges each, and the commands are pipelined in an internal qpair. The checksum of all ranges is cleared before sending commands.
+
+        Example:
+```python
+            >>> nvme0n1.deallocate([(0, 8), (100, 16)])
+            >>> ranges = numpy.stack((numpy.arange(0, 1<<20, 8), numpy.full(1<<17, 4)), axis=1).astype(numpy.uint64)
+            >>> nvme0n1.deallocate(ranges, qdepth=16)
+```
+
+        # Attributes
+            ranges (array): lba ranges of (lba, lba_count) pairs. It can be a 2-d uint64 array in shape (N, 2), like a numpy array, or any sequence of pairs
+            qdepth (int): the number of outstanding DSM commands. Default: 8
+
+        # Raises
+            SystemError: any DSM command fails
+        """
+
+        cdef const unsigned long[:, ::1] range_view
+
+        try:
+            range_view = ranges
+        except (ValueError, TypeError):
+            flat = array.array('L', [v for r in ranges for v in r])
+            range_view = memoryview(flat).cast('B').cast('L', (len(flat)//2, 2))
+        assert range_view.shape[1] == 2, "ranges should be (lba, lba_count) pairs"
+        if range_view.shape[0] == 0:
+            return
+
+        qpair = Qpair(self._nvme, qdepth+1)
+        ret = d.ns_cmd_deallocate(self._ns, qpair._qpair, &range_view[0, 0],
+                                  range_view.shape[0], qdepth, _cTIMEOUT_wrap)
+        if ret == -ETIMEDOUT:
+            raise TimeoutError("pynvme timeout: %d sec" % _cTIMEOUT_wrap)
+        if ret != 0:
+            raise SystemError("deallocate fail: %d" % ret)
+
+    def _copy_file(self, is_load, path, lba, lba_count, qdepth, io_size):
+        io_size = min(io_size, self._nvme.mdts//self.sector_size, 0x10000)
+        qpair = Qpair(self._nvme, qdepth+1)
+        ret = d.ns_cmd_file(is_load, self._ns, qpair._qpair, path.encode('utf-8'),
+                            lba, lba_count, io_size, qdepth, _cTIMEOUT_wrap)
+        if ret == -ETIMEDOUT:
+            # deleting the qpair aborts the outstanding commands, and their
+            # callbacks release the buffers and the file mapping
+            del qpair
+            raise TimeoutError("pynvme timeout: %d sec" % _cTIMEOUT_wrap)
+        if ret != 0:
+            raise SystemError("%s range fail: %d" % ("load" if is_load else "dump", ret))
+
+    async def read_async(self, qpair, buf, lba, lba_count=1, io_flags=0):
+        """read IO command, awaitable in asyncio event loop
+
+        Example:
+```python
+            >>> async def read_two_qpairs(nvme0n1, q1, q2, b1, b2):
+            ...     await asyncio.gather(nvme0n1.read_async(q1, b1, 0),
+            ...                          nvme0n1.read_async(q2, b2, 8))
+```
+
+        # Attributes
+            same as read()
+
+        # Returns
+            (tuple): cdw0 and status of the completion
+        """
+
+        return await _poller.submit(qpair._poll,
+                                    lambda cb: self.read(qpair, buf, lba, lba_count, io_flags, cb=cb))
+
+    async def write_async(self, qpair, buf, lba, lba_count=1, io_flags=0):
+        """write IO command, awaitable in asyncio event loop
+
+        # Attributes
+            same as write()
+
+        # Returns
+            (tuple): cdw0 and status of the completion
+        """
+
+        return await _poller.submit(qpair._poll,
+                                    lambda cb: self.write(qpair, buf, lba, lba_count, io_flags, cb=cb))
+
+    async def compare_async(self, qpair, buf, lba, lba_count=1, io_flags=0):
+        """compare IO command, awaitable in asyncio event loop
+
+        # Attributes
+            same as compare()
+
+        # Returns
+            (tuple): cdw0 and status of the completion
+        """
+
+        return await _poller.submit(qpair._poll,
+                                    lambda cb: self.compare(qpair, buf, lba, lba_count, io_flags, cb=cb))
+
+    async def flush_async(self, qpair):
+        """flush IO command, awaitable in asyncio event loop
+
+        # Attributes
+            same as flush()
+
+        # Returns
+            (tuple): cdw0 and status of the completion
+        """
+
+        return await _poller.submit(qpair._poll,
+                                    lambda cb: self.flush(qpair, cb=cb))
+
+    async def send_cmd_async(self, opcode, qpair, buf=None, nsid=0,
+                             cdw10=0, cdw11=0, cdw12=0,
+                             cdw13=0, cdw14=0, cdw15=0):
+        """send generic IO commands, awaitable in asyncio event loop
+
+        # Attributes
+            same as send_cmd()
+
+        # Returns
+            (tuple): cdw0 and status of the completion
+        """
+
+        return await _poller.submit(qpair._poll,
+                                    lambda cb: self.send_cmd(opcode, qpair, buf, nsid,
+                                                             cdw10, cdw11, cdw12,
+                                                             cdw13, cdw14, cdw15, cb=cb))
+
     cdef int send_read_write(self,
                              bint is_read,
                              Qpair qpair,
@@ -1877,10 +3042,27 @@ cdef class Namespace(object):
         ret = d.ns_cmd_read_write(is_read, self._ns, qpair._qpair,
                                   buf.ptr, buf.size,
                                   lba, lba_count, io_flags,
-                                  cb_func, cb_arg)
+                                  qpair.cb_func(cb_func, cb_arg),
+                                  qpair.cb_arg(cb_func, cb_arg))
         assert ret == 0, "error in submitting read write commands: 0x%x" % ret
         return ret
 
+    cdef int send_sgl(self,
+                      unsigned int opcode,
+                      Qpair qpair,
+                      SglBuffer buf,
+                      unsigned long lba,
+                      unsigned int lba_count,
+                      unsigned int io_flags,
+                      d.cmd_cb_func cb_func,
+                      void* cb_arg):
+        ret = d.ns_cmd_io_sgl(opcode, self._ns, qpair._qpair, buf.sgl,
+                              lba, lba_count, io_flags,
+                              qpair.cb_func(cb_func, cb_arg),
+                              qpair.cb_arg(cb_func, cb_arg))
+        assert ret == 0, "error in submitting sgl commands: 0x%x" % ret
+        return ret
+
     def send_cmd(self, opcode, qpair, buf=None, nsid=0,
                  cdw10=0, cdw11=0, cdw12=0,
                  cdw13=0, cdw14=0, cdw15=0,
@@ -1939,7 +3121,9 @@ cdef class Namespace(object):
 
         ret = d.nvme_send_cmd_raw(self._nvme._ctrlr, qpair._qpair, opcode,
                                   nsid, ptr, size, cdw10, cdw11, cdw12,
-                                  cdw13, cdw14, cdw15, cb_func, cb_arg)
+                                  cdw13, cdw14, cdw15,
+                                  qpair.cb_func(cb_func, cb_arg),
+                                  qpair.cb_arg(cb_func, cb_arg))
         assert ret == 0, "error in submitting io commands, 0x%x" % ret
         return ret
 
@@ -1951,13 +3135,89 @@ class DotDict(dict):
         self.__dict__ = self
 
 
+class IOWorkerResult(DotDict):
+    """result of an ioworker, returned by its close()
+
+    Scalar statistics are exported to JSON as a summary, and time series
+    and histograms are exported in columns to numpy's .npz file. Both
+    embed the device identity and the ioworker arguments.
+    """
+
+    def columns(self):
+        """time series and histograms in flat columns
+
+        # Returns
+            (dict): column name to array.array. Columns of samples and latency_intervals are named like "samples.time_ms"
+        """
+
+        ret = {}
+        for k, v in self.items():
+            if isinstance(v, array.array):
+                ret[k] = v
+            elif isinstance(v, list):
+                ret[k] = array.array('Q', v)
+            elif k in ('samples', 'latency_intervals'):
+                for c, a in v.items():
+                    ret[k+'.'+c] = a
+        return ret
+
+    def summary(self):
+        """scalar statistics, with device identity and ioworker arguments
+
+        # Returns
+            (dict): the result without columns of columns()
+        """
+
+        return {k: v for k, v in self.items()
+                if not isinstance(v, (array.array, list))
+                and k not in ('samples', 'latency_intervals')}
+
+    def to_json(self, path=None):
+        """export the summary in JSON
+
+        # Attributes
+            path (str): the file to write. Default: None, only return the JSON string
+
+        # Returns
+            (str): the JSON string of summary()
+        """
+
+        ret = json.dumps(self.summary(), indent=2)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(ret)
+        return ret
+
+    def to_npz(self, path):
+        """export columns and the summary to a compressed numpy .npz file
+
+        # Attributes
+            path (str): the file to write
+
+        # Notices
+            numpy is required. The summary is saved as a JSON string in the array "summary", and the columns can be loaded without pynvme: numpy.load(path)["samples.time_ms"]
+        """
+
+        import numpy
+        arrays = {k: numpy.asarray(v) for k, v in self.columns().items()}
+        arrays['summary'] = numpy.array(json.dumps(self.summary()))
+        numpy.savez_compressed(path, **arrays)
+
+
+# bounded memory of sub-second samples and latency intervals in each ioworker
+_ioworker_sample_max = 65536
+_ioworker_latency_interval_max = 65536
+
+
 class _IOWorker(object):
     """A process-worker executing user functions. Use its wrapper function Namespace.ioworker() in scripts. """
 
-    def __init__(self, pciaddr, nsid, lba_start, lba_size, lba_align,
+    def __init__(self, pciaddr, transport, nsid, lba_start, lba_size, lba_align,
                  lba_random, region_start, region_end,
                  read_percentage, iops, io_count, time, qdepth, qprio,
-                 output_io_per_second, output_percentile_latency):
+                 output_io_per_second, output_percentile_latency,
+                 sgl_segment_size, sample_interval_ms, latency_interval_ms,
+                 args=None, device=None):
         # queue for returning result
         self.q = _mp.Queue()
 
@@ -1966,13 +3226,17 @@ class _IOWorker(object):
 
         # create the child process
         self.p = _mp.Process(target = self._ioworker,
-                             args = (self.q, self.l, pciaddr, nsid,
+                             args = (self.q, self.l, pciaddr, transport, nsid,
                                      lba_start, lba_size, lba_align, lba_random,
                                      region_start, region_end, read_percentage,
                                      iops, io_count, time, qdepth, qprio,
-                                     output_io_per_second, output_percentile_latency))
+                                     output_io_per_second, output_percentile_latency,
+                                     sgl_segment_size, sample_interval_ms,
+                                     latency_interval_ms))
         self.output_io_per_second = output_io_per_second
         self.output_percentile_latency = output_percentile_latency
+        self.args = args
+        self.device = device
         self.p.daemon = True
 
     def start(self):
@@ -1997,8 +3261,9 @@ class _IOWorker(object):
         """
 
         # get data from queue before joinging the subprocess, otherwise deadlock
-        childpid, error, rets, output_io_per_second, output_io_per_latency = self.q.get()
-        rets = DotDict(rets)
+        childpid, error, rets, output_io_per_second, output_io_per_latency, \
+            samples, latency_intervals = self.q.get()
+        rets = IOWorkerResult(rets)
         self.p.join()
         logging.debug("ioworker closed")
 
@@ -2013,6 +3278,15 @@ class _IOWorker(object):
             assert len(self.output_io_per_second) == 0
             self.output_io_per_second += output_io_per_second
             rets['iops_consistency'] = self.iops_consistency()
+            rets['io_per_second'] = array.array('I', output_io_per_second)
+
+        # sub-second samples in columns
+        if samples is not None:
+            rets['samples'] = DotDict(samples)
+
+        # latency percentiles of each interval in columns
+        if latency_intervals is not None:
+            rets['latency_intervals'] = DotDict(latency_intervals)
 
         # transfer output table back: driver => script
         if output_io_per_latency is not None:
@@ -2036,6 +3310,13 @@ class _IOWorker(object):
             for i, k in enumerate(self.output_percentile_latency):
                 assert k>0 and k<100, "percentile should be in (0, 100)"
                 self.output_percentile_latency[k] = self.find_percentile_latency(k, output_io_per_latency)
+            rets['percentile_latency'] = DotDict(self.output_percentile_latency)
+
+        # identify the run in exported results
+        if self.args is not None:
+            rets['args'] = DotDict(self.args)
+        if self.device is not None:
+            rets['device'] = DotDict(self.device)
 
         logging.debug(f"ioworker result: {rets}")
 
@@ -2064,14 +3345,17 @@ class _IOWorker(object):
         self.close()
         return True
 
-    def _ioworker(self, rqueue, locker, pciaddr, nsid, lba_start, lba_size,
+    def _ioworker(self, rqueue, locker, pciaddr, transport, nsid, lba_start, lba_size,
                   lba_align, lba_random, region_start, region_end,
                   read_percentage, iops, io_count, seconds, qdepth, qprio,
-                  output_io_per_second, output_percentile_latency):
+                  output_io_per_second, output_percentile_latency,
+                  sgl_segment_size, sample_interval_ms, latency_interval_ms):
         cdef d.ioworker_args args
         cdef d.ioworker_rets rets
         cdef int error = 0
         output_io_per_latency = None
+        samples = None
+        latency_intervals = None
 
         try:
             # register events in worker's processor
@@ -2097,6 +3381,24 @@ class _IOWorker(object):
                 # 1-1000,000 us, all latency > 1s are counted as 1000,000us
                 args.io_counter_per_latency = <unsigned int*>PyMem_Malloc(1000*1000*sizeof(unsigned int))
 
+            # create buffer for output data: sub-second samples
+            if sample_interval_ms:
+                args.sample_max = _ioworker_sample_max
+                if seconds:
+                    args.sample_max = min(_ioworker_sample_max, max(4, seconds*1000//sample_interval_ms+2))
+                args.sample_interval_ms = sample_interval_ms
+                args.samples = <d.ioworker_sample*>PyMem_Malloc(args.sample_max*sizeof(d.ioworker_sample))
+
+            # create array for output data: latency percentiles per interval
+            if latency_interval_ms:
+                args.latency_interval_max = _ioworker_latency_interval_max
+                if seconds:
+                    args.latency_interval_max = min(_ioworker_latency_interval_max,
+                                                    max(4, seconds*1000//latency_interval_ms+2))
+                args.latency_interval_ms = latency_interval_ms
+                args.latency_intervals = <d.ioworker_latency_interval*>PyMem_Malloc(
+                    args.latency_interval_max*sizeof(d.ioworker_latency_interval))
+
             # transfer agurments
             args.lba_start = lba_start
             args.lba_size = lba_size
@@ -2109,10 +3411,11 @@ class _IOWorker(object):
             args.io_count = io_count
             args.seconds = seconds
             args.qdepth = qdepth
+            args.sgl_segment_size = sgl_segment_size
 
             # ready
             with locker:
-                nvme0 = Controller(pciaddr)
+                nvme0 = Controller(pciaddr, **transport)
                 nvme0n1 = Namespace(nvme0, nsid)
                 qpair = Qpair(nvme0, max(2, qdepth), qprio)
 
@@ -2133,6 +3436,30 @@ class _IOWorker(object):
                 for i in range(1000*1000):
                     output_io_per_latency.append(args.io_counter_per_latency[i])
 
+            # transfer back samples in columns: c => cython
+            if sample_interval_ms:
+                samples = {'time_ms': array.array('I'),
+                           'io_count_read': array.array('I'),
+                           'io_count_write': array.array('I'),
+                           'bytes': array.array('Q')}
+                for i in range(rets.sample_count):
+                    samples['time_ms'].append(args.samples[i].time_ms)
+                    samples['io_count_read'].append(args.samples[i].io_count_read)
+                    samples['io_count_write'].append(args.samples[i].io_count_write)
+                    samples['bytes'].append(args.samples[i].bytes)
+
+            # transfer back latency percentiles in columns: c => cython
+            if latency_interval_ms:
+                latency_intervals = {k: array.array('I') for k in
+                                     ('time_ms', 'io_count', 'p50_us', 'p99_us', 'p999_us', 'max_us')}
+                for i in range(rets.latency_interval_count):
+                    latency_intervals['time_ms'].append(args.latency_intervals[i].time_ms)
+                    latency_intervals['io_count'].append(args.latency_intervals[i].io_count)
+                    latency_intervals['p50_us'].append(args.latency_intervals[i].p50_us)
+                    latency_intervals['p99_us'].append(args.latency_intervals[i].p99_us)
+                    latency_intervals['p999_us'].append(args.latency_intervals[i].p999_us)
+                    latency_intervals['max_us'].append(args.latency_intervals[i].max_us)
+
         except Exception as e:
             logging.warning(e)
             warnings.warn(e)
@@ -2148,7 +3475,9 @@ class _IOWorker(object):
                         error,
                         rets,
                         output_io_per_second,
-                        output_io_per_latency))
+                        output_io_per_latency,
+                        samples,
+                        latency_intervals))
 
             with locker:
                 # close resources in right order
@@ -2160,31 +3489,61 @@ class _IOWorker(object):
                 del nvme0n1
                 del nvme0
 
+                # return cached buffers to hugepage memory before the
+                # process exits, driver_fini is not called in workers
+                d.buffer_pool_release()
+
             if args.io_counter_per_second:
                 PyMem_Free(args.io_counter_per_second)
 
             if args.io_counter_per_latency:
                 PyMem_Free(args.io_counter_per_latency)
 
+            if args.samples:
+                PyMem_Free(args.samples)
+
+            if args.latency_intervals:
+                PyMem_Free(args.latency_intervals)
+
             import gc; gc.collect()
 
 
-def config(verify, fua_read=False, fua_write=False):
+def buffer_pool_stats():
+    """get the statistics of the buffer pool in this process
+
+    # Returns
+        (DotDict): alloc_count, reuse_count, bytes_in_use, bytes_in_use_max (high water mark), and bytes_cached
+    """
+
+    cdef d.buffer_pool_stats stats
+    d.buffer_pool_get_stats(&stats)
+    return DotDict(stats)
+
+
+def buffer_pool_release():
+    """free all cached buffers in the buffer pool back to hugepage memory"""
+
+    d.buffer_pool_release()
+
+
+def config(verify, fua_read=False, fua_write=False, stages=False):
     """config driver global setting
 
     # Attributes
         verify (bool): enable inline checksum verification of read
         fua_read (bool): enable FUA of read. Default: False
         fua_write (bool): enable FUA of write. Default: False
+        stages (bool): enable timestamps of command stages, see Qpair.stages(). Default: False
 
     # Returns
-        None
+        (int): the config word in effect. The verify bit is 0 when the checksum table is not available, e.g. more than one namespace is opened.
     """
 
     # TODO: implement FUA in driver.c
     return d.driver_config((verify << 0) |
                            (fua_read << 1) |
-                           (fua_write << 2))
+                           (fua_write << 2) |
+                           (stages << 3))
 
 
 # module init, needs root privilege
@@ -2201,8 +3560,13 @@ if os.geteuid() == 0:
     # spawn only limited data from parent process
     _mp = multiprocessing.get_context("spawn")
 
-    # init driver
-    if d.driver_init() != 0:
+    # init driver, farm.py assigns each device worker its own driver
+    # instance, core set, hugepage budget and device
+    _shm_id = int(os.environ.get("PYNVME_SHM_ID", "0"))
+    _core_mask = os.environ.get("PYNVME_CORE_MASK", "").encode('ascii')
+    _mem_size = int(os.environ.get("PYNVME_MEM_SIZE", "512"))
+    _pciaddr = os.environ.get("PYNVME_PCIADDR", "").encode('ascii')
+    if d.driver_init(_shm_id, _core_mask, _mem_size, _pciaddr) != 0:
         logging.error("driver initialization fail")
         raise SystemExit("driver initialization fail")
 
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+#
+#  BSD LICENSE
+#
+#  Copyright (c) Crane Che <cranechu@gmail.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in
+#      the documentation and/or other materials provided with the
+#      distribution.
+#    * Neither the name of Intel Corporation nor the names of its
+#      contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+#  "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+#  LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+#  OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+#  SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+#  LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+#  DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+#  THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#  (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""run pytest on many devices in parallel, one worker process per device
+
+    sudo python3 farm.py --pciaddr=01:00.0,02:00.0 -- driver_test.py -x
+
+Without --pciaddr, all NVMe devices in the system are tested. Each
+worker is an independent pynvme driver instance (own shm_id and rpc
+socket /var/tmp/pynvme.sock.<shm_id>), pinned to its own core set,
+with its own share of hugepage memory, and attached to its own device
+only. Logs and junit results of each device are kept in --outdir, and
+a per-device summary is printed when all workers finish.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import subprocess
+import xml.etree.ElementTree as ET
+
+
+def probe_devices(sysfs="/sys/bus/pci/devices"):
+    """list BDF of all NVMe devices in one scan of the pci bus"""
+    ret = []
+    for dev in sorted(glob.glob(os.path.join(sysfs, "*"))):
+        with open(os.path.join(dev, "class")) as f:
+            # mass storage, non-volatile memory controller
+            if int(f.read(), 16) >> 8 == 0x0108:
+                bdf = os.path.basename(dev)
+                # same format as --pciaddr, the default domain is omitted
+                if bdf.startswith("0000:"):
+                    bdf = bdf[5:]
+                ret.append(bdf)
+    return ret
+
+
+def hugepage_mb():
+    """total hugepage memory in MB"""
+    info = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            k, v = line.split(":")
+            info[k] = int(v.split()[0])
+    return info.get("HugePages_Total", 0)*info.get("Hugepagesize", 0)//1024
+
+
+def core_masks(count, ncpu):
+    """split cores evenly to workers, return the core mask of each worker
+
+    Masks are not limited to 64 bits, and are passed to workers in hex.
+    """
+    ret = []
+    per = max(1, ncpu//count)
+    for i in range(count):
+        first = (i*per) % ncpu
+        ret.append(sum(1 << ((first+c) % ncpu) for c in range(per)))
+    return ret
+
+
+def junit_summary(path):
+    """get test result counters from the junit xml file"""
+    ret = {"tests": 0, "failures": 0, "errors": 0, "skipped": 0, "time": 0.0}
+    try:
+        root = ET.parse(path).getroot()
+    except (OSError, ET.ParseError):
+        ret["errors"] = 1
+        return ret
+
+    # pytest writes <testsuites><testsuite/></testsuites> in later versions
+    suites = [root] if root.tag == "testsuite" else root.findall("testsuite")
+    for suite in suites:
+        for k in ret:
+            ret[k] += type(ret[k])(suite.get(k, 0))
+    return ret
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="run pytest on many NVMe devices in parallel")
+    parser.add_argument("--pciaddr", default="",
+                        help="comma separated BDF addresses, default: all NVMe devices")
+    parser.add_argument("--outdir", default="farm",
+                        help="folder of worker logs and results")
+    parser.add_argument("--mem-size", type=int, default=0,
+                        help="hugepage MB of each worker, default: even share, max 2048")
+    parser.add_argument("pytest_args", nargs="*", default=["driver_test.py"],
+                        help="arguments passed to each pytest worker")
+    args = parser.parse_args(argv)
+
+    devices = [a.strip() for a in args.pciaddr.split(",") if a.strip()]
+    if not devices:
+        devices = probe_devices()
+    if not devices:
+        print("no NVMe device found")
+        return 1
+
+    mem_size = args.mem_size
+    if mem_size == 0:
+        mem_size = min(2048, hugepage_mb()//len(devices))
+    if mem_size < 64:
+        print("no enough hugepage memory for %d devices" % len(devices))
+        return 1
+
+    os.makedirs(args.outdir, exist_ok=True)
+    masks = core_masks(len(devices), os.cpu_count())
+
+    # start all workers
+    workers = {}
+    start_time = time.time()
+    for i, bdf in enumerate(devices):
+        name = bdf.replace(":", "-")
+        junit = os.path.join(args.outdir, name+".xml")
+        env = dict(os.environ,
+                   PYNVME_SHM_ID=str(i+1),
+                   PYNVME_CORE_MASK="0x%x" % masks[i],
+                   PYNVME_MEM_SIZE=str(mem_size),
+                   PYNVME_PCIADDR=bdf)
+        cmd = [sys.executable, "-B", "-m", "pytest"] + args.pytest_args + \
+              ["--pciaddr=%s" % bdf, "--junitxml=%s" % junit, "-p", "no:cacheprovider"]
+        log = open(os.path.join(args.outdir, name+".log"), "w")
+        proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        workers[bdf] = (proc, log, junit)
+        print("worker %d: %s, pid %d, cores 0x%x, %dMB" %
+              (i+1, bdf, proc.pid, masks[i], mem_size))
+
+    # aggregate results per device
+    summary = {}
+    for bdf, (proc, log, junit) in workers.items():
+        proc.wait()
+        log.close()
+        summary[bdf] = junit_summary(junit)
+        summary[bdf]["returncode"] = proc.returncode
+
+    print("%-16s %6s %6s %6s %6s %10s" %
+          ("device", "tests", "fail", "error", "skip", "time(s)"))
+    for bdf, r in summary.items():
+        print("%-16s %6d %6d %6d %6d %10.1f" %
+              (bdf, r["tests"], r["failures"], r["errors"], r["skipped"], r["time"]))
+    print("%d devices tested in %.1f seconds" % (len(devices), time.time()-start_time))
+
+    with open(os.path.join(args.outdir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+
+    return 0 if all(r["returncode"] == 0 for r in summary.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
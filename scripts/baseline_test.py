@@ -0,0 +1,44 @@
+import pytest
+
+from baseline import compare
+
+
+def _runs(*iops, io_per_second=()):
+    return [{"metrics": {"iops": v}, "io_per_second": list(io_per_second)}
+            for v in iops]
+
+
+def _iops(rows):
+    return [r for r in rows if r["metric"] == "iops"][0]
+
+
+def test_compare_single_run():
+    # noisy io per second does not widen the band of a single run
+    noisy = [100, 5000, 300, 4800, 200, 4600]
+    r = _iops(compare(_runs(10000, io_per_second=noisy),
+                      _runs(7000, io_per_second=noisy)))
+    assert r["band"] == 0.02
+    assert r["regression"]
+
+    r = _iops(compare(_runs(10000, 10100, 9900), _runs(9900)))
+    assert r["band"] == 0.02
+    assert not r["regression"]
+
+
+def test_compare_repeats():
+    base = _runs(10000, 11000, 9000)
+    r = _iops(compare(base, _runs(9500, 10500, 8500)))
+    assert r["band"] > 0.02
+    assert not r["regression"]
+
+    # stable repeats keep the band of the tolerance
+    r = _iops(compare(_runs(10000, 10000), _runs(9700, 9700)))
+    assert r["band"] == 0.02
+    assert r["regression"]
+
+
+@pytest.mark.parametrize("tolerance", [0.05, {"iops": 0.05}])
+def test_compare_tolerance(tolerance):
+    r = _iops(compare(_runs(10000), _runs(9600), tolerance))
+    assert r["band"] == 0.05
+    assert not r["regression"]
@@ -0,0 +1,144 @@
+"""host-side overhead benchmarks on the local NVMe/TCP malloc target
+
+    make nvmt
+    sudo python3 -B -m pytest scripts/benchmark_test.py --pciaddr=127.0.0.1
+
+The malloc bdev has no media latency, so the numbers here are dominated
+by pynvme itself. Results are saved together with the git commit, to be
+compared across commits. Each run writes a new file in folder benchmark,
+named by the commit and the time, unless --benchmark-json is given.
+"""
+
+import os
+import json
+import time
+import pytest
+import logging
+import subprocess
+
+import nvme as d
+
+
+_results = {}
+
+
+def _timeit(func, count, rounds=3):
+    # time of each call in us, best of the rounds
+    best = None
+    for r in range(rounds):
+        start = time.perf_counter()
+        for i in range(count):
+            func()
+        t = (time.perf_counter()-start)*1000000/count
+        best = t if best is None else min(best, t)
+    return best
+
+
+def _record(name, value, unit="us"):
+    logging.info("%s: %.3f %s" % (name, value, unit))
+    _results[name] = {"value": round(value, 3), "unit": unit}
+
+
+@pytest.fixture(scope="module", autouse=True)
+def benchmark(pciaddr, request):
+    if ':' in pciaddr:
+        pytest.skip("benchmark runs on the local NVMe/TCP target only")
+
+    yield _results
+
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    commit = commit.stdout.decode().strip()
+    date = time.localtime()
+
+    # keep results of every run, unless the file is given
+    path = request.config.getoption("--benchmark-json")
+    if not path:
+        path = os.path.join("benchmark", "%s_%s.json" %
+                            (time.strftime("%Y%m%d-%H%M%S", date), commit or "unknown"))
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, "w") as f:
+        json.dump({"commit": commit,
+                   "date": time.strftime("%Y-%m-%d %H:%M:%S", date),
+                   "target": pciaddr,
+                   "results": _results}, f, indent=2)
+    logging.info("benchmark results saved to %s" % path)
+
+
+def test_buffer_slice():
+    buf = d.Buffer(4096)
+    _record("buffer_getitem_us", _timeit(lambda: buf[100], 100000))
+    _record("buffer_slice_us", _timeit(lambda: buf[0:512], 100000))
+
+    def setitem():
+        buf[100] = 0x5a
+    _record("buffer_setitem_us", _timeit(setitem, 100000))
+
+
+@pytest.mark.parametrize("size", [512, 4096, 128*1024])
+def test_buffer_alloc(size):
+    _record("buffer_alloc_%d_us" % size, _timeit(lambda: d.Buffer(size), 1000))
+
+
+def test_command_latency(nvme0, nvme0n1):
+    q = d.Qpair(nvme0, 16)
+    buf = d.Buffer(4096)
+
+    def read():
+        nvme0n1.read(q, buf, 0, 1).waitdone()
+    _record("read_qd1_us", _timeit(read, 10000))
+
+    def write():
+        nvme0n1.write(q, buf, 0, 1).waitdone()
+    _record("write_qd1_us", _timeit(write, 10000))
+    del q
+
+
+def test_waitdone_overhead(nvme0, nvme0n1):
+    q = d.Qpair(nvme0, 64)
+    buf = d.Buffer(4096)
+    _record("waitdone_empty_us", _timeit(lambda: q.waitdone(0), 100000))
+
+    # completion cost of each command when reaped in a batch
+    def batch():
+        for i in range(32):
+            nvme0n1.read(q, buf, i, 1)
+        q.waitdone(32)
+    _record("read_qd32_batch_us", _timeit(batch, 1000)/32)
+    del q
+
+
+def test_ioworker_startup(nvme0n1):
+    def startup():
+        nvme0n1.ioworker(io_size=8, lba_align=8, lba_random=False,
+                         read_percentage=100, io_count=1, qdepth=1).start().close()
+    _record("ioworker_startup_ms", _timeit(startup, 5, rounds=1)/1000, "ms")
+
+
+@pytest.mark.parametrize("qdepth", [1, 32])
+def test_ioworker_iops(nvme0n1, qdepth):
+    r = nvme0n1.ioworker(io_size=8, lba_align=8, lba_random=True,
+                         read_percentage=100, time=5, qdepth=qdepth).start().close()
+    _record("ioworker_iops_qd%d" % qdepth, r.io_count_read*1000/r.mseconds, "IOPS")
+
+
+def test_ioworker_close(nvme0n1):
+    percentile_latency = dict.fromkeys([50, 90, 99, 99.9, 99.999])
+    io_per_second = []
+    w = nvme0n1.ioworker(io_size=8, lba_align=8, lba_random=True,
+                         read_percentage=100, time=5, qdepth=32,
+                         output_io_per_second=io_per_second,
+                         output_percentile_latency=percentile_latency).start()
+
+    # let the worker finish, so only the post-processing is measured. The
+    # worker puts its results to the queue when all IOs are completed.
+    deadline = time.time()+30
+    while w.q.empty():
+        assert time.time() < deadline, "ioworker is not finished in time"
+        time.sleep(0.01)
+    start = time.perf_counter()
+    w.close()
+    _record("ioworker_close_ms", (time.perf_counter()-start)*1000, "ms")
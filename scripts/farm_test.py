@@ -0,0 +1,67 @@
+import pytest
+
+import farm
+
+
+def _fake_device(sysfs, bdf, pci_class):
+    dev = sysfs/bdf
+    dev.mkdir()
+    (dev/"class").write_text("0x%06x\n" % pci_class)
+
+
+def test_probe_devices(tmp_path):
+    _fake_device(tmp_path, "0000:02:00.0", 0x010802)
+    _fake_device(tmp_path, "0000:01:00.0", 0x010802)
+    _fake_device(tmp_path, "0000:00:1f.2", 0x010601)  # ahci
+    _fake_device(tmp_path, "0000:00:02.0", 0x030000)  # vga
+    _fake_device(tmp_path, "10000:01:00.0", 0x010802)  # vmd domain
+
+    assert farm.probe_devices(str(tmp_path)) == \
+        ["01:00.0", "02:00.0", "10000:01:00.0"]
+    assert farm.probe_devices(str(tmp_path/"none")) == []
+
+
+@pytest.mark.parametrize("count, ncpu", [(1, 4), (2, 8), (3, 8), (8, 4), (4, 128), (3, 256)])
+def test_core_masks(count, ncpu):
+    masks = farm.core_masks(count, ncpu)
+    assert len(masks) == count
+    for m in masks:
+        assert m != 0
+        assert m < 1<<ncpu
+        assert bin(m).count('1') == max(1, ncpu//count)
+
+    # workers do not share cores until cores are not enough
+    if count <= ncpu:
+        for i in range(count):
+            for j in range(i):
+                assert masks[i] & masks[j] == 0
+
+
+def test_core_masks_above_64():
+    masks = farm.core_masks(2, 160)
+    assert masks[1] == ((1<<80)-1)<<80
+    assert "0x%x" % masks[1] == "0x" + "f"*20 + "0"*20
+
+
+def test_junit_summary(tmp_path):
+    xml = tmp_path/"a.xml"
+    xml.write_text('<testsuites>'
+                   '<testsuite tests="10" failures="1" errors="0" skipped="2" time="1.5"/>'
+                   '<testsuite tests="5" failures="0" errors="1" skipped="0" time="0.5"/>'
+                   '</testsuites>')
+    assert farm.junit_summary(str(xml)) == \
+        {"tests": 15, "failures": 1, "errors": 1, "skipped": 2, "time": 2.0}
+
+    xml.write_text('<testsuite tests="3" failures="0" errors="0" skipped="1" time="0.25"/>')
+    assert farm.junit_summary(str(xml)) == \
+        {"tests": 3, "failures": 0, "errors": 0, "skipped": 1, "time": 0.25}
+
+
+def test_junit_summary_invalid(tmp_path):
+    # the worker crashed before junit result is written
+    r = farm.junit_summary(str(tmp_path/"missing.xml"))
+    assert r["errors"] == 1 and r["tests"] == 0
+
+    xml = tmp_path/"broken.xml"
+    xml.write_text('<testsuite tests="3"')
+    assert farm.junit_summary(str(xml))["errors"] == 1
@@ -0,0 +1,52 @@
+import pytest
+
+import nvme as d
+
+
+def test_tcp_target(tcp_nvme0):
+    n = d.Namespace(tcp_nvme0, 1)
+    q = d.Qpair(tcp_nvme0, 8)
+    write_buf = d.Buffer(512)
+    read_buf = d.Buffer(512)
+    write_buf[0:512] = bytes(range(256))*2
+    n.write(q, write_buf, 8).waitdone()
+    n.read(q, read_buf, 8).waitdone()
+    assert read_buf[:] == write_buf[:]
+
+    r = n.ioworker(io_size=8, lba_align=8, lba_random=True,
+                   read_percentage=50, io_count=10000, qdepth=16).start().close()
+    assert r.io_count_read + r.io_count_write == 10000
+    n.close()
+
+
+def test_tcp_target_namespaces():
+    target = d.TcpTarget(size_mb=16, sector_size=4096, ns_count=2)
+    if not target.available:
+        pytest.skip("nvmf_tgt is not available")
+
+    with target:
+        c = d.Controller(b'127.0.0.1', target.port)
+        assert c.id_data(519, 516) == 2
+        n = d.Namespace(c, 1)
+        assert n.id_data(7, 0) == 16*1024*1024//4096
+
+        # the other namespace has the same size
+        buf = d.Buffer(4096)
+        c.identify(buf, 2, 0).waitdone()
+        assert buf.data(7, 0) == 16*1024*1024//4096
+        n.close()
+        del c
+
+
+@pytest.mark.parametrize("digest", [False, True])
+def test_tcp_transport_options(tcp_target, digest):
+    c = d.Controller(b'127.0.0.1', tcp_target.port,
+                     subnqn=tcp_target.subnqn.encode('ascii'),
+                     hdgst=digest, ddgst=digest, io_queue_size=64)
+    assert c.id_data(1023, 768, str).rstrip('\x00') == tcp_target.subnqn
+    n = d.Namespace(c, 1)
+    r = n.ioworker(io_size=64, lba_align=64, lba_random=True,
+                   read_percentage=50, io_count=1000, qdepth=32).start().close()
+    assert r.io_count_read + r.io_count_write == 1000
+    n.close()
+    del c